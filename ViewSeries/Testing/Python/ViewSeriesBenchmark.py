@@ -0,0 +1,291 @@
+# ViewSeriesBenchmark.py
+#
+# Latency benchmarks of the data side of ViewSeries (ViewSeriesLib.StudyBrowser,
+# which ViewSeriesLogic is built on) against a synthetic DICOM database.
+#
+# The stand-in database is an sqlite file with the tables of ctkDICOMDatabase
+# that ViewSeries uses (patients, studies, series, images and the tag cache),
+# read with ViewSeriesLib.SQLiteDatabase. Each patient gets studies with an MR series, a CT series in
+# every other study and a SEG series referencing the MR. Every 20th SEG
+# references the MR of another study and every 50th references a series that
+# is not in the database. The SEG files are written with pydicom (header
+# only); the MR/CT images are only rows in the database, since nothing here
+# reads their pixels.
+#
+# Reported, in milliseconds:
+#   startup      building the hierarchy index, the search index and the
+#                reference graph (cold, then warm from its saved file), and
+#                the first page of the patient list
+#   patientClick listing the studies of a patient
+#   studyOpen    building the load plan of a study (without DICOM plugins)
+#   search       one keystroke of the patient search
+#
+# Each measure has a budget; a run over budget, or slower than a previous
+# report given with --baseline by more than --tolerance, fails. With
+# --timings, the instrumentation spans and counters of each size are printed
+# as well (see ViewSeriesLib/Instrumentation.py).
+#
+# Usage:
+#   python ViewSeriesBenchmark.py --patients 100 10000 100000 --report report.json
+#   Slicer --no-main-window --python-script ViewSeriesBenchmark.py --patients 100
+#
+# The databases are generated once in --work-dir and reused by later runs.
+################################################################################
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+from ViewSeriesLib import StudyBrowser, ReferenceGraph, TagFetch, SQLiteDICOMDatabase, instrumentation
+from ViewSeriesLib.RecordLists import patientList, SORT_BY_NAME
+
+# per call budgets in ms, and startup budgets in ms per 1000 patients
+BUDGETS = {
+    'patientClick.p95': 5.0,
+    'studyOpen.p95': 50.0,
+    'search.p95': 50.0,
+    'startup.firstPage': 500.0,
+}
+STARTUP_BUDGETS_PER_1000_PATIENTS = {
+    'startup.index': 1000.0,
+    'startup.search': 200.0,
+    'startup.references.warm': 50.0,
+}
+
+STUDIES_PER_PATIENT = 2
+IMAGES_PER_SERIES = 20
+
+
+#
+# Stand-in database (read with ViewSeriesLib.SQLiteDatabase)
+#
+
+def writeSegmentationHeader(fileName, seriesUID, studyUID, referencedSeriesUID):
+    """A SEG file with only the header fields ViewSeries reads."""
+    import pydicom
+    from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+    segmentationStorage = '1.2.840.10008.5.1.4.1.1.66.4'
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = segmentationStorage
+    meta.MediaStorageSOPInstanceUID = seriesUID + '.1'
+    meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    dataset = FileDataset(fileName, {}, file_meta=meta, preamble=b'\0' * 128)
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+    dataset.SOPClassUID = segmentationStorage
+    dataset.SOPInstanceUID = seriesUID + '.1'
+    dataset.Modality = 'SEG'
+    dataset.StudyInstanceUID = studyUID
+    dataset.SeriesInstanceUID = seriesUID
+    referencedSeries = Dataset()
+    referencedSeries.SeriesInstanceUID = referencedSeriesUID
+    dataset.ReferencedSeriesSequence = [referencedSeries]
+    pydicom.dcmwrite(fileName, dataset)
+
+
+def generateDatabase(directory, patientCount, seed=0):
+    """Write the stand-in database of patientCount patients to directory
+    (unless it is already there) and return its path.
+    """
+    path = os.path.join(directory, 'ctkDICOM.sql')
+    if os.path.exists(os.path.join(directory, 'complete')):
+        return path
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(os.path.join(directory, 'seg'))
+    randomGenerator = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.executescript(SQLiteDICOMDatabase.schema)
+    patients, studies, series, images, tags = [], [], [], [], []
+    previousVolumeUID = ''
+    segmentationCount = 0
+
+    def addSeries(studyUID, seriesUID, modality, description, number, files):
+        series.append((seriesUID, studyUID, modality, description, str(number)))
+        for imageNumber, fileName in enumerate(files):
+            instanceUID = '%s.%d' % (seriesUID, imageNumber + 1)
+            images.append((instanceUID, fileName, seriesUID))
+            if imageNumber == 0:
+                # ctkDICOMDatabase caches these when the files are imported
+                tags.append((instanceUID, TagFetch.MODALITY, modality))
+                tags.append((instanceUID, TagFetch.SERIES_DESCRIPTION, description))
+
+    for patient in range(1, patientCount + 1):
+        patients.append((patient, 'Patient%d^%s' % (patient, randomGenerator.choice(['Anna', 'Ben', 'Chen', 'Dara', 'Eli'])), 'ID%07d' % patient))
+        for study in range(STUDIES_PER_PATIENT):
+            studyUID = '2.25.%d.%d' % (patient, study)
+            studyDate = '20%02d%02d%02d' % (randomGenerator.randint(10, 23), randomGenerator.randint(1, 12), randomGenerator.randint(1, 28))
+            studies.append((studyUID, patient, studyDate, 'Study %d' % study))
+            volumeUID = studyUID + '.1'
+            addSeries(studyUID, volumeUID, 'MR', 'T2 AX %d' % study, 1,
+                      ['/synthetic/%s/%d.dcm' % (volumeUID, n) for n in range(IMAGES_PER_SERIES)])
+            if study % 2:
+                ctUID = studyUID + '.2'
+                addSeries(studyUID, ctUID, 'CT', 'CT %d' % study, 2,
+                          ['/synthetic/%s/%d.dcm' % (ctUID, n) for n in range(IMAGES_PER_SERIES)])
+            segmentationUID = studyUID + '.3'
+            segmentationCount += 1
+            if segmentationCount % 50 == 0:
+                referencedUID = '2.25.999.%d' % segmentationCount  # not in the database
+            elif segmentationCount % 20 == 0 and previousVolumeUID:
+                referencedUID = previousVolumeUID  # in another study
+            else:
+                referencedUID = volumeUID
+            fileName = os.path.join(directory, 'seg', segmentationUID + '.dcm')
+            writeSegmentationHeader(fileName, segmentationUID, studyUID, referencedUID)
+            addSeries(studyUID, segmentationUID, 'SEG', 'Segmentation %d' % study, 3, [fileName])
+            previousVolumeUID = volumeUID
+        if patient % 5000 == 0 or patient == patientCount:
+            connection.executemany('INSERT INTO Patients VALUES (?, ?, ?)', patients)
+            connection.executemany('INSERT INTO Studies VALUES (?, ?, ?, ?)', studies)
+            connection.executemany('INSERT INTO Series VALUES (?, ?, ?, ?, ?)', series)
+            connection.executemany('INSERT INTO Images VALUES (?, ?, ?)', images)
+            connection.executemany('INSERT INTO TagCache VALUES (?, ?, ?)', tags)
+            connection.commit()
+            patients, studies, series, images, tags = [], [], [], [], []
+    connection.close()
+    open(os.path.join(directory, 'complete'), 'w').close()
+    return path
+
+
+#
+# Measures
+#
+
+def milliseconds(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return 1000.0 * (time.perf_counter() - start)
+
+
+def summary(name, samples):
+    samples = sorted(samples)
+    return {name + '.median': statistics.median(samples),
+            name + '.p95': samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+            name + '.max': samples[-1]}
+
+
+def runBenchmark(directory, patientCount, samples=200, seed=0):
+    """{measure: ms} for one database size."""
+    randomGenerator = random.Random(seed)
+    db = SQLiteDICOMDatabase(generateDatabase(directory, patientCount, seed))
+    graphPath = os.path.join(directory, 'references.json')
+    if os.path.exists(graphPath):
+        os.remove(graphPath)
+    browser = StudyBrowser(db, referenceGraph=ReferenceGraph(graphPath))
+    results = {'patients': patientCount}
+
+    def exhaust(steps):
+        for step in steps:
+            pass
+
+    results['startup.index'] = milliseconds(exhaust, browser.index.buildSteps())
+    results['startup.search'] = milliseconds(exhaust, browser.searchIndex.buildSteps())
+    results['startup.references.cold'] = milliseconds(exhaust, browser.referenceGraph.updateSteps(browser.index))
+    # a later session: the graph is read back from its file
+    browser.referenceGraph = ReferenceGraph(graphPath)
+    results['startup.references.warm'] = milliseconds(lambda: exhaust(browser.referenceGraph.updateSteps(browser.index)))
+
+    def firstPage():
+        records = patientList(browser.index, SORT_BY_NAME)
+        first, last = records.nextBatch()
+        return [records.text(records.key(row)) for row in range(first, last + 1)]
+    results['startup.firstPage'] = milliseconds(firstPage)
+
+    patientUIDs = randomGenerator.sample(browser.index.patientOrder, min(samples, patientCount))
+    results.update(summary('patientClick', [milliseconds(browser.listStudies, patientUID) for patientUID in patientUIDs]))
+
+    studyUIDs = randomGenerator.sample(list(browser.index.studyRecords), min(samples, len(browser.index.studyRecords)))
+    results.update(summary('studyOpen', [milliseconds(browser.loadPlan, studyUID) for studyUID in studyUIDs]))
+    plans = [browser.loadPlan(studyUID) for studyUID in studyUIDs[:20]]
+    results['studyOpen.missingSources'] = sum(len(plan['missingSources']) for plan in plans)
+
+    queries = []
+    for patientUID in patientUIDs[:samples // 4]:
+        text = browser.index.patientRecords[patientUID].name
+        queries.extend(text[:length] for length in range(1, min(len(text), 8) + 1))
+    results.update(summary('search', [milliseconds(browser.searchIndex.search, text=query) for query in queries]))
+    return results
+
+
+def regressions(results, baseline=None, tolerance=0.5):
+    """Messages for the measures over budget or slower than the baseline."""
+    messages = []
+    patientCount = results['patients']
+    for name, budget in BUDGETS.items():
+        if results[name] > budget:
+            messages.append('%d patients: %s %.1f ms is over its budget of %.1f ms' % (patientCount, name, results[name], budget))
+    for name, budget in STARTUP_BUDGETS_PER_1000_PATIENTS.items():
+        budget = max(budget, budget * patientCount / 1000.0)
+        if results[name] > budget:
+            messages.append('%d patients: %s %.1f ms is over its budget of %.1f ms' % (patientCount, name, results[name], budget))
+    if baseline:
+        for name, value in baseline.items():
+            # the maximums and the cold header reads depend too much on the machine's state
+            if name.endswith('.max') or name == 'startup.references.cold' or name not in results or not isinstance(value, float):
+                continue
+            # small times are noisy; only compare those over a millisecond
+            if results[name] > max(1.0, value * (1.0 + tolerance)):
+                messages.append('%d patients: %s %.2f ms, was %.2f ms' % (patientCount, name, results[name], value))
+    return messages
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Latency benchmarks of ViewSeries on synthetic DICOM databases.')
+    parser.add_argument('--patients', type=int, nargs='+', default=[100], help='database sizes, e.g. 100 10000 100000')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'ViewSeriesBenchmark'), help='where the databases are generated')
+    parser.add_argument('--samples', type=int, default=200, help='clicks and study opens timed per size')
+    parser.add_argument('--report', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown relative to the baseline (0.5 = 50%%)')
+    parser.add_argument('--timings', action='store_true', help='print the instrumentation spans and counters (adds a little overhead)')
+    args = parser.parse_args(argv)
+    instrumentation().enabled = args.timings
+    # the SEGs without a source are expected, do not log each of them
+    logging.getLogger().setLevel(logging.ERROR)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = dict((str(results['patients']), results) for results in json.load(baselineFile))
+
+    report, messages = [], []
+    for patientCount in args.patients:
+        results = runBenchmark(os.path.join(args.work_dir, str(patientCount)), patientCount, args.samples)
+        report.append(results)
+        for name in sorted(results):
+            value = results[name]
+            print('%7d patients  %-28s %s' % (patientCount, name, ('%10.2f ms' % value) if isinstance(value, float) else value))
+        if args.timings:
+            print(instrumentation().report())
+            instrumentation().reset()
+        messages.extend(regressions(results, baseline.get(str(patientCount)), args.tolerance))
+
+    if args.report:
+        with open(args.report, 'w') as reportFile:
+            json.dump(report, reportFile, indent=2)
+    for message in messages:
+        print('REGRESSION: ' + message)
+    return 1 if messages else 0
+
+
+if __name__ == '__main__':
+    status = main(sys.argv[1:])
+    if 'slicer' in sys.modules:
+        import slicer
+        slicer.util.exit(status)
+    sys.exit(status)
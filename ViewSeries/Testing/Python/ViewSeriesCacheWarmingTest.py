@@ -0,0 +1,115 @@
+# ViewSeriesCacheWarmingTest.py
+#
+# Tests of the headless cache warming (ViewSeriesLib/CacheWarming.py) on a
+# small database whose image files are listed out of slice order.
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib import CacheWarming, SQLiteDICOMDatabase, SegmentationCache, SegmentStatisticsCache, StudyBrowser, VolumeCache
+from ViewSeriesLib import sortSliceFiles
+from ViewSeriesTestData import writeDatabase, writeImageSeries, writeSegmentation
+
+STUDY_UID = '1.2.3'
+VOLUME_UID = '1.2.3.1'
+SEGMENTATION_UID = '1.2.3.9'
+# slice k of each file, in the order of the database
+ORDER = [2, 0, 4, 1, 3]
+
+
+class CacheWarmingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.origin, self.spacing = (-10.0, 20.0, 5.0), (0.5, 0.75, 2.5)
+        self.voxels = np.random.RandomState(1).randint(0, 1000, (5, 6, 7)).astype(np.int16)
+        self.volumeFiles = writeImageSeries(os.path.join(self.directory, 'mr'), VOLUME_UID, self.voxels, self.origin, self.spacing,
+                                            studyUID=STUDY_UID, order=ORDER)
+        self.mask = np.zeros(self.voxels.shape, dtype=bool)
+        self.mask[1:4, 2:5, 1:3] = True
+        self.segmentationFile = writeSegmentation(os.path.join(self.directory, 'seg.dcm'), SEGMENTATION_UID, VOLUME_UID,
+                                                  {1: ('Tumor', self.mask)}, self.origin, self.spacing, studyUID=STUDY_UID)
+        images = [('%s.%d' % (VOLUME_UID, number + 1), fileName, VOLUME_UID) for number, fileName in enumerate(self.volumeFiles)]
+        images.append((SEGMENTATION_UID + '.1', self.segmentationFile, SEGMENTATION_UID))
+        self.db = SQLiteDICOMDatabase(writeDatabase(
+            os.path.join(self.directory, 'ctkDICOM.sql'),
+            patients=[(1, 'Test^Patient', 'TEST')],
+            studies=[(STUDY_UID, 1, '20200105', 'Brain')],
+            series=[(VOLUME_UID, STUDY_UID, 'MR', 'T2 AX', '1'), (SEGMENTATION_UID, STUDY_UID, 'SEG', 'Tumor', '2')],
+            images=images))
+        self.browser = StudyBrowser(self.db)
+        self.browser.buildIndex()
+        self.cacheDirectory = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def warm(self):
+        return CacheWarming.warmCohort(self.browser, CacheWarming.selectStudies(self.browser), self.cacheDirectory, workers=1)
+
+    def test_sortSliceFiles(self):
+        self.assertEqual(self.db.filesForSeries(VOLUME_UID), self.volumeFiles)
+        sortedFiles = sortSliceFiles(self.volumeFiles)
+        self.assertEqual([self.volumeFiles[ORDER.index(k)] for k in range(len(ORDER))], sortedFiles)
+
+    def test_slicesInOrder(self):
+        summary, results = self.warm()
+        self.assertEqual((summary['warmed'], summary['failed']), (1, 0), results)
+        sortedFiles = sortSliceFiles(self.volumeFiles)
+        volumeArray = VolumeCache(os.path.join(self.cacheDirectory, 'volumes')).get(VOLUME_UID, sortedFiles)
+        self.assertIsNotNone(volumeArray)
+        np.testing.assert_array_equal(volumeArray.voxels, self.voxels)
+        np.testing.assert_allclose(volumeArray.origin, self.origin)
+        np.testing.assert_allclose(volumeArray.spacing, self.spacing)
+        # the entry is only valid for the files in slice order
+        self.assertIsNone(VolumeCache(os.path.join(self.cacheDirectory, 'volumes')).get(VOLUME_UID, self.volumeFiles))
+
+        segmentationArray = SegmentationCache(os.path.join(self.cacheDirectory, 'segmentations')).get(SEGMENTATION_UID, [self.segmentationFile])
+        np.testing.assert_array_equal(segmentationArray.labelmap(1), self.mask.astype(np.uint8))
+        statistics = SegmentStatisticsCache(os.path.join(self.cacheDirectory, 'statistics')).get(
+            SEGMENTATION_UID, VOLUME_UID, [self.segmentationFile] + sortedFiles)
+        self.assertEqual(statistics[0]['voxels'], int(self.mask.sum()))
+        self.assertAlmostEqual(statistics[0]['mean'], float(self.voxels[self.mask].mean()))
+        self.assertEqual(statistics[0]['max'], float(self.voxels[self.mask].max()))
+
+    def test_resume(self):
+        self.warm()
+        summary, results = self.warm()
+        self.assertEqual((summary['skipped'], summary['warmed']), (1, 0))
+        # changed files are warmed again
+        stat = os.stat(self.segmentationFile)
+        os.utime(self.segmentationFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        summary, results = self.warm()
+        self.assertEqual((summary['skipped'], summary['warmed']), (0, 1))
+
+    @unittest.skipUnless('slicer' in sys.modules, 'needs the DICOM scalar volume plugin of Slicer')
+    def test_matchesPlugin(self):
+        import slicer
+        self.warm()
+        plugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
+        loadable = plugin.examineFiles(self.volumeFiles)[0]
+        volumeNode = plugin.load(loadable)
+        try:
+            volumeArray = VolumeCache(os.path.join(self.cacheDirectory, 'volumes')).get(VOLUME_UID, loadable.files)
+            # a hit for the files of the loadable, with the voxels of the plugin
+            self.assertIsNotNone(volumeArray)
+            np.testing.assert_array_equal(volumeArray.voxels, slicer.util.arrayFromVolume(volumeNode))
+        finally:
+            slicer.mrmlScene.RemoveNode(volumeNode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# ViewSeriesLoadableCacheTest.py
+#
+# Tests of the memoized DICOM plugin examination (ViewSeriesLib/LoadableCache.py)
+# and of the examination steps of the load plans (ViewSeriesLib/StudyBrowser.py).
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib import Cancelled, CancellationToken, LoadableCache, SQLiteDICOMDatabase, StudyBrowser, fileListFingerprint
+from ViewSeriesTestData import writeDatabase, writeSegmentation
+
+
+class CountingPlugin(object):
+    """A DICOM plugin that counts the series it examines."""
+
+    def __init__(self):
+        self.examined = []
+
+    def examineFiles(self, files):
+        self.examined.append(list(files))
+        return ['loadable of %d files' % len(files)]
+
+
+class LoadableCacheTest(unittest.TestCase):
+
+    def test_fingerprint(self):
+        self.assertEqual(fileListFingerprint(['a', 'b']), fileListFingerprint(['b', 'a']))
+        self.assertNotEqual(fileListFingerprint(['a', 'b']), fileListFingerprint(['a', 'b', 'c']))
+        self.assertNotEqual(fileListFingerprint(['ab']), fileListFingerprint(['a', 'b']))
+
+    def test_examineOnce(self):
+        cache, plugin = LoadableCache(), CountingPlugin()
+        self.assertEqual(cache.examine(plugin, 'series1', ['a', 'b']), ['loadable of 2 files'])
+        self.assertEqual(cache.examine(plugin, 'series1', ['b', 'a']), ['loadable of 2 files'])
+        self.assertEqual((cache.hits, cache.misses, len(plugin.examined)), (1, 1, 1))
+        # a file added to the series
+        self.assertEqual(cache.examine(plugin, 'series1', ['a', 'b', 'c']), ['loadable of 3 files'])
+        self.assertEqual(len(plugin.examined), 2)
+
+    def test_leastRecentlyUsed(self):
+        cache, plugin = LoadableCache(maxEntries=2), CountingPlugin()
+        cache.examine(plugin, 'series1', ['a'])
+        cache.examine(plugin, 'series2', ['b'])
+        cache.examine(plugin, 'series1', ['a'])
+        cache.examine(plugin, 'series3', ['c'])
+        self.assertIsNotNone(cache.lookup('CountingPlugin', 'series1', ['a']))
+        self.assertIsNone(cache.lookup('CountingPlugin', 'series2', ['b']))
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        cache, plugin = LoadableCache(), CountingPlugin()
+        cache.examine(plugin, 'series1', ['a'])
+        cache.examine(plugin, 'series2', ['b'])
+        cache.invalidate('series1')
+        self.assertIsNone(cache.lookup('CountingPlugin', 'series1', ['a']))
+        self.assertIsNotNone(cache.lookup('CountingPlugin', 'series2', ['b']))
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+
+class ExaminingBrowser(StudyBrowser):
+    """A StudyBrowser that examines the series with a CountingPlugin."""
+
+    def __init__(self, db):
+        StudyBrowser.__init__(self, db, loadableCache=LoadableCache())
+        self.plugin = CountingPlugin()
+
+    def examineSeries(self, kind, seriesUID, files):
+        return self.loadableCache.examine(self.plugin, seriesUID, files)
+
+
+class LoadPlanStepsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        series, images = [], []
+        for number in range(3):
+            volumeUID, segmentationUID = '1.2.3.%d' % (number + 1), '1.2.3.%d' % (number + 11)
+            fileName = writeSegmentation(os.path.join(self.directory, '%s.dcm' % segmentationUID), segmentationUID, volumeUID,
+                                         {1: ('Tumor', np.ones((1, 2, 2), dtype=bool))})
+            series += [(volumeUID, '1.2.3', 'MR', 'T2 %d' % number, str(number)), (segmentationUID, '1.2.3', 'SEG', 'Tumor', '1%d' % number)]
+            images += [(volumeUID + '.1', os.path.join(self.directory, volumeUID + '.dcm'), volumeUID),
+                       (segmentationUID + '.1', fileName, segmentationUID)]
+        self.db = SQLiteDICOMDatabase(writeDatabase(os.path.join(self.directory, 'ctkDICOM.sql'), patients=[(1, 'Test^Patient', 'TEST')],
+                                                    studies=[('1.2.3', 1, '20200105', 'Brain')], series=series, images=images))
+        self.browser = ExaminingBrowser(self.db)
+        self.browser.buildIndex()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_yieldPerSeries(self):
+        token, plan = CancellationToken(), {}
+        steps = self.browser.loadPlanSteps('1.2.3', token, plan)
+        # past the matching: one step per examined series from here on
+        while not self.browser.plugin.examined:
+            next(steps)
+        self.assertEqual(len(self.browser.plugin.examined), 1)
+        next(steps)
+        self.assertEqual(len(self.browser.plugin.examined), 2)
+        token.cancel()
+        self.assertRaises(Cancelled, next, steps)
+        self.assertEqual(len(self.browser.plugin.examined), 2)
+        self.assertEqual(plan, {})
+
+    def test_plan(self):
+        plan = self.browser.loadPlan('1.2.3')
+        self.assertEqual(plan['masterVolumeSeriesUIDs'], ['1.2.3.1', '1.2.3.2', '1.2.3.3'])
+        self.assertEqual(len(self.browser.plugin.examined), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
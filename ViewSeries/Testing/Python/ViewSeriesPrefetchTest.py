@@ -0,0 +1,75 @@
+# ViewSeriesPrefetchTest.py
+#
+# Tests of the background study prefetcher (ViewSeriesLib/Prefetch.py). Its
+# timer ticks are run by hand, so the tests do not need Qt.
+################################################################################
+
+import os
+import sys
+import time
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+from ViewSeriesLib import DecodedImageCache, StudyPrefetcher
+
+
+class StudyPrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.busy = False
+        self.prefetcher = StudyPrefetcher(self.examineSteps, lambda: self.busy, images=DecodedImageCache())
+        self.stepSeconds = 0.0
+
+    def examineSteps(self, studyUID, token, plan):
+        # one series examined per step, as in StudyBrowser.loadPlanSteps
+        for series in range(3):
+            time.sleep(self.stepSeconds)
+            self.log.append('%s %d' % (studyUID, series))
+            yield
+            token.raiseIfCancelled()
+        plan.update(masterVolumeSeriesUIDs=[], masterVolumeLoadables=[])
+
+    def start(self, studyUIDs):
+        # what schedule() does, without the timer
+        self.prefetcher.queue = [lambda token, studyUID=studyUID: self.prefetcher._prefetchSteps(studyUID, token)
+                                 for studyUID in studyUIDs]
+
+    def test_timeSlice(self):
+        self.start(['study1', 'study2'])
+        # quick steps: a tick runs as many as fit in its time slice
+        self.prefetcher._tick()
+        self.assertEqual(self.log, ['study1 0', 'study1 1', 'study1 2', 'study2 0', 'study2 1', 'study2 2'])
+        self.assertFalse(self.prefetcher.isRunning())
+
+    def test_slowSteps(self):
+        self.start(['study1'])
+        self.stepSeconds = 2 * self.prefetcher.sliceMs / 1000.0
+        # a step longer than the time slice is the only one of its tick
+        self.prefetcher._tick()
+        self.assertEqual(self.log, ['study1 0'])
+        self.prefetcher._tick()
+        self.assertEqual(self.log, ['study1 0', 'study1 1'])
+
+    def test_foregroundBusy(self):
+        self.start(['study1'])
+        self.busy = True
+        self.prefetcher._tick()
+        self.assertEqual(self.log, [])
+        self.busy = False
+        self.stepSeconds = 2 * self.prefetcher.sliceMs / 1000.0
+        self.prefetcher._tick()
+        # stopped between two series
+        self.prefetcher.stop()
+        self.prefetcher._tick()
+        self.assertEqual(self.log, ['study1 0'])
+        self.assertFalse(self.prefetcher.isRunning())
+
+
+if __name__ == '__main__':
+    unittest.main()
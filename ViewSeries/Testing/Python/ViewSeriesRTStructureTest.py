@@ -0,0 +1,193 @@
+# ViewSeriesRTStructureTest.py
+#
+# Tests of the RTSTRUCT rasterization (ViewSeriesLib/RTStructure.py) against
+# a point-in-polygon test of each pixel centre.
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib import RTStructure
+from ViewSeriesLib.RTStructure import decodeRTStructure, imageSeriesGeometry, rasterizeContours
+from ViewSeriesTestData import slicePosition, writeImageSeries, writeStructureSet
+
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+
+def _lpsToIJK(origin, spacing, direction):
+    ijkToLPS = np.eye(4)
+    ijkToLPS[:3, :3] = np.array(direction).reshape(3, 3) * np.array(spacing)
+    ijkToLPS[:3, 3] = origin
+    return np.linalg.inv(ijkToLPS)
+
+
+def _insidePolygon(x, y, polygon):
+    """Ray casting (even-odd) test of the points (x, y) against one polygon."""
+    inside = np.zeros(x.shape, dtype=bool)
+    for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossingX = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x > crossingX)
+    return inside
+
+
+def _referenceMasks(contours, shape, origin, spacing, direction):
+    """{(ROI number, slice): bool (rows, columns) mask}, one contour at a time:
+    each contour goes to the slice nearest to its mean k, and toggles the
+    pixels whose centre it contains.
+    """
+    slices, rows, columns = shape
+    lpsToIJK = _lpsToIJK(origin, spacing, direction)
+    j, i = np.mgrid[0:rows, 0:columns].astype(np.float64)
+    masks = {}
+    for number, points in contours:
+        ijk = lpsToIJK[:3, :3].dot(np.asarray(points, dtype=np.float64).T) + lpsToIJK[:3, 3:4]
+        k = int(np.rint(ijk[2].mean()))
+        if not 0 <= k < slices:
+            continue
+        mask = masks.setdefault((number, k), np.zeros((rows, columns), dtype=bool))
+        mask ^= _insidePolygon(i, j, ijk[:2].T)
+    return dict((key, mask) for key, mask in masks.items() if mask.any())
+
+
+def _rasterizedMasks(contours, shape, origin, spacing, direction):
+    frames, frameSegments, frameSlices = rasterizeContours(contours, shape, origin, spacing, direction)
+    rows, columns = shape[1:]
+    return dict(((int(number), int(k)), np.unpackbits(frame)[:rows * columns].reshape(rows, columns).astype(bool))
+                for frame, number, k in zip(frames, frameSegments, frameSlices))
+
+
+def _polygon(center, radius, count, z, random):
+    """A star shaped polygon (often concave) around center, in the plane z."""
+    angles = np.sort(random.uniform(0, 2 * np.pi, count))
+    radii = radius * random.uniform(0.3, 1.0, count)
+    return np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles), np.full(count, z)], axis=1)
+
+
+class RasterizeContoursTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shape = (5, 24, 31)
+        self.chunkBytes = RTStructure.CHUNK_BYTES
+
+    def tearDown(self):
+        RTStructure.CHUNK_BYTES = self.chunkBytes
+
+    def assertMatchesReference(self, contours, origin=(0.0, 0.0, 0.0), spacing=(1.0, 1.0, 1.0), direction=IDENTITY):
+        masks = _rasterizedMasks(contours, self.shape, origin, spacing, direction)
+        expected = _referenceMasks(contours, self.shape, origin, spacing, direction)
+        self.assertEqual(sorted(masks), sorted(expected))
+        for key in expected:
+            np.testing.assert_array_equal(masks[key], expected[key], 'frame %s' % (key,))
+        return masks
+
+    def test_evenOdd(self):
+        outer = [(2.3, 2.4, 1.0), (20.6, 2.1, 1.0), (20.2, 18.7, 1.0), (2.5, 18.2, 1.0)]
+        hole = [(6.4, 6.3, 1.0), (12.7, 6.6, 1.0), (12.2, 12.4, 1.0), (6.6, 12.9, 1.0)]
+        island = [(8.1, 8.2, 1.0), (10.3, 8.4, 1.0), (9.2, 10.6, 1.0)]
+        masks = self.assertMatchesReference([(1, outer), (1, hole), (1, island)])
+        mask = masks[(1, 1)]
+        self.assertTrue(mask[4, 4])
+        self.assertFalse(mask[7, 7])
+        self.assertTrue(mask[9, 9])
+        # a contour of another ROI over the hole is not a hole of it
+        masks = self.assertMatchesReference([(1, outer), (1, hole), (2, hole)])
+        self.assertTrue(masks[(2, 1)][7, 7])
+
+    def test_randomPolygons(self):
+        random = np.random.RandomState(3)
+        contours = []
+        for number in (1, 2, 5):
+            for k in range(self.shape[0]):
+                for count in range(random.randint(0, 3)):
+                    contours.append((number, _polygon(random.uniform(0, 31, 2), random.uniform(2, 14), random.randint(3, 12), k, random)))
+        self.assertMatchesReference(contours)
+        # a few frames per chunk
+        RTStructure.CHUNK_BYTES = 3 * self.shape[1] * (self.shape[2] + 1)
+        self.assertMatchesReference(contours)
+
+    def test_offGrid(self):
+        random = np.random.RandomState(5)
+        contours = [
+            # partly outside the rows and columns
+            (1, _polygon((-2.0, 10.0), 9.0, 9, 2.0, random)),
+            (1, _polygon((28.0, 22.0), 8.0, 9, 2.0, random)),
+            # between two slices: the nearest one
+            (2, _polygon((12.0, 12.0), 6.0, 7, 2.7, random)),
+            (2, _polygon((12.0, 12.0), 6.0, 7, 0.4, random)),
+            # before the first and after the last slice: dropped
+            (3, _polygon((12.0, 12.0), 6.0, 7, -0.6, random)),
+            (3, _polygon((12.0, 12.0), 6.0, 7, 4.6, random)),
+            # entirely outside the slice
+            (4, _polygon((60.0, 12.0), 6.0, 7, 1.0, random)),
+        ]
+        masks = self.assertMatchesReference(contours)
+        self.assertEqual(sorted(masks), [(1, 2), (2, 0), (2, 3)])
+
+    def test_geometry(self):
+        random = np.random.RandomState(11)
+        origin, spacing = (-40.0, 25.0, -12.5), (0.8, 0.6, 2.5)
+        # rotated by 30 degrees about the slice normal
+        c, s = np.cos(np.pi / 6), np.sin(np.pi / 6)
+        direction = (c, -s, 0.0, s, c, 0.0, 0.0, 0.0, 1.0)
+        ijkToLPS = np.linalg.inv(_lpsToIJK(origin, spacing, direction))
+        contours = []
+        for number in (1, 2):
+            for k in range(self.shape[0]):
+                polygon = _polygon(random.uniform(0, 31, 2), random.uniform(3, 12), random.randint(3, 10), k, random)
+                contours.append((number, ijkToLPS[:3, :3].dot(polygon.T).T + ijkToLPS[:3, 3]))
+        self.assertMatchesReference(contours, origin, spacing, direction)
+
+    def test_empty(self):
+        frames, frameSegments, frameSlices = rasterizeContours([], self.shape, (0, 0, 0), (1, 1, 1), IDENTITY)
+        self.assertEqual(frames.shape, (0, (24 * 31 + 7) // 8))
+        # a degenerate contour has no pixels
+        frames, frameSegments, frameSlices = rasterizeContours([(1, np.array([(1.0, 1.0, 0.0), (5.0, 1.0, 0.0), (9.0, 1.0, 0.0)]))],
+                                                               self.shape, (0, 0, 0), (1, 1, 1), IDENTITY)
+        self.assertEqual(len(frames), 0)
+
+
+class DecodeRTStructureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_sourceGrid(self):
+        origin, spacing = (-10.0, 20.0, 5.0), (0.5, 0.75, 2.5)
+        voxels = np.zeros((4, 12, 10), dtype=np.int16)
+        # files in a scrambled slice order
+        files = writeImageSeries(os.path.join(self.directory, 'mr'), '1.2.3.1', voxels, origin, spacing, order=[2, 0, 3, 1])
+        geometry = imageSeriesGeometry(files)
+        self.assertEqual(geometry[0], (4, 12, 10))
+        np.testing.assert_allclose(geometry[1], origin)
+        np.testing.assert_allclose(geometry[2], spacing)
+
+        z = slicePosition(origin, spacing, (1.0, 0.0, 0.0, 0.0, 1.0, 0.0), 2)[2]
+        square = [(-9.1, 21.6, z), (-7.4, 21.6, z), (-7.4, 25.4, z), (-9.1, 25.4, z)]
+        fileName = writeStructureSet(os.path.join(self.directory, 'rt.dcm'), '1.2.3.8', '1.2.3.1', {7: ('GTV', [square])})
+        segmentationArray = decodeRTStructure([fileName], geometry, '1.2.3.1')
+        self.assertEqual(segmentationArray.segments[0]['label'], 'GTV')
+        self.assertEqual(segmentationArray.referencedSeriesUID, '1.2.3.1')
+        expected = np.zeros((4, 12, 10), dtype=np.uint8)
+        # columns i with -10 + 0.5 i in (-9.1, -7.4), rows j with 20 + 0.75 j in (21.6, 25.4)
+        expected[2, 3:8, 2:6] = 1
+        np.testing.assert_array_equal(segmentationArray.labelmap(7), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
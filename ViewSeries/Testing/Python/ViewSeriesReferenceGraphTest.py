@@ -0,0 +1,80 @@
+# ViewSeriesReferenceGraphTest.py
+#
+# Tests of the referenced series graph (ViewSeriesLib/ReferenceGraph.py).
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib import ReferenceGraph, readReferencedSeries
+from ViewSeriesTestData import writeSegmentation, writeStructureSet
+
+
+class ReferenceGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        masks = {1: ('Tumor', np.ones((1, 2, 2), dtype=bool))}
+        self.segmentationFile = writeSegmentation(os.path.join(self.directory, 'seg.dcm'), '1.2.3.9', '1.2.3.1', masks)
+        self.structureSetFile = writeStructureSet(os.path.join(self.directory, 'rt.dcm'), '1.2.3.8', '1.2.3.2',
+                                                  {1: ('GTV', [[(0, 0, 0), (1, 0, 0), (1, 1, 0)]])})
+        self.path = os.path.join(self.directory, 'cache', 'references.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_readReferencedSeries(self):
+        self.assertEqual(readReferencedSeries(self.segmentationFile), ['1.2.3.1'])
+        self.assertEqual(readReferencedSeries(self.structureSetFile), ['1.2.3.2'])
+
+    def test_matchSource(self):
+        graph = ReferenceGraph()
+        match = graph.matchSource('1.2.3.9', self.segmentationFile, lambda seriesUID: seriesUID == '1.2.3.1')
+        self.assertFalse(match.isMissing)
+        self.assertEqual(match.sourceSeriesUID, '1.2.3.1')
+        match = graph.matchSource('1.2.3.8', self.structureSetFile, lambda seriesUID: False)
+        self.assertTrue(match.isMissing)
+        self.assertEqual(match.referencedSeriesUIDs, ['1.2.3.2'])
+        self.assertEqual(graph.referencingSeries('1.2.3.1'), {'1.2.3.9'})
+        # each header is read once
+        self.assertEqual(graph.headerReads, 2)
+
+    def test_preferred(self):
+        graph = ReferenceGraph()
+        # without a file name the references in the graph are used as they are
+        graph._set('1.2.3.9', 'fingerprint', ['other.study', '1.2.3.1'])
+        match = graph.matchSource('1.2.3.9', '', lambda seriesUID: True, preferred={'1.2.3.1'})
+        self.assertEqual(match.sourceSeriesUID, '1.2.3.1')
+        match = graph.matchSource('1.2.3.9', '', lambda seriesUID: True)
+        self.assertEqual(match.sourceSeriesUID, 'other.study')
+
+    def test_saved(self):
+        graph = ReferenceGraph(self.path)
+        graph.references('1.2.3.9', self.segmentationFile)
+        graph.save()
+        graph = ReferenceGraph(self.path)
+        self.assertIn('1.2.3.9', graph)
+        self.assertEqual(graph.references('1.2.3.9', self.segmentationFile), ['1.2.3.1'])
+        self.assertEqual(graph.headerReads, 0)
+        # a changed file is read again
+        writeSegmentation(self.segmentationFile, '1.2.3.9', '1.2.3.5', {1: ('Tumor', np.ones((1, 2, 2), dtype=bool))})
+        stat = os.stat(self.segmentationFile)
+        os.utime(self.segmentationFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertEqual(graph.references('1.2.3.9', self.segmentationFile), ['1.2.3.5'])
+        self.assertEqual(graph.referencingSeries('1.2.3.1'), set())
+        self.assertEqual(graph.headerReads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# ViewSeriesSearchIndexTest.py
+#
+# Tests of the patient search index (ViewSeriesLib/SearchIndex.py) and of
+# the hierarchy index it follows (ViewSeriesLib/SeriesIndex.py), on a small
+# database read with ViewSeriesLib.SQLiteDatabase.
+################################################################################
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+from ViewSeriesLib import DICOMHierarchyIndex, PatientSearchIndex, SortedIndex, SQLiteDICOMDatabase
+from ViewSeriesTestData import writeDatabase
+
+
+class SortedIndexTest(unittest.TestCase):
+
+    def test_prefixAndRange(self):
+        index = SortedIndex([('20200101', 'a'), ('20210615', 'b'), ('20211231', 'c')])
+        self.assertEqual(index.prefix('2021'), ['b', 'c'])
+        self.assertEqual(index.range('20200601', '20210615'), ['b'])
+        self.assertEqual(index.range(high='20210101'), ['a'])
+        self.assertEqual(index.range(low='20211231'), ['c'])
+        index.remove('20210615', 'b')
+        index.add('20210101', 'd')
+        self.assertEqual(index.prefix('2021'), ['d', 'c'])
+
+
+class PatientSearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = writeDatabase(
+            os.path.join(self.directory, 'ctkDICOM.sql'),
+            patients=[(1, 'Smith^Anna', 'ID001'), (2, 'Jones^Ben', 'ID002'), (3, 'Goldsmith^Chen', 'XY003')],
+            studies=[('s1', 1, '20200105', 'Brain'), ('s2', 2, '20210610', 'Prostate'), ('s3', 3, '20221120', 'Lung')],
+            series=[('s1.1', 's1', 'MR', 'T2 AX', '1'), ('s1.2', 's1', 'SEG', 'Tumor', '2'),
+                    ('s2.1', 's2', 'MR', 'DWI', '1'), ('s3.1', 's3', 'CT', 'Chest', '1'), ('s3.2', 's3', 'RTSTRUCT', 'GTV', '2')])
+        self.db = SQLiteDICOMDatabase(self.path)
+        self.index = DICOMHierarchyIndex(self.db)
+        self.index.build()
+        self.search = PatientSearchIndex(self.index)
+        self.search.build()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_text(self):
+        # too short for a substring match: only word prefixes
+        self.assertEqual(self.search.search('sm').patientUIDs, {'1'})
+        # a substring that does not start a word
+        self.assertEqual(self.search.search('smith').patientUIDs, {'1', '3'})
+        self.assertEqual(self.search.search('id00').patientUIDs, {'1', '2'})
+        self.assertEqual(self.search.search('anna smith').patientUIDs, {'1'})
+        self.assertEqual(self.search.search('nobody').patientUIDs, set())
+        self.assertIsNone(self.search.search('').patientUIDs)
+
+    def test_filters(self):
+        self.assertEqual(self.search.search(modality='MR').studyUIDs, {'s1', 's2'})
+        self.assertEqual(self.search.search(dateFrom='20210101').studyUIDs, {'s2', 's3'})
+        self.assertEqual(self.search.search(dateFrom='20200101', dateTo='20211231').patientUIDs, {'1', '2'})
+        self.assertEqual(self.search.search(seriesDescription='t2').studyUIDs, {'s1'})
+        # SEG and RTSTRUCT series
+        self.assertEqual(self.search.search(hasSegmentation=True).studyUIDs, {'s1', 's3'})
+        self.assertEqual(self.search.search(modality='CT', hasSegmentation=True).patientUIDs, {'3'})
+        self.assertEqual(self.search.search('id', modality='MR', dateFrom='20210101').patientUIDs, {'2'})
+        self.assertEqual(self.search.modalityNames(), ['CT', 'MR', 'RTSTRUCT', 'SEG'])
+
+    def test_followsDatabaseChanges(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("UPDATE Patients SET PatientsName = 'Brown^Ben' WHERE UID = 2")
+        connection.execute("INSERT INTO Patients VALUES (4, 'Doe^Dara', 'ID004')")
+        connection.execute("INSERT INTO Studies VALUES ('s4', 4, '20230101', 'Knee')")
+        connection.execute("DELETE FROM Patients WHERE UID = 3")
+        connection.commit()
+        connection.close()
+        self.index.databaseChanged()
+        self.assertEqual(self.search.search('doe').patientUIDs, {'4'})
+        self.assertEqual(self.search.search('smith').patientUIDs, {'1'})
+        # kept patients are re-read when they are listed
+        self.assertEqual([patient.name for patient in self.index.patients()], ['Smith^Anna', 'Brown^Ben', 'Doe^Dara'])
+        self.assertEqual(self.search.search('brown').patientUIDs, {'2'})
+        self.assertEqual(self.search.search('jones').patientUIDs, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# ViewSeriesSegmentStatisticsTest.py
+#
+# Tests of the vectorized segment statistics (ViewSeriesLib/SegmentStatistics.py)
+# against a plain loop over the segments and their voxels.
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib import SegmentationArray, SegmentStatisticsCache, VolumeArray, readSegmentStatistics, segmentStatistics
+from ViewSeriesLib import SegmentStatistics
+
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+
+def _segmentationArray(frames, segments, shape, origin=(0.0, 0.0, 0.0), spacing=(1.0, 1.0, 1.0), direction=IDENTITY):
+    """SegmentationArray of frames [(segment number, slice, bool (rows, columns) mask)]."""
+    packed = np.array([np.packbits(mask.ravel()) for number, k, mask in frames], dtype=np.uint8)
+    return SegmentationArray(packed, np.array([number for number, k, mask in frames], dtype=np.int32),
+                             np.array([k for number, k, mask in frames], dtype=np.int32), shape, origin, spacing, direction,
+                             [{'number': number, 'label': label, 'color': [1.0, 0.0, 0.0]} for number, label in segments])
+
+
+def _referenceStatistics(segmentationArray, volumeArray):
+    """One segment at a time: its labelmap, and the nearest volume voxel of
+    each of its voxels.
+    """
+    def ijkToLPS(origin, spacing, direction):
+        matrix = np.eye(4)
+        matrix[:3, :3] = np.array(direction).reshape(3, 3) * np.array(spacing)
+        matrix[:3, 3] = origin
+        return matrix
+    segmentationToVolume = np.linalg.inv(ijkToLPS(volumeArray.origin, volumeArray.spacing, volumeArray.direction)).dot(
+        ijkToLPS(segmentationArray.origin, segmentationArray.spacing, segmentationArray.direction))
+    voxels = np.asarray(volumeArray.voxels)
+    statistics = []
+    for segment in segmentationArray.segments:
+        labelmap = segmentationArray.labelmap(segment['number'])
+        values = []
+        for k, j, i in zip(*np.nonzero(labelmap)):
+            vi, vj, vk = [int(round(v)) for v in segmentationToVolume.dot([i, j, k, 1.0])[:3]]
+            if 0 <= vk < voxels.shape[0] and 0 <= vj < voxels.shape[1] and 0 <= vi < voxels.shape[2]:
+                values.append(float(voxels[vk, vj, vi]))
+        count = int(labelmap.sum())
+        statistics.append({'number': segment['number'], 'label': segment['label'], 'voxels': count,
+                           'volumeMl': count * float(np.prod(segmentationArray.spacing)) / 1000.0,
+                           'mean': float(np.mean(values)) if values else None,
+                           'min': float(min(values)) if values else None,
+                           'max': float(max(values)) if values else None})
+    return statistics
+
+
+class SegmentStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(7)
+        self.shape = (4, 5, 7)
+        self.volumeArray = VolumeArray(random.randint(-100, 1000, self.shape).astype(np.int16), (0.0, 0.0, 0.0), (1.0, 1.0, 1.0), IDENTITY)
+        tumor = random.rand(*self.shape) > 0.6
+        edema = random.rand(*self.shape) > 0.3
+        self.frames = [(1, k, tumor[k]) for k in range(4)]
+        self.frames += [(3, k, edema[k]) for k in (0, 2)]
+        # a second frame of the same segment and slice, overlapping the first
+        self.frames.append((3, 2, tumor[2]))
+        # segment 4 has only an empty frame, segment 2 none at all
+        self.frames.append((4, 1, np.zeros(self.shape[1:], dtype=bool)))
+        # frames of a segment number that is not in the segment list
+        self.frames.append((9, 3, np.ones(self.shape[1:], dtype=bool)))
+        self.segments = [(1, 'Tumor'), (2, 'Empty'), (3, 'Edema'), (4, 'Blank')]
+        self.chunkBytes = SegmentStatistics.CHUNK_BYTES
+
+    def tearDown(self):
+        SegmentStatistics.CHUNK_BYTES = self.chunkBytes
+
+    def assertStatisticsEqual(self, statistics, expected):
+        self.assertEqual([entry['number'] for entry in statistics], [entry['number'] for entry in expected])
+        for entry, expectedEntry in zip(statistics, expected):
+            self.assertEqual(entry['label'], expectedEntry['label'])
+            self.assertEqual(entry['voxels'], expectedEntry['voxels'])
+            self.assertAlmostEqual(entry['volumeMl'], expectedEntry['volumeMl'])
+            for name in ('mean', 'min', 'max'):
+                if expectedEntry[name] is None:
+                    self.assertIsNone(entry[name], '%s of segment %d' % (name, entry['number']))
+                else:
+                    self.assertAlmostEqual(entry[name], expectedEntry[name], places=6)
+
+    def test_sameGrid(self):
+        segmentationArray = _segmentationArray(self.frames, self.segments, self.shape)
+        statistics = segmentStatistics(segmentationArray, self.volumeArray)
+        self.assertStatisticsEqual(statistics, _referenceStatistics(segmentationArray, self.volumeArray))
+        byNumber = dict((entry['number'], entry) for entry in statistics)
+        self.assertEqual((byNumber[2]['voxels'], byNumber[2]['mean']), (0, None))
+        self.assertEqual((byNumber[4]['voxels'], byNumber[4]['mean']), (0, None))
+        self.assertNotIn(9, byNumber)
+
+    def test_chunks(self):
+        # a few frames per chunk: runs of a segment are split across chunks
+        SegmentStatistics.CHUNK_BYTES = 2 * self.shape[1] * self.shape[2]
+        segmentationArray = _segmentationArray(self.frames, self.segments, self.shape)
+        self.assertStatisticsEqual(segmentStatistics(segmentationArray, self.volumeArray),
+                                   _referenceStatistics(segmentationArray, self.volumeArray))
+
+    def test_otherGrid(self):
+        # half the voxel size, shifted: some segment voxels are outside the volume
+        segmentationArray = _segmentationArray(self.frames, self.segments, self.shape, origin=(2.2, -0.8, 1.0),
+                                               spacing=(0.5, 0.5, 1.0))
+        self.assertStatisticsEqual(segmentStatistics(segmentationArray, self.volumeArray),
+                                   _referenceStatistics(segmentationArray, self.volumeArray))
+        # rotated by 90 degrees about the slice axis
+        segmentationArray = _segmentationArray(self.frames, self.segments, self.shape, origin=(4.0, 0.0, 0.0),
+                                               direction=(0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+        self.assertStatisticsEqual(segmentStatistics(segmentationArray, self.volumeArray),
+                                   _referenceStatistics(segmentationArray, self.volumeArray))
+
+    def test_outsideVolume(self):
+        segmentationArray = _segmentationArray(self.frames, self.segments, self.shape, origin=(0.0, 0.0, 100.0))
+        statistics = segmentStatistics(segmentationArray, self.volumeArray)
+        self.assertStatisticsEqual(statistics, _referenceStatistics(segmentationArray, self.volumeArray))
+        # counted, but without intensities
+        self.assertGreater(statistics[0]['voxels'], 0)
+        self.assertIsNone(statistics[0]['mean'])
+
+    def test_noSegments(self):
+        segmentationArray = _segmentationArray(self.frames, [], self.shape)
+        self.assertEqual(segmentStatistics(segmentationArray, self.volumeArray), [])
+
+    def test_cached(self):
+        directory = tempfile.mkdtemp()
+        try:
+            files = [os.path.join(directory, name) for name in ('seg.dcm', 'image.dcm')]
+            for fileName in files:
+                open(fileName, 'w').close()
+            segmentationArray = _segmentationArray(self.frames, self.segments, self.shape)
+            cache = SegmentStatisticsCache(os.path.join(directory, 'statistics'))
+            statistics = readSegmentStatistics('1.2.3.9', files[:1], '1.2.3.1', files[1:], cache,
+                                               segmentationArray=segmentationArray, volumeArray=self.volumeArray)
+            # read back from the .json file, without the arrays
+            cached = readSegmentStatistics('1.2.3.9', files[:1], '1.2.3.1', files[1:],
+                                           SegmentStatisticsCache(os.path.join(directory, 'statistics')))
+            self.assertEqual(cached, statistics)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# ViewSeriesSegmentationCacheTest.py
+#
+# Tests of the SEG decoding and the bit-packed segmentation cache
+# (ViewSeriesLib/SegmentationCache.py).
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib.SegmentationCache import SegmentationArray, SegmentationCache, decodeSegmentation, readSegmentation
+from ViewSeriesTestData import writeSegmentation
+
+
+def _masks():
+    # 3 slices of 5 x 7 pixels: rows * columns is not a multiple of 8
+    tumor = np.zeros((3, 5, 7), dtype=bool)
+    tumor[0, 1:3, 2:5] = True
+    tumor[2, 4, 6] = True
+    edema = np.zeros((3, 5, 7), dtype=bool)
+    edema[1] = True
+    return {1: ('Tumor', tumor), 3: ('Edema', edema)}
+
+
+class SegmentationDecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.origin, self.spacing = (-10.0, 20.0, 5.0), (0.5, 0.75, 2.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def decode(self, **kwargs):
+        fileName = writeSegmentation(os.path.join(self.directory, 'seg.dcm'), '1.2.3.9', '1.2.3.1', _masks(),
+                                     origin=self.origin, spacing=self.spacing, **kwargs)
+        return decodeSegmentation([fileName])
+
+    def assertMatchesMasks(self, segmentationArray):
+        self.assertEqual(segmentationArray.shape, (3, 5, 7))
+        for number, (label, mask) in _masks().items():
+            np.testing.assert_array_equal(segmentationArray.labelmap(number), mask.astype(np.uint8))
+
+    def test_binary(self):
+        segmentationArray = self.decode()
+        self.assertMatchesMasks(segmentationArray)
+        # empty frames are not kept: 2 tumor slices and 1 edema slice
+        self.assertEqual(len(segmentationArray.frames), 3)
+        self.assertEqual([segment['number'] for segment in segmentationArray.segments], [1, 3])
+        self.assertEqual([segment['label'] for segment in segmentationArray.segments], ['Tumor', 'Edema'])
+        self.assertEqual(segmentationArray.referencedSeriesUID, '1.2.3.1')
+        np.testing.assert_allclose(segmentationArray.origin, self.origin)
+        np.testing.assert_allclose(segmentationArray.spacing, self.spacing)
+
+    def test_unevenSlices(self):
+        # one segment on slices 0, 2 and 5 of 6: the empty frames keep the grid
+        tumor = np.zeros((6, 4, 4), dtype=bool)
+        tumor[[0, 2, 5], 1, 1] = True
+        fileName = writeSegmentation(os.path.join(self.directory, 'seg.dcm'), '1.2.3.9', '1.2.3.1', {1: ('Tumor', tumor)},
+                                     origin=self.origin, spacing=(1.0, 1.0, 1.0))
+        segmentationArray = decodeSegmentation([fileName])
+        self.assertEqual(segmentationArray.shape, (6, 4, 4))
+        np.testing.assert_allclose(segmentationArray.spacing, [1.0, 1.0, 1.0])
+        self.assertEqual(sorted(segmentationArray.frameSlices), [0, 2, 5])
+        np.testing.assert_array_equal(segmentationArray.labelmap(1), tumor.astype(np.uint8))
+
+    def test_segmentsOfSeveralFiles(self):
+        fileName = writeSegmentation(os.path.join(self.directory, 'seg.dcm'), '1.2.3.9', '1.2.3.1', _masks())
+        segmentationArray = decodeSegmentation([fileName, fileName])
+        self.assertEqual([segment['number'] for segment in segmentationArray.segments], [1, 3])
+
+    def test_fractional(self):
+        self.assertMatchesMasks(self.decode(fractional=True))
+
+    def test_subsampled(self):
+        segmentationArray = self.decode().subsampled(sliceStep=2, shrink=2)
+        self.assertEqual(segmentationArray.shape, (2, 3, 4))
+        np.testing.assert_array_equal(segmentationArray.labelmap(1), _masks()[1][1][::2, ::2, ::2].astype(np.uint8))
+        np.testing.assert_allclose(segmentationArray.spacing, [1.0, 1.5, 5.0])
+
+
+class SegmentationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = [writeSegmentation(os.path.join(self.directory, 'seg.dcm'), '1.2.3.9', '1.2.3.1', _masks())]
+        self.cache = SegmentationCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_roundTrip(self):
+        decoded = readSegmentation('1.2.3.9', self.files, self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        cached = readSegmentation('1.2.3.9', self.files, self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        np.testing.assert_array_equal(cached.frames, decoded.frames)
+        np.testing.assert_array_equal(cached.frameSegments, decoded.frameSegments)
+        np.testing.assert_array_equal(cached.frameSlices, decoded.frameSlices)
+        self.assertEqual(cached.shape, decoded.shape)
+        self.assertEqual(cached.segments, decoded.segments)
+        self.assertEqual(cached.referencedSeriesUID, decoded.referencedSeriesUID)
+        for number in (1, 3):
+            np.testing.assert_array_equal(cached.labelmap(number), decoded.labelmap(number))
+
+    def test_changedFilesMiss(self):
+        readSegmentation('1.2.3.9', self.files, self.cache)
+        stat = os.stat(self.files[0])
+        os.utime(self.files[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertIsNone(self.cache.get('1.2.3.9', self.files))
+        self.assertIsNone(self.cache.get('1.2.3.10', self.files))
+
+    def test_evict(self):
+        empty = SegmentationArray(np.zeros((0, 5), dtype=np.uint8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                                  (1, 5, 8), (0, 0, 0), (1, 1, 1), (1, 0, 0, 0, 1, 0, 0, 0, 1), [])
+        self.cache.put('1.2.3.9', self.files, empty)
+        self.cache.maxBytes = self.cache.totalBytes
+        self.cache.put('1.2.3.10', self.files, empty)
+        self.assertEqual(len(self.cache.entries()), 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# ViewSeriesStudyPipelineTest.py
+#
+# Tests of the cancellable study load pipeline (ViewSeriesLib/StudyPipeline.py).
+# The pipeline itself runs on a QTimer, so its tests need Slicer; its steps
+# are run by hand here instead of from the timer.
+################################################################################
+
+import os
+import sys
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+from ViewSeriesLib import CancellationToken, Cancelled, StudyLoadPipeline, timeSliced
+
+
+class CancellationTokenTest(unittest.TestCase):
+
+    def test_callbacks(self):
+        token = CancellationToken()
+        calls = []
+        token.onCancel(lambda: calls.append('first'))
+        token.onCancel(lambda: 1 / 0)  # logged, the others are still called
+        token.onCancel(lambda: calls.append('second'))
+        token.raiseIfCancelled()
+        token.cancel()
+        token.cancel()
+        self.assertEqual(calls, ['first', 'second'])
+        token.onCancel(lambda: calls.append('late'))
+        self.assertEqual(calls, ['first', 'second', 'late'])
+        self.assertRaises(Cancelled, token.raiseIfCancelled)
+
+
+class TimeSlicedTest(unittest.TestCase):
+
+    def test_slices(self):
+        # with no time per slice every step is yielded
+        self.assertEqual(list(timeSliced(iter(range(5)), sliceSeconds=0)), [0, 1, 2, 3, 4])
+        # with a long slice everything runs in the first one
+        self.assertEqual(list(timeSliced(iter(range(5)), sliceSeconds=60)), [])
+
+
+@unittest.skipUnless('slicer' in sys.modules, 'the pipeline runs on a QTimer')
+class StudyLoadPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pipeline = StudyLoadPipeline()
+        self.log = []
+
+    def tearDown(self):
+        self.pipeline.cancel()
+        if self.pipeline.timer is not None:
+            self.pipeline.timer.stop()
+
+    def steps(self, name, count):
+        def run(token):
+            token.onCancel(lambda: self.log.append(name + ' cancelled'))
+            for step in range(count):
+                self.log.append('%s %d' % (name, step))
+                yield
+        return run
+
+    def test_merge(self):
+        self.assertTrue(self.pipeline.submit('study1', self.steps('study1', 2)))
+        self.pipeline._step()
+        # the same study again is merged into the running load
+        self.assertFalse(self.pipeline.submit('study1', self.steps('again', 2)))
+        self.pipeline._step()
+        self.pipeline._step()
+        self.assertEqual(self.log, ['study1 0', 'study1 1'])
+        self.assertFalse(self.pipeline.isRunning())
+
+    def test_cancel(self):
+        self.pipeline.submit('study1', self.steps('study1', 3))
+        self.pipeline._step()
+        self.assertTrue(self.pipeline.submit('study2', self.steps('study2', 1)))
+        self.assertTrue(self.pipeline.isRunning('study2'))
+        self.pipeline._step()
+        self.assertEqual(self.log, ['study1 0', 'study1 cancelled', 'study2 0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# ViewSeriesTagFetchTest.py
+#
+# Tests of the batched tag retrieval (ViewSeriesLib/TagFetch.py), on the
+# SQLiteDICOMDatabase and on a database with only the per file and per tag
+# calls of ctkDICOMDatabase.
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+import numpy as np
+
+from ViewSeriesLib import SQLiteDICOMDatabase, TagFetch
+from ViewSeriesTestData import writeDatabase, writeImageSeries
+
+
+class CtkLikeDatabase(object):
+    """The tag calls of ctkDICOMDatabase, counted, on an sqlite file."""
+
+    def __init__(self, path):
+        self.databaseFilename = path
+        self.db = SQLiteDICOMDatabase(path)
+        self.calls = 0
+
+    def instanceForFile(self, fileName):
+        self.calls += 1
+        return self.db.instanceForFile(fileName)
+
+    def cachedTag(self, instanceUID, tag):
+        self.calls += 1
+        return self.db.cachedTag(instanceUID, tag)
+
+    def cacheTags(self, instanceUIDs, tags, values):
+        self.db.cacheTags(instanceUIDs, tags, values)
+
+
+class FetchTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = writeImageSeries(os.path.join(self.directory, 'mr'), '1.2.3.1', np.zeros((3, 2, 2), dtype=np.int16))
+        self.path = writeDatabase(
+            os.path.join(self.directory, 'ctkDICOM.sql'),
+            images=[('1.2.3.1.%d' % (number + 1), os.path.relpath(fileName, self.directory), '1.2.3.1')
+                    for number, fileName in enumerate(self.files)],
+            # a cached value, and a tag known not to be in the instance
+            tags=[('1.2.3.1.1', TagFetch.SERIES_DESCRIPTION, 'Cached'), ('1.2.3.1.2', TagFetch.SERIES_DESCRIPTION, TagFetch.TAG_NOT_IN_INSTANCE)])
+        self.requests = [(fileName, tag) for fileName in self.files for tag in (TagFetch.MODALITY, TagFetch.SERIES_DESCRIPTION)]
+
+    def tearDown(self):
+        for bulk in TagFetch._bulkDatabases.values():
+            bulk.close()
+        TagFetch._bulkDatabases.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def check(self, db):
+        values = TagFetch.fetchTags(db, self.requests + self.requests[:1])
+        self.assertEqual(len(values), 6)
+        self.assertEqual([values[(fileName, TagFetch.MODALITY)] for fileName in self.files], ['MR', 'MR', 'MR'])
+        self.assertEqual([values[(fileName, TagFetch.SERIES_DESCRIPTION)] for fileName in self.files], ['Cached', '', ''])
+        # the values read from the headers are in the tag cache now
+        self.assertEqual(TagFetch.fetchTags(db, self.requests), values)
+
+    def test_sqlite(self):
+        db = SQLiteDICOMDatabase(self.path)
+        self.check(db)
+        db.close()
+
+    def test_ctkDatabase(self):
+        db = CtkLikeDatabase(self.path)
+        self.check(db)
+        # the tag cache is read in batches from the database file
+        self.assertEqual(db.calls, 0)
+        db.db.close()
+
+    def test_unreadableDatabaseFile(self):
+        db = CtkLikeDatabase(self.path)
+        db.databaseFilename = os.path.join(self.directory, 'missing.sql')
+        self.check(db)
+        self.assertGreater(db.calls, 0)
+        db.db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
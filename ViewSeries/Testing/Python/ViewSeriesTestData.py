@@ -0,0 +1,193 @@
+# ViewSeriesTestData.py
+#
+# Small DICOM files and databases for the ViewSeriesLib tests.
+#
+# The files are written with pydicom and have the attributes ViewSeries and
+# the readers it uses (SimpleITK, pydicom) need, not complete IODs. The
+# geometry follows VolumeArray: voxels are (k, j, i) arrays, origin is the
+# LPS position of the first voxel, spacing is (i, j, k) and orientation is
+# the row and column directions of ImageOrientationPatient.
+################################################################################
+
+import os
+import sqlite3
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+SEGMENTATION_STORAGE = '1.2.840.10008.5.1.4.1.1.66.4'
+RT_STRUCTURE_SET_STORAGE = '1.2.840.10008.5.1.4.1.1.481.3'
+
+AXIAL = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+
+def _dataset(fileName, sopClassUID, sopInstanceUID, modality, seriesUID, studyUID):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sopClassUID
+    meta.MediaStorageSOPInstanceUID = sopInstanceUID
+    meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    dataset = FileDataset(fileName, {}, file_meta=meta, preamble=b'\0' * 128)
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+    dataset.SOPClassUID = sopClassUID
+    dataset.SOPInstanceUID = sopInstanceUID
+    dataset.Modality = modality
+    dataset.PatientName = 'Test^Patient'
+    dataset.PatientID = 'TEST'
+    dataset.StudyInstanceUID = studyUID
+    dataset.SeriesInstanceUID = seriesUID
+    dataset.FrameOfReferenceUID = studyUID + '.0'
+    return dataset
+
+
+def _normal(orientation):
+    row, column = orientation[:3], orientation[3:]
+    return (row[1] * column[2] - row[2] * column[1],
+            row[2] * column[0] - row[0] * column[2],
+            row[0] * column[1] - row[1] * column[0])
+
+
+def slicePosition(origin, spacing, orientation, k):
+    normal = _normal(orientation)
+    return [origin[axis] + k * spacing[2] * normal[axis] for axis in range(3)]
+
+
+def writeImageSeries(directory, seriesUID, voxels, origin=(0.0, 0.0, 0.0), spacing=(1.0, 1.0, 1.0), orientation=AXIAL,
+                     studyUID='1.2.3', order=None):
+    """Write an int16 (slices, rows, columns) array as single frame MR files,
+    one per slice, in the slice order given by order (default: k order).
+    Returns the file names, in that order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    slices, rows, columns = voxels.shape
+    files = []
+    for number, k in enumerate(order if order is not None else range(slices)):
+        fileName = os.path.join(directory, '%s.%d.dcm' % (seriesUID, number))
+        dataset = _dataset(fileName, MR_IMAGE_STORAGE, '%s.%d' % (seriesUID, number + 1), 'MR', seriesUID, studyUID)
+        dataset.InstanceNumber = number + 1
+        dataset.ImagePositionPatient = slicePosition(origin, spacing, orientation, k)
+        dataset.ImageOrientationPatient = list(orientation)
+        dataset.PixelSpacing = [spacing[1], spacing[0]]
+        dataset.SliceThickness = spacing[2]
+        dataset.Rows, dataset.Columns = rows, columns
+        dataset.SamplesPerPixel = 1
+        dataset.PhotometricInterpretation = 'MONOCHROME2'
+        dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 16, 15
+        dataset.PixelRepresentation = 1
+        dataset.PixelData = voxels[k].astype('<i2').tobytes()
+        pydicom.dcmwrite(fileName, dataset)
+        files.append(fileName)
+    return files
+
+
+def writeSegmentation(fileName, seriesUID, referencedSeriesUID, masks, origin=(0.0, 0.0, 0.0), spacing=(1.0, 1.0, 1.0),
+                      orientation=AXIAL, studyUID='1.2.3', fractional=False):
+    """Write a SEG with one frame per slice of each segment (empty frames
+    included); masks is {segmentNumber: (label, (slices, rows, columns) bool array)}.
+    """
+    import numpy as np
+    from pydicom.pixels import pack_bits
+    dataset = _dataset(fileName, SEGMENTATION_STORAGE, seriesUID + '.1', 'SEG', seriesUID, studyUID)
+    referencedSeries = Dataset()
+    referencedSeries.SeriesInstanceUID = referencedSeriesUID
+    dataset.ReferencedSeriesSequence = [referencedSeries]
+    planeOrientation = Dataset()
+    planeOrientation.ImageOrientationPatient = list(orientation)
+    pixelMeasures = Dataset()
+    pixelMeasures.PixelSpacing = [spacing[1], spacing[0]]
+    pixelMeasures.SliceThickness = spacing[2]
+    pixelMeasures.SpacingBetweenSlices = spacing[2]
+    shared = Dataset()
+    shared.PlaneOrientationSequence = [planeOrientation]
+    shared.PixelMeasuresSequence = [pixelMeasures]
+    dataset.SharedFunctionalGroupsSequence = [shared]
+
+    segments, perFrame, frames = [], [], []
+    for number, (label, mask) in sorted(masks.items()):
+        segment = Dataset()
+        segment.SegmentNumber = number
+        segment.SegmentLabel = label
+        segment.RecommendedDisplayCIELabValue = [32768, 32768, 32768]
+        segments.append(segment)
+        for k in range(mask.shape[0]):
+            identification = Dataset()
+            identification.ReferencedSegmentNumber = number
+            position = Dataset()
+            position.ImagePositionPatient = slicePosition(origin, spacing, orientation, k)
+            frameGroup = Dataset()
+            frameGroup.SegmentIdentificationSequence = [identification]
+            frameGroup.PlanePositionSequence = [position]
+            perFrame.append(frameGroup)
+            frames.append(mask[k])
+    dataset.SegmentSequence = segments
+    dataset.PerFrameFunctionalGroupsSequence = perFrame
+    frames = np.array(frames, dtype=bool)
+    dataset.NumberOfFrames = len(frames)
+    dataset.Rows, dataset.Columns = frames.shape[1:]
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.PixelRepresentation = 0
+    if fractional:
+        dataset.SegmentationType = 'FRACTIONAL'
+        dataset.MaximumFractionalValue = 255
+        dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 8, 8, 7
+        dataset.PixelData = (frames * 255).astype(np.uint8).tobytes()
+    else:
+        dataset.SegmentationType = 'BINARY'
+        dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 1, 1, 0
+        dataset.PixelData = pack_bits(frames.ravel())
+    pydicom.dcmwrite(fileName, dataset)
+    return fileName
+
+
+def writeStructureSet(fileName, seriesUID, referencedSeriesUID, rois, studyUID='1.2.3'):
+    """Write an RTSTRUCT; rois is {roiNumber: (name, [(n, 3) LPS points of a
+    closed planar contour])}.
+    """
+    dataset = _dataset(fileName, RT_STRUCTURE_SET_STORAGE, seriesUID + '.1', 'RTSTRUCT', seriesUID, studyUID)
+    referencedSeries = Dataset()
+    referencedSeries.SeriesInstanceUID = referencedSeriesUID
+    referencedStudy = Dataset()
+    referencedStudy.RTReferencedSeriesSequence = [referencedSeries]
+    frameOfReference = Dataset()
+    frameOfReference.FrameOfReferenceUID = studyUID + '.0'
+    frameOfReference.RTReferencedStudySequence = [referencedStudy]
+    dataset.ReferencedFrameOfReferenceSequence = [frameOfReference]
+    structureSetROIs, roiContours = [], []
+    for number, (name, contours) in sorted(rois.items()):
+        structureSetROI = Dataset()
+        structureSetROI.ROINumber = number
+        structureSetROI.ROIName = name
+        structureSetROIs.append(structureSetROI)
+        roiContour = Dataset()
+        roiContour.ReferencedROINumber = number
+        roiContour.ROIDisplayColor = [255, 0, 0]
+        roiContour.ContourSequence = []
+        for points in contours:
+            contour = Dataset()
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(points)
+            contour.ContourData = [float(value) for point in points for value in point]
+            roiContour.ContourSequence.append(contour)
+        roiContours.append(roiContour)
+    dataset.StructureSetROISequence = structureSetROIs
+    dataset.ROIContourSequence = roiContours
+    pydicom.dcmwrite(fileName, dataset)
+    return fileName
+
+
+def writeDatabase(path, patients=(), studies=(), series=(), images=(), tags=()):
+    """An sqlite file with the ctkDICOMDatabase tables of SQLiteDICOMDatabase,
+    filled with the given rows (tuples in the column order of its schema).
+    """
+    from ViewSeriesLib import SQLiteDICOMDatabase
+    connection = sqlite3.connect(path)
+    connection.executescript(SQLiteDICOMDatabase.schema)
+    for table, rows in (('Patients', patients), ('Studies', studies), ('Series', series), ('Images', images), ('TagCache', tags)):
+        for row in rows:
+            connection.execute('INSERT INTO %s VALUES (%s)' % (table, ','.join('?' * len(row))), row)
+    connection.commit()
+    connection.close()
+    return path
@@ -0,0 +1,94 @@
+# ViewSeriesViewSyncTest.py
+#
+# Tests of the linked navigation of the slot views (ViewSeriesLib/ViewSync.py).
+# The synchronizer works on slice nodes and their logics, so its tests need
+# Slicer; the views are slice logics of the scene, without widgets, and the
+# frames are applied by hand instead of from the timer.
+################################################################################
+
+import os
+import sys
+import unittest
+
+try:
+    import ViewSeriesLib
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    import ViewSeriesLib
+
+from ViewSeriesLib import ViewSynchronizer
+
+
+class SliceView(object):
+    """The parts of a slice widget the synchronizer uses, on a slice logic."""
+
+    def __init__(self, name):
+        import slicer
+        self.logic = slicer.vtkMRMLSliceLogic()
+        self.logic.SetMRMLScene(slicer.mrmlScene)
+        self.logic.AddSliceNode(name)
+        self.visible = False
+
+    def mrmlSliceNode(self):
+        return self.logic.GetSliceNode()
+
+    def mrmlSliceCompositeNode(self):
+        return self.logic.GetSliceCompositeNode()
+
+    def sliceLogic(self):
+        return self.logic
+
+
+@unittest.skipUnless('slicer' in sys.modules, 'the synchronizer works on slice nodes')
+class ViewSynchronizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.views = {'ViewSyncTest1': SliceView('ViewSyncTest1'), 'ViewSyncTest2': SliceView('ViewSyncTest2')}
+        self.views['ViewSyncTest1'].mrmlSliceCompositeNode().SetLinkedControl(False)
+        self.views['ViewSyncTest2'].mrmlSliceCompositeNode().SetLinkedControl(True)
+        self.synchronizer = ViewSynchronizer()
+
+    def tearDown(self):
+        import slicer
+        self.synchronizer.clear()
+        for view in self.views.values():
+            slicer.mrmlScene.RemoveNode(view.mrmlSliceCompositeNode())
+            slicer.mrmlScene.RemoveNode(view.mrmlSliceNode())
+
+    def linkedControls(self):
+        return [self.views[viewName].mrmlSliceCompositeNode().GetLinkedControl() for viewName in sorted(self.views)]
+
+    def test_linkedControlRestored(self):
+        self.synchronizer.setViews(self.views)
+        self.assertEqual(self.linkedControls(), [False, False])
+        # the view that is dropped gets its own linking back
+        self.synchronizer.setViews({'ViewSyncTest1': self.views['ViewSyncTest1']})
+        self.assertEqual(self.linkedControls(), [False, True])
+        self.synchronizer.setViews(self.views)
+        self.assertEqual(self.linkedControls(), [False, False])
+        self.synchronizer.setViews({})
+        self.assertEqual(self.linkedControls(), [False, True])
+        self.assertEqual(self.synchronizer.linkedControls, {})
+
+    def test_latestChangeApplied(self):
+        self.synchronizer.setViews(self.views)
+        source, other = self.views['ViewSyncTest1'], self.views['ViewSyncTest2']
+        # several changes before the frame: only the last one is applied
+        for offset in (1.0, 2.0, 3.0):
+            source.sliceLogic().SetSliceOffset(offset)
+        self.assertEqual(list(self.synchronizer.pending), ['offset'])
+        self.synchronizer._applyPending()
+        self.assertAlmostEqual(other.sliceLogic().GetSliceOffset(), 3.0)
+        self.assertEqual(self.synchronizer.frameTimeStats()['frames'], 1)
+        # changes made while paused are not propagated
+        with self.synchronizer.paused():
+            source.sliceLogic().SetSliceOffset(7.0)
+        self.assertEqual(self.synchronizer.pending, {})
+        # unlinked properties are not propagated
+        self.synchronizer.linked['offset'] = False
+        source.sliceLogic().SetSliceOffset(9.0)
+        self.assertEqual(self.synchronizer.pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,7 +25,6 @@
         # labelNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
 #
 # To do:
-#   Try with QListView instead of QListWidget?
 #   Had to install Quantitative Reporting and SlicerRT extensions manually - how to load extensions automatically?
 #
 # Deepa Krishnaswamy
@@ -34,21 +33,43 @@
 ################################################################################
 
 from slicer.util import VTKObservationMixin
-import numpy as np 
 
 import os, json, xml.dom.minidom, string, glob, re, math
 import vtk, qt, ctk, slicer
 import logging
-import CompareVolumes
-import SimpleITK as sitk
-import sitkUtils
+import time
 import datetime
 from slicer.ScriptedLoadableModule import *
 
-from DICOMLib import DICOMPlugin
+
+from ViewSeriesLib import loadableCache
+from ViewSeriesLib import LoadRequest, PairLoader
+from ViewSeriesLib import ViewNodeRegistry
+from ViewSeriesLib import StudyLoadPipeline, timeSliced
+from ViewSeriesLib import nodeResidency
+from ViewSeriesLib.NodeCache import DEFAULT_BUDGET_MB
+from ViewSeriesLib import StudyPrefetcher, decodedImages
+from ViewSeriesLib.Prefetch import DEFAULT_PREFETCH_MEMORY_MB
+from ViewSeriesLib import volumeCache
+from ViewSeriesLib.VolumeCache import DEFAULT_VOLUME_CACHE_MB
+from ViewSeriesLib import segmentationCache
+from ViewSeriesLib.SegmentationCache import DEFAULT_SEGMENTATION_CACHE_MB
+from ViewSeriesLib import SliceLayoutEngine
+from ViewSeriesLib import LazyRecordList, patientList, studyList
+from ViewSeriesLib.RecordLists import SORT_BY_NAME, SORT_BY_ID, SORT_BY_DATE
+from ViewSeriesLib import SearchResult
+from ViewSeriesLib import referenceGraph
+from ViewSeriesLib import StudyBrowser
+from ViewSeriesLib.StudyBrowser import VOLUME, SEGMENTATION, RTSTRUCTURE
+from ViewSeriesLib import instrumentation
+from ViewSeriesLib import ViewSynchronizer
+from ViewSeriesLib import segmentStatisticsCache
 
 ################################################################################
 
+# pairs shown at once, the others are on the next pages of views
+DEFAULT_VIEWS_PER_PAGE = 9
+
 #
 # ViewSeries
 #
@@ -90,6 +111,62 @@ class ViewSeries(ScriptedLoadableModule):
 # ViewSeriesWidget
 #
 
+class RecordListModel(qt.QAbstractListModel):
+  """List model of a LazyRecordList.
+     Only the rows the view has fetched exist in the model, and more rows
+     are fetched, one batch at a time, when the view is scrolled to the end.
+     The UID of a row is its Qt.UserRole data.
+  """
+
+  def __init__(self, parent=None):
+    qt.QAbstractListModel.__init__(self, parent)
+    self.records = LazyRecordList([], str)
+
+  def setRecords(self, records):
+    self.beginResetModel()
+    self.records = records
+    self.records.fetched = 0
+    self.endResetModel()
+
+  def sortBy(self, sortBy):
+    self.beginResetModel()
+    self.records.sort(sortBy)
+    self.records.fetched = 0
+    self.endResetModel()
+
+  def filter(self, visibleKeys):
+    self.beginResetModel()
+    self.records.filter(visibleKeys)
+    self.records.fetched = 0
+    self.endResetModel()
+
+  def rowCount(self, parent=None):
+    if parent is not None and parent.isValid():
+      return 0
+    return self.records.fetched
+
+  def data(self, index, role=qt.Qt.DisplayRole):
+    if not index.isValid() or index.row() >= self.records.fetched:
+      return None
+    key = self.records.key(index.row())
+    if role == qt.Qt.DisplayRole:
+      return self.records.text(key)
+    if role == qt.Qt.UserRole:
+      return key
+    return None
+
+  def canFetchMore(self, parent):
+    return not parent.isValid() and self.records.canFetchMore()
+
+  def fetchMore(self, parent):
+    first, last = self.records.nextBatch()
+    if parent.isValid() or last < first:
+      return
+    self.beginInsertRows(qt.QModelIndex(), first, last)
+    self.records.fetched = last + 1
+    self.endInsertRows()
+
+
 class ViewSeriesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   """Uses ScriptedLoadableModuleWidget base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
@@ -108,215 +185,549 @@ class ViewSeriesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.selectPatientName = ''
     self.selectStudyName = ''
     self.studyCollapsibleButton = None
-    self.studyListWidget = None
-    self.selectPatientNameIndex = None
-    self.selectStudyNameIndex = None
-    self.studyListWidgetNum = 0 # number of studies
+    self.studyListView = None
+    self.selectPatientUID = ''
+    self.selectStudyUID = ''
+    self.studyListNum = 0 # number of studies
     self.seriesListNum = 0 # number of series
-    self.patientNames = None
     self.db = slicer.dicomDatabase
-    self.patientList = None
+    self.index = None # patient -> study -> series index of self.db
+    self.loadableCache = loadableCache() # examineFiles results, kept for the session
+    self.studyPipeline = StudyLoadPipeline() # one cancellable study load at a time
+    self.prefetcher = StudyPrefetcher(self.examineStudySteps, self.isLoading, residency=nodeResidency(), volumeCache=volumeCache())
+    self.prefetchCount = 1 # number of studies to prefetch, 0 to disable
+    self.prefetchNextPage = True # decode the volumes of the next page of views in the background
+    self.sortBy = SORT_BY_NAME # order of the patient list
+    self.searchIndex = None # name/ID, date, modality and description search of self.index
+    self.searchResult = SearchResult() # what the lists are filtered to
+    self.startupPipeline = StudyLoadPipeline() # builds the indexes a time slice at a time
+    self.databaseChangedWhileIndexing = False
+    self.missingSourceNames = [] # SEGs and RTSTRUCTs of the current study without a source volume
 
-  def selectPatient(self, item):
+  def selectPatient(self, index):
 
       """This is called when the user selects a patient name from the list.
          The corresponding study names are listed when a patient is selected.
       """
 
-      print ('Patient ' + str(item.text()) + ' was clicked')
-      self.selectPatientName = item.text()
-
-      # Get the info from the slicer database
-      # We need to find where the self.selectPatientName appears in the list of the patientNames
-      patientList = list(self.db.patients())
-      patientNames = []
-      for patient in range(0,len(patientList)):
-          studyList = self.db.studiesForPatient(patientList[patient])
-          seriesList = self.db.seriesForStudy(studyList[0])
-          fileList = self.db.filesForSeries(seriesList[0])
-          patientNames.append(self.db.fileValue(fileList[0], "0010,0010"))
-      self.patientNames = patientNames
-
-      # Find which one it is in the list of patients
-      index = patientNames.index(self.selectPatientName)
-      patientNameClicked = patientNames[index]
-      self.selectPatientNameIndex = index
-
-      # Get the study names from the patient that was selected
-      studyList = self.db.studiesForPatient(patientList[index])
-      print ('studyList: ' + str(studyList)) # this is correct
-
-      # First remove the previous studies from the list
-      if not (self.studyListWidgetNum == 0): # if it's not equal to 0, remove items
-          num_items = self.studyListWidget.count
-          # get a list of the current items
-          items = []
-          for n in range(0,num_items):
-              items.append(self.studyListWidget.item(n))
-          # now remove these items from the list
-          for item in items:
-              self.studyListWidget.takeItem(self.studyListWidget.row(item))
-
-      # Add the new study items in
-      for study in studyList:
-          self.studyListWidget.addItem(study)
-      self.studyListWidgetNum = (self.studyListWidget).count
-      print ('self.studyListWidgetNum: ' + str(self.studyListWidgetNum)) # this is correct, is 2
-
-      # need to update the layout??
-
-      # Select the study and then get the series and update the viewer.
-      self.studyListWidget.itemClicked.connect(self.selectStudy)
-
-
-  def selectStudy(self, item):
-
-    """This is called when the user selects a study name from the list."""
-    
-    # do some cleanup first 
-    self.removeObservers() # is this right??
-
-    print ('Study ' + str(item.text()) + ' was clicked') # why is this printing out multiple times?
-    self.selectStudyName = item.text()
-
-    # Get the index of the study that was clicked
-    index = self.patientNames.index(self.selectPatientName)
-    studyNames = self.db.studiesForPatient(self.patientList[index])
-    # print ('studyNames: ' + str(studyNames))
-
-    index = studyNames.index(self.selectStudyName)
-    studyNameClicked = studyNames[index]
-    # Get the series names from the study that was selected
-    seriesList = self.db.seriesForStudy(studyNames[index])
-    print ('seriesList: ' + str(seriesList))
-    self.seriesListNum = len(seriesList)
-    print ('number of series: ' + str(self.seriesListNum))
-
-    ## Set up the plugins
-    # for the scalar volumes 
-    DICOMScalarVolumePlugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
-    # for the SEG label volumes 
-    DICOMSegmentationPlugin = slicer.modules.dicomPlugins['DICOMSegmentationPlugin']()
-    # for RTSTRUCT 
-    DicomRtImportExportPlugin = slicer.modules.dicomPlugins['DicomRtImportExportPlugin']()
-    
-    ### Get the series that have SEG files ###
-
-    self.segmentationNodesNum = 0
-    self.segmentationNodesIndex = [] 
-    self.volumeNodesNum = 0 
-    self.volumeNodesIndex = [] 
-    self.seriesDescription = [] 
-    self.referencedSeriesUID = [] 
-    
-    for n in range(0,self.seriesListNum):
-        
-        # Get the list of files 
-        fileList = self.db.filesForSeries(seriesList[n]) # should be n not 0 
-        print ('fileList: ' + str(fileList))
-        # Check the modality, want SEG 
-        modality = self.db.fileValue(fileList[0], "0008,0060")
-        print ('modality: ' + str(modality))
-        
-        # keep ones that have SEG - these are loaded 
-        if (modality=="SEG"):
-            loadables = DICOMSegmentationPlugin.examineFiles(fileList)
-            self.segmentationNodesNum += 1 
-            self.segmentationNodesIndex.append(n)
-            self.referencedSeriesUID.append(loadables[0].referencedSeriesUID)
-            
-        elif (modality=="MR" or modality=="CT"):
-            loadables = DICOMScalarVolumePlugin.examineFiles(fileList)
-            self.volumeNodesNum += 1
-            self.volumeNodesIndex.append(n)
-            # get the series instance UID 
-            self.referencedSeriesUID.append(seriesList[n])
-            
-        else:
-            self.referencedSeriesUID.append('') # other modality, like SR, not used for now. 
-             
-        # get the Series Description 
-        seriesDescription = self.db.fileValue(fileList[0], "0008,103e")
-        self.seriesDescription.append(seriesDescription)
-       
-        
-    ### find the MR filenames that match the segmentation series description names ### need to redo this. 
-    print ('self.segmentationNodesIndex: ' + str(self.segmentationNodesIndex))
-    print ('self.volumeNodesIndex: ' + str(self.volumeNodesIndex))
-    
-    # These are all the seriesDescriptions with SEG in it, or for MR/CT 
-    seg_names = [self.seriesDescription[i] for i in self.segmentationNodesIndex]
-    volume_names = [self.seriesDescription[i] for i in self.volumeNodesIndex]
-    print ('seg_names: ' + str(seg_names))
-    print ('volume_names: ' + str(volume_names))
-    
-    print ('referencedSeriesUID: ' + str(self.referencedSeriesUID))
-    
-    # For each of the segmentation scans, find the volume scan that matches
-    # Based on self.referencedSeriesUID 
-    print ('self.segmentationNodesIndex: ' + str(self.segmentationNodesIndex))
-    seg_seriesUID = [self.referencedSeriesUID[i] for i in self.segmentationNodesIndex]
-    print ('seg_series_UID: ' + str(seg_seriesUID))
-    
-    volume_seriesUID = [self.referencedSeriesUID[i] for i in self.volumeNodesIndex]
-    volume_scan_match = [] 
-    volume_names_ordered = []
-    for n in range(0, self.segmentationNodesNum):
-        series = seg_seriesUID[n]
-        index = volume_seriesUID.index(series)
-        # index into actual filelist 
-        volume_scan_match.append(self.volumeNodesIndex[index])
-        volume_names_ordered.append(volume_names[index])
-    self.volumeNodesMatchIndex = volume_scan_match
-    
-    # print to check
-    print ('seriesDescriptions: ' + str(self.seriesDescription))
-    print ('seg_names: ' + str(seg_names))
-    print ('self.segmentationNodesIndex: ' + str(self.segmentationNodesIndex))
-    print ('volume_names (ordered): ' + str(volume_names_ordered))
-    print ('self.volumeNodesMatchIndex: ' + str(self.volumeNodesMatchIndex))
-    
-    # Get the master volume loadables
-    self.masterVolumeNodesLoadables = [] 
-    for n in range(0, self.segmentationNodesNum):
-        index = self.volumeNodesMatchIndex[n]
-        fileList = self.db.filesForSeries(seriesList[index]) 
-        loadables = DICOMScalarVolumePlugin.examineFiles(fileList)
-        self.masterVolumeNodesLoadables.append(loadables[0])
-    print ('self.masterVolumeNodesLoadables: ' + str(self.masterVolumeNodesLoadables))
-    
-    # Get the segmentation volume loadables
-    self.segmentationNodesLoadables = [] 
-    for n in range(0, self.segmentationNodesNum):
-        index = self.segmentationNodesIndex[n]
-        fileList = self.db.filesForSeries(seriesList[index]) 
-        loadables = DICOMSegmentationPlugin.examineFiles(fileList)
-        self.segmentationNodesLoadables.append(loadables[0])
-    print ('self.segmentationNodesLoadables: ' + str(self.segmentationNodesLoadables))
+      self.selectPatientName = index.data()
+      # The row carries the patient UID, so duplicated names are not a problem
+      self.selectPatientUID = index.data(qt.Qt.UserRole)
+
+      # Show the studies of the patient that was selected
+      with instrumentation().span('patient'):
+        self.studyListModel.setRecords(self.studyRecords(self.selectPatientUID))
+      self.studyListNum = len(self.studyListModel.records)
+
+      # The user moved to another patient: prefetch the first studies of this one instead
+      self.prefetcher.schedule(self.nextStudyUIDs(None, self.prefetchCount))
+
+
+  def selectStudy(self, index):
+
+    """This is called when the user selects a study name from the list.
+       A load of another study that is still running is cancelled, and
+       clicking the study that is already loading does not start it again.
+    """
     
-    # temporary 
-    for n in range(0, self.segmentationNodesNum):
-        DICOMSegmentationPlugin.load(self.segmentationNodesLoadables[n])
-        segmentationNodesView = list(slicer.util.getNodes('*vtkMRMLSegmentationNode*').values())[-1]
-        segmentationNodesView.GetDisplayNode().SetVisibility(False)
-        ID = segmentationNodesView.GetID()
-        self.editorWidget.setSegmentationNode(slicer.mrmlScene.GetNodeByID(ID))
+    studyUID = index.data(qt.Qt.UserRole)
+    # with profiling on, each load is written to its own cProfile file
+    if not self.studyPipeline.submit(studyUID, lambda token: instrumentation().profiledSteps(self.loadStudySteps(studyUID, token), 'study-' + studyUID)):
+      return
+
+    self.selectStudyName = index.data()
+    self.selectStudyUID = studyUID
+
+    # While this study is reviewed, prefetch the next ones in the list
+    self.prefetcher.schedule(self.nextStudyUIDs(studyUID, self.prefetchCount))
+
+  def nextStudyUIDs(self, studyUID, count):
+    """The count studies after studyUID in the study list (all of them if
+       studyUID is None), continuing with the studies of the next patients
+       in the order the patient list is shown.
+    """
+    studyUIDs = self.studyListModel.records.keys
+    start = studyUIDs.index(studyUID) + 1 if studyUID in studyUIDs else 0
+    nextStudies = studyUIDs[start:start + count]
+    patients = self.patientListModel.records
+    patientRow = patients.row(self.selectPatientUID)
+    if patientRow >= 0:
+      patientRow += 1
+      while len(nextStudies) < count and patientRow < len(patients):
+        nextStudies.extend(self.studyRecords(patients.key(patientRow)).keys)
+        patientRow += 1
+    return nextStudies[:count]
+
+  def loadStudySteps(self, studyUID, token):
+
+    """Steps of loading one study, run by self.studyPipeline.
+       Each yield lets the GUI process events, and the load stops there
+       if token was cancelled by a newer selection.
+    """
 
+    loadStart = time.perf_counter()
+    plan = {}
+    yield from self.examineStudySteps(studyUID, token, plan)
+    self.seriesListNum = len(plan['seriesList'])
+    self.masterVolumeNodesLoadables = plan['masterVolumeLoadables']
+    self.segmentationNodesLoadables = plan['segmentationLoadables']
+    self.missingSourceNames = [self.index.series(match.seriesUID).description for match in plan['missingSources']]
     
     ### Create the layout - one seg series per view ### 
-    self.cvLogic = ViewSeriesLogic()
+    # The volumes and segmentations are loaded in the background, and each
+    # view is filled in as soon as its own pair is loaded.
+    # self.logic is kept between studies, so its slice views are reused
     viewNames = [] 
-    viewNames = volume_names_ordered
-    print ('viewNames: ' + str(viewNames))
-    self.cvLogic.viewerPerSEG(segmentationNodes=self.segmentationNodesLoadables, \
-                              masterVolumeNodes=self.masterVolumeNodesLoadables, \
-                              viewNames=viewNames, \
-                              layout=None, \
-                              orientation='Axial',
-                              opacity=0.5) 
+    viewNames = plan['viewNames']
+    self.clearStatistics()
+    self.logic.viewerPerSEG(segmentationNodes=self.segmentationNodesLoadables, \
+                             masterVolumeNodes=self.masterVolumeNodesLoadables, \
+                             segmentationSeriesUIDs=plan['segmentationSeriesUIDs'], \
+                             segmentationKinds=plan['segmentationKinds'], \
+                             masterVolumeSeriesUIDs=plan['masterVolumeSeriesUIDs'], \
+                             viewNames=viewNames, \
+                             layout=None, \
+                             orientation='Axial', \
+                             onPairLoaded=self.onPairLoaded, \
+                             onProgress=self.onLoadProgress, \
+                             onStatistics=self.onStatistics, \
+                             cancellationToken=token) 
     
+    self.updatePageControls()
+    # the next page of views first, then the next studies
+    self.schedulePrefetch()
+    
+    # the study stays in flight (and can be cancelled) until all views are loaded
+    while self.logic.pairLoader.isRunning():
+      yield True
+    instrumentation().record('study', time.perf_counter() - loadStart)
+    self.showTimings('ViewSeries: loaded %d views of study %s' % (len(viewNames), self.selectStudyName))
+    
+  def examineStudySteps(self, studyUID, token, plan):
+
+    """Classify the series of a study and match each SEG or RTSTRUCT to its volume
+       (see StudyBrowser.loadPlanSteps). Used for loading and for
+       prefetching a study.
+    """
+    yield from self.logic.loadPlanSteps(studyUID, token, plan)
+
+  def isLoading(self):
+    """True while a study or a page of views is loading, when prefetching waits."""
+    return self.studyPipeline.isRunning() or (self.logic is not None and self.logic.isLoading())
+
+  def schedulePrefetch(self):
+    """Prefetch the next page of views of the study, then the next studies."""
+    volumes = self.logic.pageVolumes(self.logic.page + 1) if self.prefetchNextPage else []
+    self.prefetcher.schedule(self.nextStudyUIDs(self.selectStudyUID, self.prefetchCount), volumes=volumes)
+
+  def onPageChanged(self, step):
+    """Show the previous (step -1) or next (step 1) page of views."""
+    self.clearStatistics()
+    self.logic.showPage(self.logic.page + step)
+    self.updatePageControls()
+    self.schedulePrefetch()
+
+  def updatePageControls(self):
+    pageCount = self.logic.pageCount()
+    self.pageWidget.visible = pageCount > 1
+    self.pageLabel.text = 'Page %d of %d (%d segmentations)' % (self.logic.page + 1, pageCount, len(self.logic.pairs))
+    self.previousPageButton.enabled = self.logic.page > 0
+    self.nextPageButton.enabled = self.logic.page < pageCount - 1
+
+  def onPairLoaded(self, request):
+    """Called on the main thread when one volume/segmentation pair is in the scene."""
+    if request.segmentationNode:
+      self.editorWidget.setSegmentationNode(request.segmentationNode)
+
+  def clearStatistics(self):
+    self.statisticsTable.setRowCount(0)
+    self.statisticsTable.visible = False
+
+  def onStatistics(self, request):
+    """Called on the main thread with the per-segment statistics of a loaded pair."""
+    def number(value, format='%.1f'):
+      item = qt.QTableWidgetItem()
+      # numeric sorting; empty when the segment is outside of the volume
+      if value is not None:
+        item.setData(qt.Qt.DisplayRole, float(format % value))
+      item.setTextAlignment(qt.Qt.AlignRight | qt.Qt.AlignVCenter)
+      return item
+    table = self.statisticsTable
+    table.sortingEnabled = False
+    for segment in request.statistics:
+      row = table.rowCount
+      table.insertRow(row)
+      table.setItem(row, 0, qt.QTableWidgetItem(request.label))
+      table.setItem(row, 1, qt.QTableWidgetItem(segment['label']))
+      table.setItem(row, 2, number(segment['voxels'], '%d'))
+      table.setItem(row, 3, number(segment['volumeMl'], '%.2f'))
+      table.setItem(row, 4, number(segment['mean']))
+      table.setItem(row, 5, number(segment['min']))
+      table.setItem(row, 6, number(segment['max']))
+    table.sortingEnabled = True
+    table.visible = table.rowCount > 0
+
+  def onLoadProgress(self, done, total, pendingViewNames):
+    self.loadProgressBar.maximum = total
+    self.loadProgressBar.value = done
+    self.loadProgressBar.visible = done < total
+    if pendingViewNames:
+      self.loadProgressLabel.text = 'Loading: ' + ', '.join(pendingViewNames)
+    elif self.missingSourceNames:
+      self.loadProgressLabel.text = 'No loadable source volume in the database for: ' + ', '.join(self.missingSourceNames)
+    else:
+      self.loadProgressLabel.text = ''
    
-   
+  def populatePatientList(self):
+    """Show the patients of the index, one row per patient UID.
+       Only the first batch of rows is created, the rest as the list is scrolled.
+    """
+    self.updateModalityFilter()
+    self.searchResult = self.search()
+    records = patientList(self.index, self.sortBy)
+    records.filter(self.searchResult.patientUIDs)
+    self.patientListModel.setRecords(records)
+
+  def studyRecords(self, patientUID):
+    """The study list of a patient, sorted and filtered like the patient list."""
+    records = studyList(self.index, patientUID, self.sortBy)
+    records.filter(self.searchResult.studyUIDs)
+    return records
+
+  def search(self):
+    """SearchResult of the search box and filters."""
+    return self.searchIndex.search(text=self.searchLineEdit.text,
+                                   modality=self.modalityComboBox.currentText if self.modalityComboBox.currentIndex > 0 else '',
+                                   hasSegmentation=self.hasSegmentationCheckBox.checked,
+                                   dateFrom=self.dateFromLineEdit.text.strip(),
+                                   dateTo=self.dateToLineEdit.text.strip(),
+                                   seriesDescription=self.seriesDescriptionLineEdit.text)
+
+  def isSearching(self):
+    return self.searchResult.patientUIDs is not None or self.searchResult.studyUIDs is not None
+
+  def onSearchChanged(self, *args):
+    """Filter the lists on every keystroke, from the search index only."""
+    self.searchResult = self.search()
+    self.patientListModel.filter(self.searchResult.patientUIDs)
+    self.studyListModel.filter(self.searchResult.studyUIDs)
+
+  def updateModalityFilter(self):
+    """List the modalities of the database in the modality filter, keeping the selection."""
+    current = self.modalityComboBox.currentText
+    modalities = self.searchIndex.modalityNames()
+    if modalities == [self.modalityComboBox.itemText(row) for row in range(1, self.modalityComboBox.count)]:
+      return
+    wasBlocking = self.modalityComboBox.blockSignals(True)
+    self.modalityComboBox.clear()
+    self.modalityComboBox.addItem('Any modality')
+    self.modalityComboBox.addItems(modalities)
+    self.modalityComboBox.currentIndex = max(0, self.modalityComboBox.findText(current))
+    self.modalityComboBox.blockSignals(wasBlocking)
+
+  def onSortChanged(self, comboIndex):
+    """Reorder the patient and study lists, without reading the database again."""
+    self.sortBy = self.sortComboBox.itemData(comboIndex)
+    self.patientListModel.sortBy(self.sortBy)
+    self.studyListModel.sortBy(self.sortBy)
+
+  def onSeriesAdded(self, seriesUID):
+    knownPatients = len(self.index.patientOrder)
+    self.index.seriesAdded(seriesUID)
+    self.loadableCache.invalidate(seriesUID)
+    if len(self.index.patientOrder) != knownPatients:
+      self.populatePatientList()
+    elif self.isSearching():
+      self.onSearchChanged()
+
+  def onDatabaseChanged(self):
+    if self.startupPipeline.isRunning():
+      # handled once the index is built
+      self.databaseChangedWhileIndexing = True
+      return
+    knownPatients = list(self.index.patientOrder)
+    self.index.databaseChanged()
+    if self.index.patientOrder != knownPatients:
+      self.populatePatientList()
+    elif self.isSearching():
+      self.onSearchChanged()
+
+  def cleanup(self):
+    """Called when the application closes and the module widget is destroyed."""
+    self.db.disconnect('seriesAdded(QString)', self.onSeriesAdded)
+    self.db.disconnect('databaseChanged()', self.onDatabaseChanged)
+    self.startupPipeline.cancel()
+    self.studyPipeline.cancel()
+    self.prefetcher.stop()
+    self.logic.viewSync.clear()
+    self.removeObservers()
+
+  def indexSteps(self, token):
+    """Steps of building the indexes of the database, run by self.startupPipeline
+       after the panel is shown. The patient list fills in while the first
+       patients are indexed, and search is enabled when everything is indexed.
+    """
+    start = time.perf_counter()
+    for stage, count in timeSliced(self.logic.buildIndexSteps()):
+      token.raiseIfCancelled()
+      if stage == 'patients':
+        if len(self.patientListModel.records) < LazyRecordList.batchSize:
+          self.populatePatientList()
+        self.indexingLabel.text = 'Indexing the DICOM database: %d patients' % count
+      elif stage == 'search':
+        self.indexingLabel.text = 'Indexing for search: %d of %d patients' % (count, len(self.index.patientOrder))
+      else:
+        # the references of the SEGs that are new since the last session
+        self.indexingLabel.text = 'Indexing referenced series: %d segmentations' % count
+      yield
+    if self.databaseChangedWhileIndexing:
+      self.databaseChangedWhileIndexing = False
+      self.index.databaseChanged()
+    self.populatePatientList()
+    for widget in self.searchWidgets:
+      widget.enabled = True
+    self.indexingLabel.visible = False
+    instrumentation().record('startup.index', time.perf_counter() - start)
+    self.showTimings('ViewSeries: indexed %d patients' % len(self.index.patientOrder))
+
+  def setupAdvanced(self):
+    """Settings, stored in the application settings under ViewSeries/."""
+    settings = qt.QSettings()
+
+    advancedCollapsibleButton = ctk.ctkCollapsibleButton()
+    advancedCollapsibleButton.text = "Advanced"
+    advancedCollapsibleButton.collapsed = True
+    self.layout.addWidget(advancedCollapsibleButton)
+    self.advancedLayout = qt.QFormLayout(advancedCollapsibleButton)
+
+    # Loaded volumes and segmentations are kept in the scene up to this much memory
+    self.memoryBudgetSpinBox = qt.QSpinBox()
+    self.memoryBudgetSpinBox.minimum = 256
+    self.memoryBudgetSpinBox.maximum = 1024 * 1024
+    self.memoryBudgetSpinBox.singleStep = 256
+    self.memoryBudgetSpinBox.suffix = ' MB'
+    self.memoryBudgetSpinBox.value = int(settings.value('ViewSeries/MemoryBudgetMB', DEFAULT_BUDGET_MB))
+    self.memoryBudgetSpinBox.toolTip = 'Least recently viewed series are removed from the scene above this memory use'
+    self.memoryBudgetSpinBox.connect('valueChanged(int)', self.onMemoryBudgetChanged)
+    self.advancedLayout.addRow('Memory budget:', self.memoryBudgetSpinBox)
+    self.onMemoryBudgetChanged(self.memoryBudgetSpinBox.value)
+
+    # Studies after the selected one are examined and decoded in the background
+    self.prefetchCountSpinBox = qt.QSpinBox()
+    self.prefetchCountSpinBox.minimum = 0
+    self.prefetchCountSpinBox.maximum = 10
+    self.prefetchCountSpinBox.specialValueText = 'Off'
+    self.prefetchCountSpinBox.value = int(settings.value('ViewSeries/PrefetchCount', 1))
+    self.prefetchCountSpinBox.toolTip = 'Number of following studies to prepare while the current one is reviewed'
+    self.prefetchCountSpinBox.connect('valueChanged(int)', self.onPrefetchCountChanged)
+    self.advancedLayout.addRow('Prefetch studies:', self.prefetchCountSpinBox)
+    self.onPrefetchCountChanged(self.prefetchCountSpinBox.value)
+
+    self.prefetchMemorySpinBox = qt.QSpinBox()
+    self.prefetchMemorySpinBox.minimum = 0
+    self.prefetchMemorySpinBox.maximum = 1024 * 1024
+    self.prefetchMemorySpinBox.singleStep = 256
+    self.prefetchMemorySpinBox.suffix = ' MB'
+    self.prefetchMemorySpinBox.value = int(settings.value('ViewSeries/PrefetchMemoryMB', DEFAULT_PREFETCH_MEMORY_MB))
+    self.prefetchMemorySpinBox.toolTip = 'Prefetching stops when the decoded images use this much memory'
+    self.prefetchMemorySpinBox.connect('valueChanged(int)', self.onPrefetchMemoryChanged)
+    self.advancedLayout.addRow('Prefetch memory:', self.prefetchMemorySpinBox)
+    self.onPrefetchMemoryChanged(self.prefetchMemorySpinBox.value)
+
+    # Decoded volumes are kept on disk, in the Slicer cache directory
+    self.volumeCacheSpinBox = qt.QSpinBox()
+    self.volumeCacheSpinBox.minimum = 0
+    self.volumeCacheSpinBox.maximum = 1024 * 1024
+    self.volumeCacheSpinBox.singleStep = 1024
+    self.volumeCacheSpinBox.suffix = ' MB'
+    self.volumeCacheSpinBox.specialValueText = 'Off'
+    self.volumeCacheSpinBox.value = int(settings.value('ViewSeries/VolumeCacheMB', DEFAULT_VOLUME_CACHE_MB))
+    self.volumeCacheSpinBox.toolTip = 'Size of the disk cache of decoded volumes in ' + volumeCache().directory
+    self.volumeCacheSpinBox.connect('valueChanged(int)', self.onVolumeCacheSizeChanged)
+    self.clearVolumeCacheButton = qt.QPushButton('Clear')
+    self.clearVolumeCacheButton.toolTip = 'Remove all the decoded volumes from the disk cache'
+    self.clearVolumeCacheButton.connect('clicked()', lambda: volumeCache().clear())
+    volumeCacheLayout = qt.QHBoxLayout()
+    volumeCacheLayout.addWidget(self.volumeCacheSpinBox)
+    volumeCacheLayout.addWidget(self.clearVolumeCacheButton)
+    self.advancedLayout.addRow('Volume cache:', volumeCacheLayout)
+    self.onVolumeCacheSizeChanged(self.volumeCacheSpinBox.value)
+
+    # Decoded segmentations are kept on disk as well, bit-packed and compressed
+    self.segmentationCacheSpinBox = qt.QSpinBox()
+    self.segmentationCacheSpinBox.minimum = 0
+    self.segmentationCacheSpinBox.maximum = 1024 * 1024
+    self.segmentationCacheSpinBox.singleStep = 256
+    self.segmentationCacheSpinBox.suffix = ' MB'
+    self.segmentationCacheSpinBox.specialValueText = 'Off'
+    self.segmentationCacheSpinBox.value = int(settings.value('ViewSeries/SegmentationCacheMB', DEFAULT_SEGMENTATION_CACHE_MB))
+    self.segmentationCacheSpinBox.toolTip = 'Size of the disk cache of decoded segmentations in ' + segmentationCache().directory
+    self.segmentationCacheSpinBox.connect('valueChanged(int)', self.onSegmentationCacheSizeChanged)
+    self.clearSegmentationCacheButton = qt.QPushButton('Clear')
+    self.clearSegmentationCacheButton.toolTip = 'Remove all the decoded segmentations from the disk cache'
+    self.clearSegmentationCacheButton.connect('clicked()', lambda: segmentationCache().clear())
+    segmentationCacheLayout = qt.QHBoxLayout()
+    segmentationCacheLayout.addWidget(self.segmentationCacheSpinBox)
+    segmentationCacheLayout.addWidget(self.clearSegmentationCacheButton)
+    self.advancedLayout.addRow('Segmentation cache:', segmentationCacheLayout)
+    self.onSegmentationCacheSizeChanged(self.segmentationCacheSpinBox.value)
+
+    # Studies with many segmentations are shown one page of views at a time
+    self.viewsPerPageSpinBox = qt.QSpinBox()
+    self.viewsPerPageSpinBox.minimum = 0
+    self.viewsPerPageSpinBox.maximum = 64
+    self.viewsPerPageSpinBox.specialValueText = 'All'
+    self.viewsPerPageSpinBox.value = int(settings.value('ViewSeries/ViewsPerPage', DEFAULT_VIEWS_PER_PAGE))
+    self.viewsPerPageSpinBox.toolTip = 'Only the segmentations of the page shown are loaded and kept in memory'
+    self.viewsPerPageSpinBox.connect('valueChanged(int)', self.onViewsPerPageChanged)
+    self.prefetchNextPageCheckBox = qt.QCheckBox('Prefetch the next page')
+    self.prefetchNextPageCheckBox.toolTip = 'Decode the volumes of the next page in the background'
+    self.prefetchNextPageCheckBox.checked = str(settings.value('ViewSeries/PrefetchNextPage', True)).lower() == 'true'
+    self.prefetchNextPageCheckBox.connect('toggled(bool)', self.onPrefetchNextPageChanged)
+    viewsPerPageLayout = qt.QHBoxLayout()
+    viewsPerPageLayout.addWidget(self.viewsPerPageSpinBox)
+    viewsPerPageLayout.addWidget(self.prefetchNextPageCheckBox)
+    self.advancedLayout.addRow('Views per page:', viewsPerPageLayout)
+    self.logic.viewsPerPage = self.viewsPerPageSpinBox.value
+    self.prefetchNextPage = self.prefetchNextPageCheckBox.checked
+
+    # Large volumes are shown from a subsampled preview while the full resolution is decoded
+    self.progressiveCheckBox = qt.QCheckBox('Show a preview of large series first')
+    self.progressiveCheckBox.toolTip = 'Show every few slices of series of %d slices or more while they are decoded' % PairLoader.previewMinSlices
+    self.progressiveCheckBox.checked = str(settings.value('ViewSeries/ProgressiveLoading', True)).lower() == 'true'
+    self.progressiveCheckBox.connect('toggled(bool)', self.onProgressiveChanged)
+    self.advancedLayout.addRow('Progressive loading:', self.progressiveCheckBox)
+    self.onProgressiveChanged(self.progressiveCheckBox.checked)
+
+    # Per-segment statistics of the loaded pairs, cached on disk
+    self.statisticsCheckBox = qt.QCheckBox('Compute segment statistics')
+    self.statisticsCheckBox.toolTip = 'Voxel count, volume and intensity of each segment, cached in ' + segmentStatisticsCache().directory
+    self.statisticsCheckBox.checked = str(settings.value('ViewSeries/SegmentStatistics', True)).lower() == 'true'
+    self.statisticsCheckBox.connect('toggled(bool)', self.onStatisticsChanged)
+    self.clearStatisticsCacheButton = qt.QPushButton('Clear')
+    self.clearStatisticsCacheButton.toolTip = 'Remove all the cached segment statistics'
+    self.clearStatisticsCacheButton.connect('clicked()', lambda: segmentStatisticsCache().clear())
+    statisticsLayout = qt.QHBoxLayout()
+    statisticsLayout.addWidget(self.statisticsCheckBox)
+    statisticsLayout.addWidget(self.clearStatisticsCacheButton)
+    self.advancedLayout.addRow('Statistics:', statisticsLayout)
+    self.onStatisticsChanged(self.statisticsCheckBox.checked)
+
+    # Scrolling, zooming and window/leveling one view follows in the others, at most once per frame
+    self.linkSliceCheckBox = qt.QCheckBox('Slice')
+    self.linkZoomCheckBox = qt.QCheckBox('Zoom')
+    self.linkWindowLevelCheckBox = qt.QCheckBox('Window/level')
+    self.frameTimeTargetSpinBox = qt.QSpinBox()
+    self.frameTimeTargetSpinBox.minimum = 5
+    self.frameTimeTargetSpinBox.maximum = 100
+    self.frameTimeTargetSpinBox.suffix = ' ms'
+    self.frameTimeTargetSpinBox.prefix = 'frame '
+    self.frameTimeTargetSpinBox.toolTip = 'Target time of one update of the linked views; slower updates are spaced out'
+    linkViewsLayout = qt.QHBoxLayout()
+    for checkBox, key in ((self.linkSliceCheckBox, 'LinkSlice'), (self.linkZoomCheckBox, 'LinkZoom'), (self.linkWindowLevelCheckBox, 'LinkWindowLevel')):
+      checkBox.checked = str(settings.value('ViewSeries/' + key, True)).lower() == 'true'
+      checkBox.connect('toggled(bool)', self.onLinkViewsChanged)
+      linkViewsLayout.addWidget(checkBox)
+    linkViewsLayout.addWidget(self.frameTimeTargetSpinBox)
+    self.advancedLayout.addRow('Linked views:', linkViewsLayout)
+    self.frameTimeTargetSpinBox.value = int(settings.value('ViewSeries/FrameTimeTargetMs', ViewSynchronizer.targetFrameMs))
+    self.frameTimeTargetSpinBox.connect('valueChanged(int)', self.onFrameTimeTargetChanged)
+    self.onLinkViewsChanged()
+    self.onFrameTimeTargetChanged(self.frameTimeTargetSpinBox.value)
+
+    # Timings and counters of the study loads, off by default (see ViewSeriesLib/Instrumentation.py)
+    self.profileDirectory = os.path.join(slicer.app.cachePath, 'ViewSeries', 'profiles')
+    self.recordTimingsCheckBox = qt.QCheckBox('Record timings')
+    self.recordTimingsCheckBox.toolTip = 'Time the steps of each study load, and show them here and in the log'
+    self.profileStudyLoadsCheckBox = qt.QCheckBox('Profile study loads')
+    self.profileStudyLoadsCheckBox.toolTip = 'Write a cProfile file of each study load to ' + self.profileDirectory
+    performanceLayout = qt.QHBoxLayout()
+    performanceLayout.addWidget(self.recordTimingsCheckBox)
+    performanceLayout.addWidget(self.profileStudyLoadsCheckBox)
+    self.advancedLayout.addRow('Performance:', performanceLayout)
+    self.timingsTextEdit = qt.QPlainTextEdit()
+    self.timingsTextEdit.readOnly = True
+    self.timingsTextEdit.font = qt.QFontDatabase.systemFont(qt.QFontDatabase.FixedFont)
+    self.advancedLayout.addRow(self.timingsTextEdit)
+    self.recordTimingsCheckBox.checked = str(settings.value('ViewSeries/RecordTimings', False)).lower() == 'true'
+    self.profileStudyLoadsCheckBox.checked = str(settings.value('ViewSeries/ProfileStudyLoads', False)).lower() == 'true'
+    self.recordTimingsCheckBox.connect('toggled(bool)', self.onRecordTimingsChanged)
+    self.profileStudyLoadsCheckBox.connect('toggled(bool)', self.onProfileStudyLoadsChanged)
+    self.onRecordTimingsChanged(self.recordTimingsCheckBox.checked)
+    self.onProfileStudyLoadsChanged(self.profileStudyLoadsCheckBox.checked)
+
+  def onMemoryBudgetChanged(self, budgetMB):
+    qt.QSettings().setValue('ViewSeries/MemoryBudgetMB', budgetMB)
+    residency = nodeResidency()
+    residency.budgetBytes = budgetMB * 1024 * 1024
+    residency.evict()
+
+  def onPrefetchCountChanged(self, count):
+    qt.QSettings().setValue('ViewSeries/PrefetchCount', count)
+    self.prefetchCount = count
+    if count == 0:
+      self.prefetcher.stop()
+
+  def onPrefetchMemoryChanged(self, memoryMB):
+    qt.QSettings().setValue('ViewSeries/PrefetchMemoryMB', memoryMB)
+    decodedImages().capBytes = memoryMB * 1024 * 1024
+
+  def onVolumeCacheSizeChanged(self, sizeMB):
+    qt.QSettings().setValue('ViewSeries/VolumeCacheMB', sizeMB)
+    volumeCache().maxBytes = sizeMB * 1024 * 1024
+    volumeCache().evict()
+
+  def onSegmentationCacheSizeChanged(self, sizeMB):
+    qt.QSettings().setValue('ViewSeries/SegmentationCacheMB', sizeMB)
+    segmentationCache().maxBytes = sizeMB * 1024 * 1024
+    segmentationCache().evict()
+
+  def onViewsPerPageChanged(self, viewsPerPage):
+    qt.QSettings().setValue('ViewSeries/ViewsPerPage', viewsPerPage)
+    self.logic.setViewsPerPage(viewsPerPage)
+    self.updatePageControls()
+
+  def onPrefetchNextPageChanged(self, checked):
+    qt.QSettings().setValue('ViewSeries/PrefetchNextPage', checked)
+    self.prefetchNextPage = checked
+
+  def onProgressiveChanged(self, checked):
+    qt.QSettings().setValue('ViewSeries/ProgressiveLoading', checked)
+    self.logic.progressive = checked
+
+  def onStatisticsChanged(self, checked):
+    qt.QSettings().setValue('ViewSeries/SegmentStatistics', checked)
+    self.logic.computeStatistics = checked
+
+  def onLinkViewsChanged(self, checked=None):
+    settings = qt.QSettings()
+    settings.setValue('ViewSeries/LinkSlice', self.linkSliceCheckBox.checked)
+    settings.setValue('ViewSeries/LinkZoom', self.linkZoomCheckBox.checked)
+    settings.setValue('ViewSeries/LinkWindowLevel', self.linkWindowLevelCheckBox.checked)
+    self.logic.linkViews(offset=self.linkSliceCheckBox.checked, zoom=self.linkZoomCheckBox.checked, windowLevel=self.linkWindowLevelCheckBox.checked)
+
+  def onFrameTimeTargetChanged(self, targetMs):
+    qt.QSettings().setValue('ViewSeries/FrameTimeTargetMs', targetMs)
+    self.logic.viewSync.targetFrameMs = float(targetMs)
+
+  def onRecordTimingsChanged(self, checked):
+    qt.QSettings().setValue('ViewSeries/RecordTimings', checked)
+    instrumentation().enabled = checked
+    instrumentation().reset()
+    self.timingsTextEdit.visible = checked
+
+  def onProfileStudyLoadsChanged(self, checked):
+    qt.QSettings().setValue('ViewSeries/ProfileStudyLoads', checked)
+    instrumentation().profileDirectory = self.profileDirectory if checked else ''
+
+  def showTimings(self, title):
+    """Log and show what was recorded since the last time, if timings are recorded."""
+    if not instrumentation().enabled:
+      return
+    instrumentation().log(title)
+    self.timingsTextEdit.plainText = title + '\n' + instrumentation().report()
+    instrumentation().reset()
+
   def setupEditor(self):
       
     self.editorWidget = slicer.qMRMLSegmentEditorWidget()
@@ -353,22 +764,20 @@ class ViewSeriesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     This creates a list of the patient names from the DICOM database, which the user then must select.
     """
 
+    setupStart = time.perf_counter()
+
     # This adds the Reload & Test
     ScriptedLoadableModuleWidget.setup(self)
 
-    # Get list of patients from slicer DICOM database 
+    # Index the patients/studies/series of the slicer DICOM database once.
+    # The indexes are built in time slices after the panel is shown (see
+    # indexSteps), and kept up to date from the database signals.
     self.db = slicer.dicomDatabase
-    patientList = list(self.db.patients())
-    self.patientList = patientList
-    # Get all the patient names in the database
-    # For some reason, not all are listed - probably doesn't do nested names
-    patientNames = []
-    for patient in range(0,len(patientList)):
-        studyList = self.db.studiesForPatient(patientList[patient])
-        seriesList = self.db.seriesForStudy(studyList[0])
-        fileList = self.db.filesForSeries(seriesList[0])
-        patientNames.append(self.db.fileValue(fileList[0], "0010,0010"))
-    print ('patientNames: ' + str(patientNames))
+    self.logic = ViewSeriesLogic(self.db)
+    self.index = self.logic.index
+    self.searchIndex = self.logic.searchIndex
+    self.db.connect('seriesAdded(QString)', self.onSeriesAdded)
+    self.db.connect('databaseChanged()', self.onDatabaseChanged)
 
     # Display the patient names 
     # Collapsible button
@@ -376,17 +785,63 @@ class ViewSeriesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     patientCollapsibleButton.text = "Patient names"
     self.layout.addWidget(patientCollapsibleButton)
 
-    # Try with QListWidget
-    patientListWidget = qt.QListWidget()
-    for patient in patientNames:
-        patientListWidget.addItem(patient)
-
     # Layout within the patient collapsible button
     patientLayout = qt.QFormLayout(patientCollapsibleButton)
-    patientLayout.addWidget(patientListWidget)
+
+    self.indexingLabel = qt.QLabel('Indexing the DICOM database')
+    patientLayout.addRow(self.indexingLabel)
+
+    self.sortComboBox = qt.QComboBox()
+    self.sortComboBox.addItem('Name', SORT_BY_NAME)
+    self.sortComboBox.addItem('Patient ID', SORT_BY_ID)
+    self.sortComboBox.addItem('Study date', SORT_BY_DATE)
+    patientLayout.addRow('Sort by:', self.sortComboBox)
+
+    # Search and filters, applied to the lists on every change
+    self.searchLineEdit = qt.QLineEdit()
+    self.searchLineEdit.placeholderText = 'Patient name or ID'
+    self.searchLineEdit.clearButtonEnabled = True
+    patientLayout.addRow('Search:', self.searchLineEdit)
+    self.modalityComboBox = qt.QComboBox()
+    self.modalityComboBox.addItem('Any modality')
+    self.hasSegmentationCheckBox = qt.QCheckBox('Has segmentation')
+    self.hasSegmentationCheckBox.toolTip = 'Only studies with a SEG or RTSTRUCT series'
+    filterLayout = qt.QHBoxLayout()
+    filterLayout.addWidget(self.modalityComboBox)
+    filterLayout.addWidget(self.hasSegmentationCheckBox)
+    patientLayout.addRow('Filter:', filterLayout)
+    self.dateFromLineEdit = qt.QLineEdit()
+    self.dateFromLineEdit.placeholderText = 'From YYYYMMDD'
+    self.dateToLineEdit = qt.QLineEdit()
+    self.dateToLineEdit.placeholderText = 'To YYYYMMDD'
+    dateLayout = qt.QHBoxLayout()
+    dateLayout.addWidget(self.dateFromLineEdit)
+    dateLayout.addWidget(self.dateToLineEdit)
+    patientLayout.addRow('Study date:', dateLayout)
+    self.seriesDescriptionLineEdit = qt.QLineEdit()
+    self.seriesDescriptionLineEdit.placeholderText = 'Series description starts with'
+    patientLayout.addRow('Series:', self.seriesDescriptionLineEdit)
+
+    # The rows are fetched from the index as the list is scrolled
+    self.patientListModel = RecordListModel()
+    self.patientListView = qt.QListView()
+    self.patientListView.uniformItemSizes = True
+    self.patientListView.setModel(self.patientListModel)
+    self.populatePatientList()
+    patientLayout.addWidget(self.patientListView)
 
     # check if a patient name is clicked
-    patientListWidget.itemClicked.connect(self.selectPatient)
+    self.patientListView.connect('clicked(QModelIndex)', self.selectPatient)
+    self.sortComboBox.connect('currentIndexChanged(int)', self.onSortChanged)
+    for lineEdit in (self.searchLineEdit, self.dateFromLineEdit, self.dateToLineEdit, self.seriesDescriptionLineEdit):
+      lineEdit.connect('textChanged(QString)', self.onSearchChanged)
+    self.modalityComboBox.connect('currentIndexChanged(int)', self.onSearchChanged)
+    self.hasSegmentationCheckBox.connect('toggled(bool)', self.onSearchChanged)
+    # enabled when the search index is built
+    self.searchWidgets = [self.searchLineEdit, self.modalityComboBox, self.hasSegmentationCheckBox,
+                          self.dateFromLineEdit, self.dateToLineEdit, self.seriesDescriptionLineEdit]
+    for widget in self.searchWidgets:
+      widget.enabled = False
 
     # Display the study names 
     # Collapsible button
@@ -395,52 +850,126 @@ class ViewSeriesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.layout.addWidget(studyCollapsibleButton)
     self.studyCollapsibleButton = studyCollapsibleButton
 
-    self.studyListWidget = qt.QListWidget()
+    self.studyListModel = RecordListModel()
+    self.studyListView = qt.QListView()
+    self.studyListView.uniformItemSizes = True
+    self.studyListView.setModel(self.studyListModel)
     self.studyLayout = qt.QFormLayout(self.studyCollapsibleButton)
-    self.studyLayout.addWidget(self.studyListWidget)
+    self.studyLayout.addWidget(self.studyListView)
+
+    # Select the study and then get the series and update the viewer.
+    # Connected once here: connecting in selectPatient ran the load once per patient click.
+    self.studyListView.connect('clicked(QModelIndex)', self.selectStudy)
+
+    # Shows which views are still loading
+    self.loadProgressBar = qt.QProgressBar()
+    self.loadProgressBar.format = 'Loaded %v of %m'
+    self.loadProgressBar.visible = False
+    self.studyLayout.addRow(self.loadProgressBar)
+    self.loadProgressLabel = qt.QLabel()
+    self.loadProgressLabel.wordWrap = True
+    self.studyLayout.addRow(self.loadProgressLabel)
+
+    # Studies with more segmentations than views per page are shown a page at a time
+    self.previousPageButton = qt.QPushButton('Previous')
+    self.previousPageButton.connect('clicked()', lambda: self.onPageChanged(-1))
+    self.pageLabel = qt.QLabel()
+    self.pageLabel.alignment = qt.Qt.AlignCenter
+    self.nextPageButton = qt.QPushButton('Next')
+    self.nextPageButton.connect('clicked()', lambda: self.onPageChanged(1))
+    pageLayout = qt.QHBoxLayout()
+    pageLayout.setContentsMargins(0, 0, 0, 0)
+    pageLayout.addWidget(self.previousPageButton)
+    pageLayout.addWidget(self.pageLabel, 1)
+    pageLayout.addWidget(self.nextPageButton)
+    self.pageWidget = qt.QWidget()
+    self.pageWidget.setLayout(pageLayout)
+    self.pageWidget.visible = False
+    self.studyLayout.addRow(self.pageWidget)
+
+    # Volume and intensity of each segment of the views of the page, filled in as they load
+    self.statisticsTable = qt.QTableWidget()
+    self.statisticsTable.setColumnCount(7)
+    self.statisticsTable.setHorizontalHeaderLabels(['View', 'Segment', 'Voxels', 'Volume (mL)', 'Mean', 'Min', 'Max'])
+    self.statisticsTable.verticalHeader().visible = False
+    self.statisticsTable.editTriggers = qt.QAbstractItemView.NoEditTriggers
+    self.statisticsTable.selectionBehavior = qt.QAbstractItemView.SelectRows
+    self.statisticsTable.visible = False
+    self.studyLayout.addRow(self.statisticsTable)
+
+    self.setupAdvanced()
     
     self.setupEditor()
-    
-    # ### Try wtih QListView ###
-    # sampleLayout = qt.QVBoxLayout()
-    # listView = qt.QListView()
-    # # listView.setSpacing(3)
-    # # listView.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
-    # listModel = qt.QStandardItemModel()
-    # item = qt.QStandardItem("Item 1")
-    # listModel.appendRow(item)
-    # item = qt.QStandardItem("Item 2")
-    # listModel.appendRow(item)
-    # item = qt.QStandardItem("Item 3")
-    # listModel.appendRow(item)
-    # listView.setModel(listModel)
-    # # listView.show()
-    # sampleLayout.addWidget(listView)
+
+    # The panel is ready: index the database in the background of the GUI
+    self.startupPipeline.submit('index', self.indexSteps)
+    instrumentation().record('startup.panel', time.perf_counter() - setupStart)
 
 ###################
 # ViewSeriesLogic #
 ###################
 # Similar to CompareVolumesLogic 
 
-class ViewSeriesLogic(ScriptedLoadableModuleLogic):
+class ViewSeriesLogic(ScriptedLoadableModuleLogic, StudyBrowser):
     """This class should implement all the actual
     computation done by your module.  The interface
     should be such that other python code can import
     this class and make use of the functionality without
     requiring an instance of the Widget
+
+    Listing patients and studies, matching series and building load plans
+    come from StudyBrowser (listPatients, listStudies, classifySeries,
+    matchSegmentations, loadPlan), and work on db without any view.
     """
-    def __init__(self):
+    def __init__(self, db=None):
         ScriptedLoadableModuleLogic.__init__(self)
-        self.sliceViewItemPattern = """
-          <item><view class="vtkMRMLSliceNode" singletontag="{viewName}">
-            <property name="orientation" action="default">{orientation}</property>
-            <property name="viewlabel" action="default">{viewName}</property>
-            <property name="viewcolor" action="default">{color}</property>
-          </view></item>
-         """
+        StudyBrowser.__init__(self, db if db is not None else slicer.dicomDatabase,
+                              referenceGraph=referenceGraph(), loadableCache=loadableCache())
+        self.dicomPlugins = {}
         # use a nice set of colors
         self.colors = slicer.util.getNode('GenericColors')
         self.lookupTable = self.colors.GetLookupTable()
+        # slot views, reused by all the studies shown with this logic
+        self.layoutEngine = SliceLayoutEngine(self.lookupTable)
+        # loaded nodes by series UID, shared by all the studies of the session
+        self.residency = nodeResidency()
+        # nodes shown in the views of the current study, by series UID and view name
+        self.viewRegistry = ViewNodeRegistry()
+        self.residency.registry = self.viewRegistry
+        self.sliceWidgets = {}
+        # views already fitted to their volume, which is not done again when a preview is refined
+        self.fittedViews = set()
+        # show a preview of large volumes first (see PairLoader)
+        self.progressive = True
+        # the pairs of the study and the page of them shown (see showPage)
+        self.viewsPerPage = DEFAULT_VIEWS_PER_PAGE
+        self.pairs = []
+        self.pageOptions = {}
+        self.page = 0
+        self.pairLoader = None
+        # linked slice offset, zoom and window/level of the slot views, one update per frame
+        self.viewSync = ViewSynchronizer()
+        # compute the per-segment statistics of the loaded pairs (see SegmentStatistics)
+        self.computeStatistics = True
+
+    def examineSeries(self, kind, seriesUID, files):
+        """Loadables of the DICOM plugin for kind, cached in self.loadableCache.
+
+        Structure sets are rasterized by ViewSeries (see RTStructure), so
+        without SlicerRT they get a plain loadable of their files.
+        """
+        if kind not in self.dicomPlugins:
+            pluginName = {VOLUME: 'DICOMScalarVolumePlugin', SEGMENTATION: 'DICOMSegmentationPlugin', RTSTRUCTURE: 'DicomRtImportExportPlugin'}[kind]
+            pluginClass = slicer.modules.dicomPlugins.get(pluginName)
+            self.dicomPlugins[kind] = pluginClass() if pluginClass else None
+        if self.dicomPlugins[kind] is None:
+            from DICOMLib import DICOMLoadable
+            loadable = DICOMLoadable()
+            loadable.files = files
+            loadable.name = self.seriesDescription(seriesUID) or 'RTSTRUCT'
+            loadable.selected = True
+            return [loadable]
+        return self.loadableCache.examine(self.dicomPlugins[kind], seriesUID, files)
 
     def assignLayoutDescription(self,layoutDescription):
         """assign the xml to the user-defined layout slot"""
@@ -451,30 +980,49 @@ class ViewSeriesLogic(ScriptedLoadableModuleLogic):
             layoutNode.AddLayoutDescription(layoutNode.SlicerLayoutUserView, layoutDescription)
         layoutNode.SetViewArrangement(layoutNode.SlicerLayoutUserView)
     
-    def viewerPerSEG(self,segmentationNodes=None,masterVolumeNodes=None,viewNames=[],layout=None,orientation='Axial',opacity=0.5):
+    def viewerPerSEG(self,segmentationNodes=None,masterVolumeNodes=None,viewNames=[],layout=None,orientation='Axial',onPairLoaded=None,onProgress=None,cancellationToken=None,segmentationSeriesUIDs=None,masterVolumeSeriesUIDs=None,onStatistics=None,segmentationKinds=None):
         """ Load each volume in the scene into its own
         slice viewer and link them all together.
         If background is specified, put it in the background
         of all viewers and make the other volumes be the
         forground.  If label is specified, make it active as
         the label layer of all viewers.
-        Return a map of slice nodes indexed by the view name (given or generated).
-        Opacity applies only when background is selected.
+        Return a map of slice nodes indexed by the view name of their slot;
+        the given viewNames are shown as the view labels.
+
+        The layout is created right away and the volume/segmentation pairs
+        are loaded in the background; each view is filled in as soon as its
+        pair is ready. onPairLoaded(request) and onProgress(done, total,
+        pendingViewNames) are called on the main thread while loading.
+        Cancelling cancellationToken stops the loading and removes the nodes
+        it created.
+        With self.computeStatistics, onStatistics(request) is called when the
+        per-segment statistics of a loaded pair are in request.statistics.
+        segmentationKinds tells which of the segmentations are RT structure
+        sets (RTSTRUCTURE); by default they are all SEGs (SEGMENTATION).
+        When the series UIDs of the loadables are given, series that are
+        still in the scene are reused, and the other resident series are
+        hidden and may be evicted to stay within the memory budget.
+
+        With more pairs than self.viewsPerPage (or than the views of layout),
+        only the first page of pairs is shown and loaded; see showPage.
         """
+        segmentationSeriesUIDs = segmentationSeriesUIDs or [''] * len(segmentationNodes)
+        masterVolumeSeriesUIDs = masterVolumeSeriesUIDs or [''] * len(masterVolumeNodes)
+        segmentationKinds = segmentationKinds or [SEGMENTATION] * len(segmentationNodes)
+        # (label, volume loadable, segmentation loadable, volume series UID, segmentation series UID, segmentation kind)
+        self.pairs = []
+        for index in range(len(segmentationNodes)):
+            self.pairs.append((viewNames[index] if index < len(viewNames) else None, masterVolumeNodes[index], segmentationNodes[index], \
+                               masterVolumeSeriesUIDs[index], segmentationSeriesUIDs[index], segmentationKinds[index]))
+        self.pageOptions = {'layout': layout, 'orientation': orientation, 'onPairLoaded': onPairLoaded,
+                            'onProgress': onProgress, 'cancellationToken': cancellationToken, 'onStatistics': onStatistics}
+        return self.showPage(0)
+
+    def gridShape(self, volumeCount, layout=None):
+        """(rows, columns) of the grid for volumeCount views."""
         import math
-        DICOMScalarVolumePlugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
-        DICOMSegmentationPlugin = slicer.modules.dicomPlugins['DICOMSegmentationPlugin']()
         
-        if masterVolumeNodes:
-            print ('masterVolumeNodes were passed in -- loading')
-            masterVolumeNodesView = [] 
-            for n in range(0,len(masterVolumeNodes)):
-                masterVolumeNode = DICOMScalarVolumePlugin.load(masterVolumeNodes[n]) 
-                masterVolumeNodesView.append(masterVolumeNode)
-            print ('masterVolumeNodesView: ' + str(masterVolumeNodesView))
-           
-
-        volumeCount = len(segmentationNodes)
         volumeCountSqrt = math.sqrt(volumeCount)
         if layout:
             rows = layout[0]
@@ -496,80 +1044,153 @@ class ViewSeriesLogic(ScriptedLoadableModuleLogic):
             rows = math.floor(r)
             if r != rows:
                 rows += 1
+        return int(rows), int(columns)
+
+    def pageSize(self):
+        """Pairs per page, 0 for all of them on one page."""
+        layout = self.pageOptions.get('layout')
+        return layout[0] * layout[1] if layout else self.viewsPerPage
+
+    def pageCount(self):
+        pageSize = self.pageSize()
+        return max(1, (len(self.pairs) + pageSize - 1) // pageSize) if pageSize else 1
+
+    def pagePairs(self, page):
+        pageSize = self.pageSize()
+        if not pageSize:
+            return list(self.pairs) if page == 0 else []
+        return self.pairs[page * pageSize:(page + 1) * pageSize]
+
+    def pageVolumes(self, page):
+        """(seriesUID, loadable) of the master volumes of a page, for prefetching."""
+        return [(pair[3], pair[1]) for pair in self.pagePairs(page) if pair[1] is not None]
+
+    def isLoading(self):
+        return self.pairLoader is not None and self.pairLoader.isRunning()
+
+    def setViewsPerPage(self, viewsPerPage):
+        """Change the page size, staying on the page of the first pair shown."""
+        first = self.page * self.pageSize()
+        self.viewsPerPage = viewsPerPage
+        if self.pairs and not self.pageOptions.get('layout'):
+            self.showPage(first // viewsPerPage if viewsPerPage else 0)
+
+    def showPage(self, page):
+        """Show the pairs of one page in the slot views and load them.
+
+        The grid has the same shape on all the pages, so switching pages
+        only relabels the views. Pairs of the previous page that are loaded
+        are kept in the scene, but only the current page is protected from
+        eviction; pairs that were still loading are dropped.
+        """
+        page = max(0, min(page, self.pageCount() - 1))
+        self.page = page
+        pairs = self.pagePairs(page)
+        orientation = self.pageOptions['orientation']
+        onPairLoaded = self.pageOptions['onPairLoaded']
+        if self.pairLoader is not None:
+            self.pairLoader.cancel(keepLoaded=True)
 
         #
-        # construct the XML for the layout
-        # - one viewer per volume
-        # - default orientation as specified
+        # show a grid of slot views, one per volume of a page
+        # - the layout of each grid shape is built and registered once
+        # - the slice views are kept from study to study and page to page, and only relabeled
         #
-        actualViewNames = []
-        index = 1
-        layoutDescription = ''
-        layoutDescription += '<layout type="vertical">\n'
-        for row in range(int(rows)):
-            layoutDescription += ' <item> <layout type="horizontal">\n'
-            for column in range(int(columns)):
-                try:
-                    viewName = viewNames[index-1]
-                except IndexError:
-                    viewName = '%d_%d' % (row,column)
-                rgb = [int(round(v*255)) for v in self.lookupTable.GetTableValue(index)[:-1]]
-                color = '#%0.2X%0.2X%0.2X' % tuple(rgb)
-                layoutDescription += self.sliceViewItemPattern.format(viewName=viewName,orientation=orientation,color=color)
-                actualViewNames.append(viewName)
-                index += 1
-            layoutDescription += '</layout></item>\n'
-        layoutDescription += '</layout>'
-        self.assignLayoutDescription(layoutDescription)
-        print (layoutDescription)
+        rows, columns = self.gridShape(len(self.pagePairs(0)), self.pageOptions['layout'])
+        with instrumentation().span('layout'):
+            actualViewNames = self.layoutEngine.showGrid(rows, columns, orientation, [pair[0] or '' for pair in pairs])
         
-        # let the widgets all decide how big they should be
-        slicer.app.processEvents()
-    
-        # put one of the volumes into each view, or none if it should be blank
-        sliceNodesByViewName = {}
-        layoutManager = slicer.app.layoutManager()
+            # put one of the volumes into each view, or none if it should be blank
+            sliceNodesByViewName = {}
+            layoutManager = slicer.app.layoutManager()
+            
+            # look the slice widgets up once, the views are then set up from the registry
+            self.sliceWidgets = dict((viewName, layoutManager.sliceWidget(viewName)) for viewName in actualViewNames)
+            self.viewRegistry.clear()
+            self.fittedViews = set()
+            slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+            try:
+                for viewName in actualViewNames:
+                    sliceWidget = self.sliceWidgets[viewName]
+                    sliceWidget.mrmlSliceCompositeNode().SetForegroundVolumeID("")
+                    sliceWidget.mrmlSliceNode().SetOrientation(orientation)
+                    sliceNodesByViewName[viewName] = sliceWidget.mrmlSliceNode()
+            finally:
+                slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+        instrumentation().count('views', len(actualViewNames))
+        self.viewSync.setViews(self.sliceWidgets if any(self.viewSync.linked.values()) else {})
         
-        print ('actualViewNames: ' + str(actualViewNames))
+        # load the pairs of the page in the background, filling each view as it is ready
+        self.residency.setVisibleSeries([pair[3] for pair in pairs] + [pair[4] for pair in pairs])
+        requests = []
+        for index, (label, volumeLoadable, segmentationLoadable, volumeSeriesUID, segmentationSeriesUID, segmentationKind) in enumerate(pairs):
+            if index >= len(actualViewNames):
+                break
+            requests.append(LoadRequest(actualViewNames[index], volumeLoadable, segmentationLoadable, \
+                                        volumeSeriesUID=volumeSeriesUID, \
+                                        segmentationSeriesUID=segmentationSeriesUID, \
+                                        segmentationKind=segmentationKind, \
+                                        label=label))
         
-        for index in range(len(actualViewNames)):
-            
-            viewName = actualViewNames[index]
-            print ('viewName: ' + str(viewName))
-            
-            try: 
-                masterVolumeNodeID = masterVolumeNodesView[index].GetID()
-            except: 
-                masterVolumeNodeID = ""
-                
-            print ('masterVolumeNodeID: ' + str(masterVolumeNodeID))
-            
-                
-            # ### This loads just the underlying masterVolumeNodeID in each view ### 
-            # sliceWidget = layoutManager.sliceWidget(viewName)
-            # compositeNode = sliceWidget.mrmlSliceCompositeNode() 
-            # compositeNode.SetForegroundVolumeID(masterVolumeNodeID)
-            # compositeNode.SetDoPropagateVolumeSelection(False) # added
-            # sliceNode = sliceWidget.mrmlSliceNode()
-            # sliceNode.SetOrientation(orientation)
-            # sliceNodesByViewName[viewName] = sliceNode
-            ### Same as above ### 
-            layoutManager.sliceWidget(viewName).mrmlSliceCompositeNode().SetForegroundVolumeID(masterVolumeNodeID)
-            layoutManager.sliceWidget(viewName).mrmlSliceNode().SetOrientation(orientation)
-            sliceNodesByViewName[viewName] = layoutManager.sliceWidget(viewName).mrmlSliceNode()
-                        
-            segmentationNodesView = list(slicer.util.getNodes('*vtkMRMLSegmentationNode*').values())
-            IDs = [f.GetID() for f in segmentationNodesView]
-            seg_node = slicer.util.getNode(IDs[index])
-            display_node = seg_node.GetDisplayNode()
-            viewNameSeg = 'vtkMRMLSliceNode' + viewName
-            display_node.SetDisplayableOnlyInView(viewNameSeg)
-            display_node.SetVisibility(True)
-            
+        def pairsLoaded(loadedRequests):
+            self.showPairsInViews(loadedRequests, orientation)
+            if onPairLoaded:
+                for request in loadedRequests:
+                    onPairLoaded(request)
+        
+        self.pairLoader = PairLoader(requests, onPairsLoaded=pairsLoaded, onPairsShown=self.fitViews, onProgress=self.pageOptions['onProgress'], cancellationToken=self.pageOptions['cancellationToken'], residency=self.residency, volumeCache=volumeCache(), segmentationCache=segmentationCache(), progressive=self.progressive, \
+                                     statisticsCache=segmentStatisticsCache() if self.computeStatistics else None, onStatistics=self.pageOptions['onStatistics'])
+        self.pairLoader.start()
         
         return sliceNodesByViewName
 
-    
+    def linkViews(self, **linked):
+        """Link or unlink the offset, zoom and windowLevel of the slot views
+        (see ViewSeriesLib/ViewSync.py); Slicer's own linking is left to the
+        user when none is linked.
+        """
+        self.viewSync.linked.update(linked)
+        self.viewSync.setViews(self.sliceWidgets if any(self.viewSync.linked.values()) else {})
+
+    def showPairsInViews(self, requests, orientation='Axial'):
+        """Show loaded volume/segmentation pairs in the views they belong to.
+        The nodes come from the requests themselves (and are recorded in
+        self.viewRegistry), and all the display changes are done in one
+        scene batch process (nested in the one of the PairLoader tick). The
+        views are fitted afterwards, by fitViews.
+        """
+        with instrumentation().span('layout.show'), self.viewSync.paused():
+            slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+            try:
+                for request in requests:
+                    self.viewRegistry.register(request)
+                    sliceWidget = self.sliceWidgets[request.viewName]
+                    masterVolumeNodeID = request.volumeNode.GetID() if request.volumeNode else ""
+                    sliceWidget.mrmlSliceCompositeNode().SetForegroundVolumeID(masterVolumeNodeID)
+                    sliceWidget.mrmlSliceNode().SetOrientation(orientation)
+                    if request.segmentationNode:
+                        display_node = request.segmentationNode.GetDisplayNode()
+                        viewNameSeg = 'vtkMRMLSliceNode' + request.viewName
+                        display_node.SetDisplayableOnlyInView(viewNameSeg)
+                        display_node.SetVisibility(True)
+            finally:
+                slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+    def fitViews(self, requests):
+        """Fit the views of shown pairs to their volumes, once the scene
+        batch process of the PairLoader tick has ended (so the slice layers
+        have the new volumes). A view is fitted only the first time, so
+        refining a preview keeps the slice position. Fitting is not
+        propagated to the linked views; instead a newly filled view takes the
+        linked state the user has set.
+        """
+        with instrumentation().span('layout.fit'), self.viewSync.paused():
+            for request in requests:
+                if request.viewName not in self.fittedViews:
+                    self.sliceWidgets[request.viewName].sliceLogic().FitSliceToAll()
+                    self.fittedViews.add(request.viewName)
+        for request in requests:
+            self.viewSync.viewContentChanged(request.viewName)
 
 
 # #
@@ -0,0 +1,308 @@
+# CacheWarming.py
+#
+# Headless batch filling of the ViewSeries caches for a cohort of studies.
+#
+# Before a reading session, every study of a cohort can be made ready to
+# open instantly. For each study the same load plan as selectStudy() is built
+# (classification, SEG/RTSTRUCT to source matching through the reference
+# graph, header metadata through the tag cache; see StudyBrowser). Its
+# volumes (with their files sorted into slice order, as the volume loadables
+# are), segmentations and structure sets are then decoded, with their
+# segment statistics, into the VolumeCache, SegmentationCache and
+# SegmentStatisticsCache that ViewSeries reads from (the directory layout is
+# that of their singletons, under <Slicer cache>/ViewSeries).
+#
+# Plans are built in the main process, which owns the database. The decoding
+# is CPU bound and pydicom holds the GIL, so it is spread over a pool of
+# worker processes, one study per task. Each finished study is appended to a
+# journal (warmed.jsonl in the cache directory) with a fingerprint of its
+# files: an interrupted run resumes where it stopped, and a later run only
+# redoes the studies whose files changed. The run ends with a summary of the
+# per-study timings, the cache sizes and the failures.
+#
+# The DICOM plugin loadables are only kept for a Slicer session (see
+# LoadableCache), so they are not warmed here.
+#
+# Usage, on the database file of a Slicer DICOM database:
+#   python -m ViewSeriesLib.CacheWarming --database <DICOM database>/ctkDICOM.sql --cache-dir <Slicer cache>/ViewSeries
+# or in Slicer, on its DICOM database and cache directory:
+#   Slicer --no-main-window --python-code "from ViewSeriesLib import CacheWarming; slicer.util.exit(CacheWarming.main([]))"
+################################################################################
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from .ReferenceGraph import ReferenceGraph
+from .StudyBrowser import StudyBrowser, RTSTRUCTURE
+from .VolumeCache import VolumeCache, DEFAULT_VOLUME_CACHE_MB, readScalarVolume, sortSliceFiles, sourceFingerprint
+from .SegmentationCache import SegmentationCache, DEFAULT_SEGMENTATION_CACHE_MB, readSegmentation
+from .SegmentStatistics import SegmentStatisticsCache, readSegmentStatistics
+
+JOURNAL_FILE_NAME = 'warmed.jsonl'
+
+
+def studyJob(browser, studyUID):
+    """The load plan of a study, as a picklable job for warmStudy()."""
+    plan = browser.loadPlan(studyUID)
+    files = plan['files']
+    pairs = []
+    for label, volumeSeriesUID, segmentationSeriesUID, kind in zip(plan['viewNames'], plan['masterVolumeSeriesUIDs'],
+                                                                     plan['segmentationSeriesUIDs'], plan['segmentationKinds']):
+        pairs.append({'label': label, 'kind': kind,
+                      'volumeSeriesUID': volumeSeriesUID, 'volumeFiles': files[volumeSeriesUID],
+                      'segmentationSeriesUID': segmentationSeriesUID, 'segmentationFiles': files[segmentationSeriesUID]})
+    allFiles = [fileName for seriesFiles in files.values() for fileName in seriesFiles]
+    return {'studyUID': studyUID, 'pairs': pairs, 'fingerprint': sourceFingerprint(allFiles),
+            'missingSources': len(plan['missingSources'])}
+
+
+def warmStudy(job, volumeCache, segmentationCache, statisticsCache=None):
+    """Decode the pairs of a study job into the caches (in a worker process).
+
+    Returns the journal entry of the study.
+    """
+    from .RTStructure import readRTStructure
+    timings = {'volumes': 0.0, 'segmentations': 0.0, 'statistics': 0.0}
+    errors = []
+    volumes = {}  # series UID -> (sorted files, VolumeArray), for the SEGs of the same volume
+    start = time.perf_counter()
+    for pair in job['pairs']:
+        try:
+            stepStart = time.perf_counter()
+            if pair['volumeSeriesUID'] not in volumes:
+                # the files come in database order: decoded (and cached) in
+                # slice order, as the volume loadables list them
+                volumeFiles = sortSliceFiles(pair['volumeFiles'])
+                volumes[pair['volumeSeriesUID']] = volumeFiles, readScalarVolume(pair['volumeSeriesUID'], volumeFiles, volumeCache)
+            volumeFiles, volumeArray = volumes[pair['volumeSeriesUID']]
+            timings['volumes'] += time.perf_counter() - stepStart
+            stepStart = time.perf_counter()
+            if pair['kind'] == RTSTRUCTURE:
+                segmentationArray = readRTStructure(pair['segmentationSeriesUID'], pair['segmentationFiles'], segmentationCache,
+                                                    sourceSeriesUID=pair['volumeSeriesUID'], sourceFiles=volumeFiles)
+            else:
+                segmentationArray = readSegmentation(pair['segmentationSeriesUID'], pair['segmentationFiles'], segmentationCache)
+            timings['segmentations'] += time.perf_counter() - stepStart
+            if statisticsCache is not None:
+                stepStart = time.perf_counter()
+                readSegmentStatistics(pair['segmentationSeriesUID'], pair['segmentationFiles'], pair['volumeSeriesUID'], volumeFiles,
+                                      statisticsCache, segmentationArray=segmentationArray, volumeArray=volumeArray)
+                timings['statistics'] += time.perf_counter() - stepStart
+        except Exception as e:
+            errors.append('%s: %s' % (pair['label'], e))
+    return {'studyUID': job['studyUID'], 'fingerprint': job['fingerprint'], 'status': 'failed' if errors else 'ok',
+            'pairs': len(job['pairs']), 'missingSources': job['missingSources'],
+            'seconds': time.perf_counter() - start, 'timings': timings, 'errors': errors,
+            'cacheHits': volumeCache.hits + segmentationCache.hits, 'cacheMisses': volumeCache.misses + segmentationCache.misses}
+
+
+def readJournal(path):
+    """{studyUID: fingerprint} of the studies warmed by earlier runs."""
+    warmed = {}
+    try:
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run
+                    continue
+                if entry.get('status') == 'ok' and entry.get('fingerprint'):
+                    warmed[entry['studyUID']] = entry['fingerprint']
+                else:
+                    warmed.pop(entry.get('studyUID'), None)
+    except OSError:
+        pass
+    return warmed
+
+
+def selectStudies(browser, studyUIDs=(), patientIDs=()):
+    """The study UIDs of the cohort: the given studies and the studies of the
+    patients with the given PatientIDs, or all the studies of the database.
+    """
+    index = browser.index
+    if not studyUIDs and not patientIDs:
+        return [studyUID for patientUID in index.patientOrder for studyUID in index.patientRecords[patientUID].studyUIDs]
+    selected = [studyUID for studyUID in studyUIDs if studyUID in index.studyRecords]
+    for studyUID in studyUIDs:
+        if studyUID not in index.studyRecords:
+            logging.warning('Study %s is not in the database' % studyUID)
+    wanted = set(patientIDs)
+    for patientUID in index.patientOrder:
+        patient = index.patientRecords[patientUID]
+        if patient.patientID in wanted:
+            wanted.discard(patient.patientID)
+            selected.extend(patient.studyUIDs)
+    for patientID in sorted(wanted):
+        logging.warning('Patient %s is not in the database' % patientID)
+    # keep the order, without duplicates
+    return list(dict.fromkeys(selected))
+
+
+def _processPool(workers):
+    # spawned rather than forked: the parent may be a Qt application (Slicer)
+    context = multiprocessing.get_context('spawn')
+    if 'slicer' in sys.modules:
+        import slicer
+        context.set_executable(os.path.join(slicer.app.applicationDirPath, 'PythonSlicer' + ('.exe' if os.name == 'nt' else '')))
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def summarize(results, skipped, seconds, volumeCache, segmentationCache):
+    """Summary of a run: counts, per-study timings (s) and cache sizes."""
+    warmed = [result for result in results if result['status'] == 'ok']
+    studySeconds = [result['seconds'] for result in warmed]
+    summary = {'studies': len(results) + skipped, 'warmed': len(warmed), 'skipped': skipped,
+               'failed': len(results) - len(warmed), 'seconds': seconds,
+               'study.median': _percentile(studySeconds, 0.5), 'study.p95': _percentile(studySeconds, 0.95),
+               'study.max': max(studySeconds) if studySeconds else 0.0,
+               'pairs': sum(result['pairs'] for result in results),
+               'missingSources': sum(result.get('missingSources', 0) for result in results),
+               'volumeCacheBytes': volumeCache.totalBytes, 'segmentationCacheBytes': segmentationCache.totalBytes}
+    for step in ('volumes', 'segmentations', 'statistics'):
+        summary[step + '.seconds'] = sum(result['timings'][step] for result in results)
+    summary['failures'] = [{'studyUID': result['studyUID'], 'errors': result['errors']} for result in results if result['status'] != 'ok']
+    return summary
+
+
+def warmCohort(browser, studyUIDs, cacheDirectory, workers=None, volumeCacheBytes=DEFAULT_VOLUME_CACHE_MB * 1024 * 1024,
+               segmentationCacheBytes=DEFAULT_SEGMENTATION_CACHE_MB * 1024 * 1024, computeStatistics=True, restart=False,
+               onResult=None):
+    """Warm the caches under cacheDirectory for the studies; returns
+    (summary, per-study results). onResult(result) is called as each study
+    finishes. Studies in the journal whose files did not change are skipped,
+    unless restart.
+    """
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    volumeCache = VolumeCache(os.path.join(cacheDirectory, 'volumes'), volumeCacheBytes)
+    segmentationCache = SegmentationCache(os.path.join(cacheDirectory, 'segmentations'), segmentationCacheBytes)
+    statisticsCache = SegmentStatisticsCache(os.path.join(cacheDirectory, 'statistics')) if computeStatistics else None
+    os.makedirs(cacheDirectory, exist_ok=True)
+    journalPath = os.path.join(cacheDirectory, JOURNAL_FILE_NAME)
+    warmed = {} if restart else readJournal(journalPath)
+    results = []
+    skipped = 0
+    start = time.perf_counter()
+
+    with open(journalPath, 'a') as journal, _processPool(workers) as pool:
+
+        def finished(result):
+            # one line per study, written as it finishes, so an interrupted run is resumable
+            journal.write(json.dumps(result) + '\n')
+            journal.flush()
+            results.append(result)
+            if onResult:
+                onResult(result)
+
+        def collect(futures, returnWhen):
+            done, notDone = concurrent.futures.wait(futures, return_when=returnWhen)
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker process died
+                    result = {'studyUID': job['studyUID'], 'fingerprint': job['fingerprint'], 'status': 'failed',
+                              'pairs': len(job['pairs']), 'seconds': 0.0, 'errors': [str(e)],
+                              'timings': {'volumes': 0.0, 'segmentations': 0.0, 'statistics': 0.0}}
+                finished(result)
+
+        futures = {}
+        for studyUID in studyUIDs:
+            try:
+                job = studyJob(browser, studyUID)
+            except Exception as e:
+                finished({'studyUID': studyUID, 'fingerprint': None, 'status': 'failed', 'pairs': 0, 'seconds': 0.0,
+                          'errors': ['plan: %s' % e], 'timings': {'volumes': 0.0, 'segmentations': 0.0, 'statistics': 0.0}})
+                continue
+            if job['fingerprint'] is not None and warmed.get(studyUID) == job['fingerprint']:
+                skipped += 1
+                continue
+            futures[pool.submit(warmStudy, job, volumeCache, segmentationCache, statisticsCache)] = job
+            # plans are built while the workers decode, a few studies ahead
+            if len(futures) >= 2 * workers:
+                collect(futures, concurrent.futures.FIRST_COMPLETED)
+        if futures:
+            collect(futures, concurrent.futures.ALL_COMPLETED)
+
+    browser.referenceGraph.save()
+    return summarize(results, skipped, time.perf_counter() - start, volumeCache, segmentationCache), results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Fill the ViewSeries caches for a cohort of studies, without the GUI.')
+    parser.add_argument('--database', help='ctkDICOM.sql file of the DICOM database (default in Slicer: its DICOM database)')
+    parser.add_argument('--cache-dir', help='ViewSeries cache directory (default in Slicer: <Slicer cache>/ViewSeries)')
+    parser.add_argument('--studies', nargs='+', default=[], help='StudyInstanceUIDs of the cohort')
+    parser.add_argument('--patient-ids', nargs='+', default=[], help='PatientIDs of the cohort')
+    parser.add_argument('--list', help='file with one StudyInstanceUID or PatientID per line')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes (default: one less than the CPUs)')
+    parser.add_argument('--volume-cache-mb', type=int, default=DEFAULT_VOLUME_CACHE_MB)
+    parser.add_argument('--segmentation-cache-mb', type=int, default=DEFAULT_SEGMENTATION_CACHE_MB)
+    parser.add_argument('--no-statistics', action='store_true', help='do not compute the segment statistics')
+    parser.add_argument('--restart', action='store_true', help='warm all the studies again, ignoring the journal of earlier runs')
+    parser.add_argument('--report', help='write the summary and the per-study results to this JSON file')
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.database:
+        from .SQLiteDatabase import SQLiteDICOMDatabase
+        db = SQLiteDICOMDatabase(args.database)
+    elif 'slicer' in sys.modules:
+        import slicer
+        db = slicer.dicomDatabase
+    else:
+        parser.error('--database is needed outside of Slicer')
+    cacheDirectory = args.cache_dir
+    if not cacheDirectory:
+        if 'slicer' not in sys.modules:
+            parser.error('--cache-dir is needed outside of Slicer')
+        import slicer
+        cacheDirectory = os.path.join(slicer.app.cachePath, 'ViewSeries')
+
+    browser = StudyBrowser(db, referenceGraph=ReferenceGraph(os.path.join(cacheDirectory, 'references.json')))
+    for stage in browser.index.buildSteps():
+        pass
+    for stage in browser.referenceGraph.updateSteps(browser.index):
+        pass
+    studyUIDs, patientIDs = list(args.studies), list(args.patient_ids)
+    if args.list:
+        with open(args.list) as listFile:
+            for line in listFile:
+                key = line.strip()
+                if key:
+                    (studyUIDs if key in browser.index.studyRecords else patientIDs).append(key)
+    cohort = selectStudies(browser, studyUIDs, patientIDs)
+    print('Warming the caches in %s for %d studies' % (cacheDirectory, len(cohort)))
+
+    def progress(result):
+        print('%-64s %-6s %7.1f s  %s' % (result['studyUID'], result['status'], result['seconds'], '; '.join(result['errors'])))
+        sys.stdout.flush()
+
+    summary, results = warmCohort(browser, cohort, cacheDirectory, args.workers or None,
+                                  args.volume_cache_mb * 1024 * 1024, args.segmentation_cache_mb * 1024 * 1024,
+                                  computeStatistics=not args.no_statistics, restart=args.restart, onResult=progress)
+    for name in sorted(summary):
+        if name != 'failures':
+            print('%-24s %s' % (name, ('%.2f' % summary[name]) if isinstance(summary[name], float) else summary[name]))
+    if summary['volumeCacheBytes'] >= 0.95 * args.volume_cache_mb * 1024 * 1024:
+        print('The volume cache is full: the first studies may have been evicted, use a larger --volume-cache-mb')
+    if args.report:
+        with open(args.report, 'w') as reportFile:
+            json.dump({'summary': summary, 'studies': results}, reportFile, indent=2)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,147 @@
+# Instrumentation.py
+#
+# Timing spans and counters of the hot paths of opening a study.
+#
+# Selecting a patient or a study used to print the series UIDs, view names
+# and layout slots of every click to the console, which cost time on large
+# studies and still did not tell where the time went. Instead, the code is
+# instrumented with named spans (index, metadata, examine, decode, nodes,
+# layout, ...), each accumulating a count, a total and a maximum time, and
+# with counters (files touched, bytes decoded, cache hits and misses).
+#
+# Nothing is recorded or logged unless instrumentation is enabled (see the
+# Advanced section of the module panel): a disabled span is a shared no-op
+# object. Decoding runs in the worker threads, so recording takes a lock.
+#
+# Study loads can also be profiled with cProfile (profileDirectory). The
+# profile covers the main thread from the start to the end of the load,
+# including the timer callbacks that create the nodes; the decoding in the
+# worker threads only shows up in the decode spans. The .prof files can be
+# read with pstats or snakeviz.
+################################################################################
+
+import logging
+import os
+import re
+import threading
+import time
+
+
+class _Span(object):
+
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Instrumentation(object):
+    """Named timing spans and counters, recorded while enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.profileDirectory = ''  # study loads are profiled into it when set
+        self.lock = threading.Lock()
+        self.spans = {}  # name -> [count, total seconds, max seconds]
+        self.counters = {}  # name -> value
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+
+    def span(self, name):
+        """Context manager timing the code it wraps as one call of span name."""
+        return _Span(self, name) if self.enabled else _NO_SPAN
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [1, seconds, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                span[2] = max(span[2], seconds)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        """The spans, longest total first, and the counters, as text."""
+        with self.lock:
+            spans = sorted(self.spans.items(), key=lambda item: -item[1][1])
+            counters = sorted(self.counters.items())
+        lines = ['%-24s %5d x %10.1f ms  (max %.1f ms)' % (name, count, total * 1000, longest * 1000)
+                 for name, (count, total, longest) in spans]
+        lines.extend('%-24s %12d' % (name, value) for name, value in counters)
+        return '\n'.join(lines)
+
+    def log(self, title):
+        """Log the report under title, if enabled."""
+        if self.enabled:
+            logging.info(title + '\n' + self.report())
+
+    def profiledSteps(self, steps, name):
+        """The steps of a generator, profiled from the first step to the last
+        when profileDirectory is set.
+        """
+        if not self.profileDirectory:
+            yield from steps
+            return
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield from steps
+        finally:
+            profile.disable()
+            self.dumpProfile(profile, name)
+
+    def dumpProfile(self, profile, name):
+        fileName = '%s-%s.prof' % (re.sub(r'[^\w.-]', '_', name), time.strftime('%Y%m%d-%H%M%S'))
+        path = os.path.join(self.profileDirectory, fileName)
+        try:
+            os.makedirs(self.profileDirectory, exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as e:
+            logging.warning('Could not write the profile of %s: %s' % (name, e))
+            return
+        logging.info('Profile of %s written to %s' % (name, path))
+
+
+_instrumentation = None
+
+
+def instrumentation():
+    """The session wide Instrumentation."""
+    global _instrumentation
+    if _instrumentation is None:
+        _instrumentation = Instrumentation()
+    return _instrumentation
@@ -0,0 +1,451 @@
+# LoadEngine.py
+#
+# Background loading of the volume/segmentation pairs shown by viewerPerSEG.
+#
+# Pixel data of the master volumes is decoded with SimpleITK in a pool of
+# worker threads (the readers release the GIL while decoding), or read from
+# the on-disk VolumeCache. MRML nodes can only be created on the main thread,
+# so a QTimer polls the workers and turns each decoded volume into a volume
+# node as soon as it is ready, together with the segmentation that goes with
+# it, which is decoded in the background as well (see SegmentationCache). Each pair is handed to a callback right
+# away, so its slice view can be filled in while the others are still loading.
+# RT structure sets take the place of the segmentation the same way: their
+# contours are rasterized in the background on the grid of the volume (see
+# RTStructure).
+#
+# Large series that have to be decoded are shown progressively: a preview
+# made of every few slices, subsampled in-plane, is decoded first and shown
+# with a segmentation subsampled the same way; when the full decode is done
+# the same nodes are filled with the full resolution data, so the views keep
+# their slice position.
+################################################################################
+
+import concurrent.futures
+import functools
+import logging
+import os
+import time
+
+from .Instrumentation import instrumentation
+from .StudyBrowser import SEGMENTATION, RTSTRUCTURE
+
+_workerPool = None
+
+
+def workerPool():
+    """Thread pool shared by all the loads of the session."""
+    global _workerPool
+    if _workerPool is None:
+        _workerPool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(2, min(8, (os.cpu_count() or 2) - 1)),
+            thread_name_prefix='ViewSeriesLoad')
+    return _workerPool
+
+
+def decodeScalarVolume(files):
+    """Read a sorted list of DICOM files into a SimpleITK image (no MRML access)."""
+    import SimpleITK as sitk
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(list(files))
+    return reader.Execute()
+
+
+def decodePreviewVolume(files, sliceStep, shrink):
+    """VolumeArray of every sliceStep-th file of a sorted series, with every
+    shrink-th row and column (no MRML access).
+    """
+    from .VolumeCache import VolumeArray
+    with instrumentation().span('decode.preview'):
+        return VolumeArray.fromImage(decodeScalarVolume(list(files)[::sliceStep])).subsampled(1, shrink)
+
+
+class LoadRequest(object):
+    """One master volume and segmentation pair, shown in one view."""
+
+    def __init__(self, viewName, volumeLoadable, segmentationLoadable, volumeSeriesUID='', segmentationSeriesUID='', label=None, segmentationKind=SEGMENTATION):
+        self.viewName = viewName
+        # what the view shows, for progress reports (the view name is a layout slot)
+        self.label = label or viewName
+        self.volumeLoadable = volumeLoadable
+        self.segmentationLoadable = segmentationLoadable
+        self.volumeSeriesUID = volumeSeriesUID
+        self.segmentationSeriesUID = segmentationSeriesUID
+        # SEGMENTATION, or RTSTRUCTURE for a structure set loaded as a segmentation
+        self.segmentationKind = segmentationKind
+        self.volumeNode = None
+        self.segmentationNode = None
+        self.createdNodes = []
+        self.isPreview = False  # True while the nodes hold the preview
+        self.statistics = None  # per segment, see SegmentStatistics
+        self.error = None
+
+
+class PairLoader(object):
+    """Loads a list of LoadRequests, decoding in the background.
+
+    onPairsLoaded(requests) is called on the main thread with the pairs whose
+    nodes were just created or reused (several at once when they are ready
+    together), inside the one scene batch process of the timer tick that
+    created them, onPairsShown(requests) with the same pairs once that batch
+    process has ended (for what needs the views up to date, such as fitting
+    them to their volumes),
+    onProgress(done, total, pendingViewNames) after each call and
+    onFinished(requests) once everything is loaded.
+
+    With progressive, volumes of at least previewMinSlices files that are not
+    in the volume cache are first shown as a preview (request.isPreview is
+    True): onPairsLoaded is called for the preview and again, with the same
+    nodes, once they hold the full resolution data.
+
+    If the cancellation token is cancelled, decoding that has not started is
+    dropped and the nodes already created by this loader are removed.
+
+    With a residency manager (see NodeCache), series that are still in the
+    scene are reused instead of loaded, and new nodes are registered with it.
+    Images already decoded by the prefetcher (see Prefetch) are not decoded
+    again, and with a volume cache (see VolumeCache) decoded volumes are read
+    from and stored to disk; the same goes for the segmentations with a
+    segmentation cache (see SegmentationCache).
+
+    With a statistics cache (see SegmentStatistics), the per-segment
+    statistics of each loaded pair are computed in the background from the
+    decoded arrays (or read from the cache), and onStatistics(request) is
+    called on the main thread when request.statistics is set. This may be
+    after onFinished.
+    """
+
+    pollIntervalMs = 20
+    previewSliceStep = 4
+    previewShrink = 2
+    previewMinSlices = 100
+
+    def __init__(self, requests, onPairsLoaded=None, onProgress=None, onFinished=None, cancellationToken=None, residency=None, volumeCache=None, segmentationCache=None, progressive=False, statisticsCache=None, onStatistics=None, onPairsShown=None):
+        self.requests = list(requests)
+        self.residency = residency
+        self.volumeCache = volumeCache
+        self.segmentationCache = segmentationCache
+        self.statisticsCache = statisticsCache
+        self.progressive = progressive
+        self.onPairsLoaded = onPairsLoaded
+        self.onPairsShown = onPairsShown
+        self.onProgress = onProgress
+        self.onFinished = onFinished
+        self.onStatistics = onStatistics
+        self.cancellationToken = cancellationToken
+        self.cancelled = False
+        self.futures = {}
+        self.segmentationFutures = {}
+        self.previewFutures = {}
+        self.statisticsFutures = {}
+        self.previews = {}  # request -> (preview volume node, preview segmentation node)
+        self.volumeNodes = {}  # volume seriesUID -> node created by this load, shared by its views
+        self.pending = list(self.requests)
+        self.done = []
+        self.finished = False
+        self.timer = None
+        self.startTime = None
+        self.firstImageShown = False
+
+    def _wantsPreview(self, request):
+        if not self.progressive or len(request.volumeLoadable.files) < self.previewMinSlices:
+            return False
+        # a cached volume is read faster than a preview is decoded
+        return self.volumeCache is None or not request.volumeSeriesUID or not self.volumeCache.contains(request.volumeSeriesUID)
+
+    def _segmentationReader(self, request):
+        """readSegmentation, or the same for a structure set, which is
+        rasterized on the grid of the volume of the request.
+        """
+        if request.segmentationKind == RTSTRUCTURE:
+            from .RTStructure import readRTStructure
+            return functools.partial(readRTStructure, sourceSeriesUID=request.volumeSeriesUID, sourceFiles=request.volumeLoadable.files)
+        from .SegmentationCache import readSegmentation
+        return readSegmentation
+
+    def start(self):
+        import qt
+        from .Prefetch import decodedImages
+        from .VolumeCache import readScalarVolume
+        self.startTime = time.perf_counter()
+        pool = workerPool()
+        decodes = []
+        decodedSeries = {}  # volume seriesUID -> the request that reads it
+        for request in self.requests:
+            if self.residency is not None:
+                request.volumeNode = self.residency.node(request.volumeSeriesUID)
+                request.segmentationNode = self.residency.node(request.segmentationSeriesUID)
+                instrumentation().count('nodes.reused', (request.volumeNode is not None) + (request.segmentationNode is not None))
+            if request.volumeNode is not None:
+                self.futures[request] = None
+                continue
+            if request.volumeSeriesUID in decodedSeries:
+                # the views of the same volume wait for one decode
+                continue
+            decodedSeries[request.volumeSeriesUID] = request
+            volumeArray = decodedImages().take(request.volumeSeriesUID, request.volumeLoadable.files)
+            if volumeArray is not None:
+                instrumentation().count('prefetch.hit')
+                self.futures[request] = concurrent.futures.Future()
+                self.futures[request].set_result(volumeArray)
+                continue
+            decodes.append(request)
+            # the previews of all the views are decoded first
+            if self._wantsPreview(request):
+                self.previewFutures[request] = pool.submit(decodePreviewVolume, request.volumeLoadable.files, \
+                                                           self.previewSliceStep, self.previewShrink)
+        for request in self.requests:
+            if request.segmentationNode is None:
+                self.segmentationFutures[request] = pool.submit(self._segmentationReader(request), request.segmentationSeriesUID, \
+                                                                request.segmentationLoadable.files, self.segmentationCache)
+            else:
+                self.segmentationFutures[request] = None
+        for request in decodes:
+            self.futures[request] = pool.submit(readScalarVolume, request.volumeSeriesUID, request.volumeLoadable.files, self.volumeCache)
+        for request in self.requests:
+            if request not in self.futures:
+                self.futures[request] = self.futures[decodedSeries[request.volumeSeriesUID]]
+        self.timer = qt.QTimer()
+        self.timer.setInterval(self.pollIntervalMs)
+        self.timer.connect('timeout()', self._poll)
+        self._reportProgress()
+        self.timer.start()
+        if self.cancellationToken is not None:
+            self.cancellationToken.onCancel(self.cancel)
+
+    def isRunning(self):
+        return self.timer is not None and bool(self.pending) and not self.cancelled
+
+    def cancel(self, keepLoaded=False):
+        """Stop loading and remove the nodes created so far. With keepLoaded,
+        the pairs that are completely loaded are kept (e.g. when the view
+        shows another page) and only the previews of the others are removed.
+        """
+        import slicer
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.timer is not None:
+            self.timer.stop()
+        pending, self.pending = self.pending, []
+        for request in pending:
+            for future in (self.futures[request], self.segmentationFutures[request], self.previewFutures.get(request)):
+                if future is not None:
+                    future.cancel()
+        # statistics are cached once computed, the others are computed next time
+        for future in self.statisticsFutures.values():
+            future.cancel()
+        self.statisticsFutures = {}
+        # pending requests may already show a preview
+        for request in (pending if keepLoaded else self.done + pending):
+            # only remove what this load created, reused nodes stay resident
+            for node in request.createdNodes:
+                if self.residency is not None:
+                    self.residency.forget(node.GetAttribute('ViewSeries.SeriesInstanceUID'), node)
+                if slicer.mrmlScene.IsNodePresent(node):
+                    slicer.mrmlScene.RemoveNode(node)
+            request.createdNodes = []
+            request.segmentationNode = None
+            request.volumeNode = None
+
+    def _poll(self):
+        if self.cancelled:
+            return
+        if self._hasReadyPairs():
+            import slicer
+            # the nodes of a tick are created and shown in one scene batch process
+            slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+            try:
+                shown = self._showReadyPairs()
+            finally:
+                slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+            if shown and self.onPairsShown and not self.cancelled:
+                self.onPairsShown(shown)
+        if not self.pending and not self.finished:
+            self.finished = True
+            if self.onFinished:
+                self.onFinished(self.done)
+        self._pollStatistics()
+        if not self.pending and not self.statisticsFutures:
+            self.timer.stop()
+
+    def _hasReadyPairs(self):
+        if any(future.done() for future in self.previewFutures.values()):
+            return True
+        return any(all(future is None or future.done() for future in (self.futures[request], self.segmentationFutures[request]))
+                   for request in self.pending)
+
+    def _showReadyPairs(self):
+        # Previews are small, all the ready ones are shown at once
+        previewed = []
+        for request in list(self.previewFutures):
+            future = self.previewFutures[request]
+            if not future.done():
+                continue
+            del self.previewFutures[request]
+            if self.futures[request].done() or future.exception() is not None:
+                # the full volume was as fast, or the preview could not be decoded
+                continue
+            self._showPreview(request, future.result())
+            previewed.append(request)
+        # Reused pairs are all finished at once, but at most one pair that
+        # needs new nodes is finished per timer tick so the GUI stays responsive
+        loaded = []
+        for request in list(self.pending):
+            futures = (self.futures[request], self.segmentationFutures[request])
+            if not all(future is None or future.done() for future in futures):
+                continue
+            needsNodes = any(future is not None for future in futures)
+            if needsNodes and any(self.futures[done] is not None or self.segmentationFutures[done] is not None for done in loaded):
+                continue
+            self.pending.remove(request)
+            self._finishPair(request)
+            loaded.append(request)
+        shown = previewed + [request for request in loaded if request not in previewed]
+        if shown:
+            if not self.firstImageShown:
+                self.firstImageShown = True
+                instrumentation().record('firstImage', time.perf_counter() - self.startTime)
+            if self.onPairsLoaded:
+                self.onPairsLoaded(shown)
+        if loaded:
+            self._reportProgress()
+        return shown
+
+    def _pollStatistics(self):
+        for request in list(self.statisticsFutures):
+            future = self.statisticsFutures[request]
+            if not future.done():
+                continue
+            del self.statisticsFutures[request]
+            if future.exception() is not None:
+                logging.warning('Could not compute the segment statistics of %s: %s' % (request.label, future.exception()))
+                continue
+            request.statistics = future.result()
+            if self.onStatistics:
+                self.onStatistics(request)
+
+    def _showPreview(self, request, volumeArray):
+        """Show the preview of a volume, with its segmentation subsampled the
+        same way if it is already decoded.
+        """
+        import slicer
+        from .VolumeCache import volumeNodeFromArray
+        from .SegmentationCache import segmentationNodeFromArray
+        segmentationNode = None
+        with instrumentation().span('nodes.preview'):
+            volumeNode = volumeNodeFromArray(volumeArray, slicer.mrmlScene.GenerateUniqueName(request.volumeLoadable.name))
+            future = self.segmentationFutures[request]
+            if future is not None and future.done() and future.exception() is None:
+                segmentationArray = future.result().subsampled(self.previewSliceStep, self.previewShrink)
+                segmentationNode = segmentationNodeFromArray(segmentationArray, slicer.mrmlScene.GenerateUniqueName(request.segmentationLoadable.name))
+        request.volumeNode = volumeNode
+        self._created(request, volumeNode, request.volumeSeriesUID)
+        if segmentationNode is not None:
+            request.segmentationNode = segmentationNode
+            self._created(request, segmentationNode, request.segmentationSeriesUID)
+        request.isPreview = True
+        self.previews[request] = (volumeNode, segmentationNode)
+        instrumentation().count('previews')
+
+    def _finishPair(self, request):
+        volumePreview, segmentationPreview = self.previews.pop(request, (None, None))
+        try:
+            sharedNode = self.volumeNodes.get(request.volumeSeriesUID)
+            if sharedNode is not None and request.volumeNode is not sharedNode:
+                # another view of this load has the same volume
+                request.volumeNode = sharedNode
+            elif request.volumeNode is None or request.volumeNode is volumePreview:
+                with instrumentation().span('nodes.volume'):
+                    request.volumeNode = self._createVolumeNode(request, volumePreview)
+                self._created(request, request.volumeNode, request.volumeSeriesUID)
+                self.volumeNodes[request.volumeSeriesUID] = request.volumeNode
+            if request.segmentationNode is None or request.segmentationNode is segmentationPreview:
+                with instrumentation().span('nodes.segmentation'):
+                    request.segmentationNode = self._loadSegmentation(request, segmentationPreview)
+                self._created(request, request.segmentationNode, request.segmentationSeriesUID)
+        except Exception as e:
+            logging.error('Could not load %s: %s' % (request.label, e))
+            request.error = e
+        # previews that were not filled in place (the DICOM plugin loaded a new node instead)
+        for node in (volumePreview, segmentationPreview):
+            if node is not None and node is not request.volumeNode and node is not request.segmentationNode:
+                self._removeCreated(request, node)
+        request.isPreview = False
+        self.done.append(request)
+        if self.statisticsCache is not None and request.error is None:
+            self._computeStatistics(request)
+
+    def _computeStatistics(self, request):
+        # from the arrays just decoded; those of reused nodes are read from the caches
+        arrays = []
+        for future in (self.segmentationFutures[request], self.futures[request]):
+            if future is not None and future.exception() is not None:
+                # loaded by the DICOM plugin, there is no array to compute them from
+                return
+            arrays.append(future.result() if future is not None else None)
+        from .SegmentStatistics import readSegmentStatistics
+        self.statisticsFutures[request] = workerPool().submit(readSegmentStatistics, \
+            request.segmentationSeriesUID, request.segmentationLoadable.files, \
+            request.volumeSeriesUID, request.volumeLoadable.files, self.statisticsCache, \
+            segmentationArray=arrays[0], volumeArray=arrays[1], segmentationReader=self._segmentationReader(request), \
+            segmentationCache=self.segmentationCache, volumeCache=self.volumeCache)
+
+    def _created(self, request, node, seriesUID):
+        if node is None:
+            return
+        if node not in request.createdNodes:
+            instrumentation().count('nodes.created')
+            request.createdNodes.append(node)
+        if self.residency is not None:
+            # registered again after a preview is filled in, for its new size
+            self.residency.add(seriesUID, node)
+
+    def _removeCreated(self, request, node):
+        import slicer
+        if node in request.createdNodes:
+            request.createdNodes.remove(node)
+        if self.residency is not None:
+            self.residency.forget(node.GetAttribute('ViewSeries.SeriesInstanceUID'), node)
+        if slicer.mrmlScene.IsNodePresent(node):
+            slicer.mrmlScene.RemoveNode(node)
+
+    def _createVolumeNode(self, request, previewNode=None):
+        import slicer
+        loadable = request.volumeLoadable
+        try:
+            volumeArray = self.futures[request].result()
+        except Exception as e:
+            # SimpleITK could not read the series, let the DICOM plugin do it
+            logging.warning('Background decode of %s failed (%s), loading with the DICOM plugin' % (loadable.name, e))
+            plugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
+            return plugin.load(loadable)
+        from .VolumeCache import volumeNodeFromArray, updateVolumeNodeFromArray
+        if previewNode is not None:
+            updateVolumeNodeFromArray(previewNode, volumeArray)
+            return previewNode
+        return volumeNodeFromArray(volumeArray, slicer.mrmlScene.GenerateUniqueName(loadable.name))
+
+    def _loadSegmentation(self, request, previewNode=None):
+        import slicer
+        loadable = request.segmentationLoadable
+        try:
+            segmentationArray = self.segmentationFutures[request].result()
+        except Exception as e:
+            # not decodable here, let the DICOM plugin do it
+            logging.warning('Background decode of %s failed (%s), loading with the DICOM plugin' % (loadable.name, e))
+            pluginName = 'DicomRtImportExportPlugin' if request.segmentationKind == RTSTRUCTURE else 'DICOMSegmentationPlugin'
+            plugin = slicer.modules.dicomPlugins[pluginName]()
+            before = set(node.GetID() for node in slicer.util.getNodesByClass('vtkMRMLSegmentationNode'))
+            plugin.load(loadable)
+            # the node the plugin just added, whatever else is in the scene
+            added = [node for node in slicer.util.getNodesByClass('vtkMRMLSegmentationNode') if node.GetID() not in before]
+            return added[0] if added else None
+        from .SegmentationCache import segmentationNodeFromArray, fillSegmentationNode
+        if previewNode is not None:
+            fillSegmentationNode(previewNode, segmentationArray)
+            return previewNode
+        return segmentationNodeFromArray(segmentationArray, slicer.mrmlScene.GenerateUniqueName(loadable.name))
+
+    def _reportProgress(self):
+        if self.onProgress:
+            self.onProgress(len(self.done), len(self.requests), [request.label for request in self.pending])
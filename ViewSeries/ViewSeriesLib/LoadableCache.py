@@ -0,0 +1,92 @@
+# LoadableCache.py
+#
+# Memoized DICOM plugin examineFiles() results.
+#
+# Examining a series with DICOMScalarVolumePlugin or DICOMSegmentationPlugin
+# reads and sorts all of its file headers, which is the expensive part of
+# opening a study. The loadables are cached by plugin and SeriesInstanceUID,
+# together with a fingerprint of the file list they were made from: if files
+# are added to or removed from the series the fingerprint no longer matches
+# and the series is examined again.
+#
+# The cache is a module level singleton (see loadableCache()), so it is kept
+# across study switches and across reloads of the ViewSeries module, which
+# only re-import ViewSeries.py and not this package.
+################################################################################
+
+import collections
+import hashlib
+
+from .Instrumentation import instrumentation
+
+
+def fileListFingerprint(files):
+    """Order independent fingerprint of a list of file names."""
+    digest = hashlib.sha1()
+    for fileName in sorted(files):
+        digest.update(fileName.encode('utf-8', 'surrogateescape'))
+        digest.update(b'\0')
+    return '%d:%s' % (len(files), digest.hexdigest())
+
+
+class LoadableCache(object):
+    """Least recently used cache of examineFiles() results."""
+
+    def __init__(self, maxEntries=512):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()  # (pluginName, seriesUID) -> (fingerprint, loadables)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, pluginName, seriesUID, files):
+        """Cached loadables for the series, or None if missing or out of date."""
+        key = (pluginName, seriesUID)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != fileListFingerprint(files):
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def store(self, pluginName, seriesUID, files, loadables):
+        key = (pluginName, seriesUID)
+        self.entries[key] = (fileListFingerprint(files), loadables)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def examine(self, plugin, seriesUID, files):
+        """plugin.examineFiles(files), examined only once per series and file list."""
+        pluginName = plugin.__class__.__name__
+        loadables = self.lookup(pluginName, seriesUID, files)
+        if loadables is not None:
+            self.hits += 1
+            instrumentation().count('loadables.hit')
+            return loadables
+        self.misses += 1
+        instrumentation().count('loadables.miss')
+        with instrumentation().span('examine.plugin'):
+            loadables = plugin.examineFiles(files)
+        self.store(pluginName, seriesUID, files, loadables)
+        return loadables
+
+    def invalidate(self, seriesUID=None):
+        """Forget one series (all plugins), or everything if no series is given."""
+        if seriesUID is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[1] == seriesUID]:
+            del self.entries[key]
+
+
+_loadableCache = None
+
+
+def loadableCache():
+    """The session wide LoadableCache."""
+    global _loadableCache
+    if _loadableCache is None:
+        _loadableCache = LoadableCache()
+    return _loadableCache
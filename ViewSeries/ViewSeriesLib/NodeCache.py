@@ -0,0 +1,165 @@
+# NodeCache.py
+#
+# Memory-budgeted residency of the volume and segmentation nodes loaded by
+# ViewSeries, keyed by SeriesInstanceUID.
+#
+# Every study used to load fresh nodes and never remove the old ones. The
+# residency manager remembers which node holds which series, so a series that
+# is still in the scene is reused instead of loaded again, and it tracks the
+# voxel memory of every node. When the total goes over the budget the least
+# recently viewed series are removed from the scene, with all of their nodes,
+# never the ones of the study being shown.
+################################################################################
+
+import collections
+import logging
+
+SERIES_UID_ATTRIBUTE = 'ViewSeries.SeriesInstanceUID'
+
+DEFAULT_BUDGET_MB = 4096
+
+
+def nodeMemorySize(node):
+    """Voxel memory of a volume or segmentation node, in bytes."""
+    if node.IsA('vtkMRMLVolumeNode'):
+        imageData = node.GetImageData()
+        return imageData.GetActualMemorySize() * 1024 if imageData else 0
+    if node.IsA('vtkMRMLSegmentationNode'):
+        import slicer
+        segmentation = node.GetSegmentation()
+        representationName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+        counted = set()
+        size = 0
+        for index in range(segmentation.GetNumberOfSegments()):
+            labelmap = segmentation.GetNthSegment(index).GetRepresentation(representationName)
+            # segments can share one labelmap, count it once
+            if labelmap is None or labelmap.GetAddressAsString('') in counted:
+                continue
+            counted.add(labelmap.GetAddressAsString(''))
+            size += labelmap.GetActualMemorySize() * 1024
+        return size
+    return 0
+
+
+class NodeResidencyManager(object):
+    """Least recently viewed cache of MRML nodes, bounded by voxel memory.
+
+    Every node registered for a series is tracked (e.g. the node of a DICOM
+    plugin fallback next to an earlier one), and evicting the series removes
+    them all. Lookups are dictionary lookups: a series that is not
+    registered is looked up in the registry of the nodes shown in the views
+    (see NodeRegistry), and the nodes loaded before this manager existed
+    (e.g. before ViewSeriesLib was reloaded) are adopted from the scene once.
+    """
+
+    def __init__(self, budgetBytes=DEFAULT_BUDGET_MB * 1024 * 1024, registry=None):
+        self.budgetBytes = budgetBytes
+        self.registry = registry
+        self.entries = collections.OrderedDict()  # seriesUID -> {nodeID: bytes}
+        self.keep = set()
+        self.adopted = False
+
+    def __contains__(self, seriesUID):
+        """True if the series is registered (without marking it as viewed)."""
+        return seriesUID in self.entries
+
+    @property
+    def totalBytes(self):
+        return sum(size for nodes in self.entries.values() for size in nodes.values())
+
+    def node(self, seriesUID):
+        """The node holding the series if it is still in the scene, else None
+        (the last one registered when there are several).
+        """
+        import slicer
+        if not self.adopted:
+            self._adoptSceneNodes()
+        nodes = self.entries.get(seriesUID, {})
+        for nodeID in reversed(list(nodes)):
+            node = slicer.mrmlScene.GetNodeByID(nodeID)
+            if node is not None:
+                self.entries.move_to_end(seriesUID)
+                return node
+            del nodes[nodeID]
+        self.entries.pop(seriesUID, None)
+        node = self.registry.node(seriesUID) if self.registry is not None else None
+        if node is None:
+            return None
+        self.add(seriesUID, node)
+        return node
+
+    def _adoptSceneNodes(self):
+        # nodes loaded before this manager existed, found by their series attribute
+        import slicer
+        self.adopted = True
+        for className in ('vtkMRMLScalarVolumeNode', 'vtkMRMLSegmentationNode'):
+            for node in slicer.util.getNodesByClass(className):
+                seriesUID = node.GetAttribute(SERIES_UID_ATTRIBUTE)
+                if seriesUID and node.GetID() not in self.entries.get(seriesUID, {}):
+                    self.entries.setdefault(seriesUID, {})[node.GetID()] = nodeMemorySize(node)
+
+    def add(self, seriesUID, node):
+        """Register a node loaded for the series and enforce the budget."""
+        if not seriesUID or node is None:
+            return
+        node.SetAttribute(SERIES_UID_ATTRIBUTE, seriesUID)
+        nodes = self.entries.setdefault(seriesUID, {})
+        nodes.pop(node.GetID(), None)
+        nodes[node.GetID()] = nodeMemorySize(node)
+        self.entries.move_to_end(seriesUID)
+        self.evict()
+
+    def forget(self, seriesUID, node=None):
+        """Stop tracking one node of the series, or all of them."""
+        if node is None:
+            self.entries.pop(seriesUID, None)
+            return
+        nodes = self.entries.get(seriesUID, {})
+        nodes.pop(node.GetID(), None)
+        if not nodes:
+            self.entries.pop(seriesUID, None)
+
+    def setVisibleSeries(self, seriesUIDs):
+        """Mark the series of the study being shown.
+
+        They are never evicted, and the resident segmentations of other
+        studies are hidden so they do not show up in reused views.
+        """
+        import slicer
+        self.keep = set(uid for uid in seriesUIDs if uid)
+        for seriesUID in list(self.entries):
+            if seriesUID in self.keep:
+                self.entries.move_to_end(seriesUID)
+                continue
+            for nodeID in self.entries[seriesUID]:
+                node = slicer.mrmlScene.GetNodeByID(nodeID)
+                if node is not None and node.IsA('vtkMRMLSegmentationNode') and node.GetDisplayNode():
+                    node.GetDisplayNode().SetVisibility(False)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently viewed series until the budget is met."""
+        import slicer
+        total = self.totalBytes
+        for seriesUID in list(self.entries):
+            if total <= self.budgetBytes:
+                break
+            if seriesUID in self.keep:
+                continue
+            for nodeID, size in self.entries.pop(seriesUID).items():
+                node = slicer.mrmlScene.GetNodeByID(nodeID)
+                if node is not None:
+                    logging.debug('Evicting %s (%d MB)' % (node.GetName(), size // (1024 * 1024)))
+                    slicer.mrmlScene.RemoveNode(node)
+                total -= size
+
+
+_nodeResidency = None
+
+
+def nodeResidency():
+    """The session wide NodeResidencyManager."""
+    global _nodeResidency
+    if _nodeResidency is None:
+        _nodeResidency = NodeResidencyManager()
+    return _nodeResidency
@@ -0,0 +1,50 @@
+# NodeRegistry.py
+#
+# Which node is shown in which view, for the views created by viewerPerSEG.
+#
+# The load path returns the exact nodes it created or reused (see LoadEngine),
+# and they are recorded here by series UID and view name. The views are set up
+# from this registry instead of searching the scene for segmentation nodes, and
+# the residency manager (see NodeCache) finds the nodes of the series shown
+# here without searching the scene either.
+################################################################################
+
+
+class ViewNodeRegistry(object):
+    """seriesUID -> viewName -> (volumeNode, segmentationNode)."""
+
+    def __init__(self):
+        self.entries = {}
+        self.seriesNodes = {}  # seriesUID -> the node holding it
+
+    def register(self, request):
+        """Record the nodes of a loaded LoadRequest, under both of its series."""
+        nodes = (request.volumeNode, request.segmentationNode)
+        for seriesUID, node in ((request.segmentationSeriesUID, request.segmentationNode), (request.volumeSeriesUID, request.volumeNode)):
+            if seriesUID:
+                self.entries.setdefault(seriesUID, {})[request.viewName] = nodes
+                if node is not None:
+                    self.seriesNodes[seriesUID] = node
+
+    def nodes(self, seriesUID, viewName):
+        """(volumeNode, segmentationNode) shown for the series in the view, or (None, None)."""
+        return self.entries.get(seriesUID, {}).get(viewName, (None, None))
+
+    def node(self, seriesUID):
+        """The node that held the series in a view, if it is still in the scene, or None."""
+        import slicer
+        node = self.seriesNodes.get(seriesUID)
+        if node is not None and not slicer.mrmlScene.IsNodePresent(node):
+            del self.seriesNodes[seriesUID]
+            node = None
+        return node
+
+    def viewNames(self, seriesUID):
+        """Views showing the series."""
+        return list(self.entries.get(seriesUID, {}))
+
+    def clear(self):
+        """Forget which node is in which view; the nodes of the series stay
+        known to node() while they are in the scene.
+        """
+        self.entries = {}
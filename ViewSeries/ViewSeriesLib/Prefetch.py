@@ -0,0 +1,201 @@
+# Prefetch.py
+#
+# Background prefetching of the studies the user is likely to open next.
+#
+# While a study is being reviewed, the prefetcher examines the next studies
+# (which fills the LoadableCache) and decodes their master volumes in the
+# worker pool into a DecodedImageCache (and into the on-disk VolumeCache).
+# When one of those studies is then opened, PairLoader takes the decoded
+# volumes from the cache instead of reading the files again. The volumes of
+# the next page of views of the current study can be decoded first.
+#
+# Prefetching is low priority: it advances in small steps (at most one
+# series examined by a DICOM plugin, which has to run on the main thread) for
+# up to sliceMs per timer tick, and when a step takes longer than that the
+# next tick is put off in proportion, so prefetching never takes more than a
+# fraction of the main thread however slow the plugins are. It decodes one
+# series at a time, pauses while a foreground load is running, stops at its
+# memory cap, and is dropped when the user moves elsewhere.
+################################################################################
+
+import collections
+import functools
+import logging
+import time
+
+from .LoadableCache import fileListFingerprint
+from .LoadEngine import workerPool
+from .VolumeCache import readScalarVolume
+from .StudyPipeline import CancellationToken, Cancelled
+
+DEFAULT_PREFETCH_MEMORY_MB = 2048
+
+# yielded by the steps while they wait for a worker: nothing more to do this tick
+_WAITING = 'waiting'
+
+
+class DecodedImageCache(object):
+    """Decoded VolumeArrays waiting to become volume nodes, by series UID."""
+
+    def __init__(self, capBytes=DEFAULT_PREFETCH_MEMORY_MB * 1024 * 1024):
+        self.capBytes = capBytes
+        self.entries = collections.OrderedDict()  # seriesUID -> (fingerprint, volumeArray, bytes)
+        self.totalBytes = 0
+
+    def __contains__(self, seriesUID):
+        return seriesUID in self.entries
+
+    def isFull(self):
+        return self.totalBytes >= self.capBytes
+
+    def put(self, seriesUID, files, volumeArray):
+        """Keep a decoded volume, dropping the oldest ones to stay under the cap."""
+        size = volumeArray.nbytes
+        if size > self.capBytes:
+            return False
+        self.discard(seriesUID)
+        while self.entries and self.totalBytes + size > self.capBytes:
+            self.discard(next(iter(self.entries)))
+        self.entries[seriesUID] = (fileListFingerprint(files), volumeArray, size)
+        self.totalBytes += size
+        return True
+
+    def take(self, seriesUID, files):
+        """Remove and return the volume of the series, if it was decoded from these files."""
+        entry = self.entries.get(seriesUID)
+        if entry is None:
+            return None
+        self.discard(seriesUID)
+        if entry[0] != fileListFingerprint(files):
+            return None
+        return entry[1]
+
+    def discard(self, seriesUID):
+        entry = self.entries.pop(seriesUID, None)
+        if entry is not None:
+            self.totalBytes -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.totalBytes = 0
+
+
+_decodedImages = None
+
+
+def decodedImages():
+    """The session wide DecodedImageCache."""
+    global _decodedImages
+    if _decodedImages is None:
+        _decodedImages = DecodedImageCache()
+    return _decodedImages
+
+
+class StudyPrefetcher(object):
+    """Examines and decodes a queue of studies in the background.
+
+    examineSteps(studyUID, token, plan) is the generator used to plan a study
+    load (see ViewSeriesWidget.examineStudySteps); isForegroundBusy() returns
+    True while prefetching should pause.
+    """
+
+    intervalMs = 100
+    # main thread time per tick; a tick that takes longer puts off the next
+    # ones so that prefetching takes at most 1 / (1 + idleFactor) of the time
+    sliceMs = 10.0
+    idleFactor = 4.0
+
+    def __init__(self, examineSteps, isForegroundBusy, residency=None, images=None, volumeCache=None):
+        self.examineSteps = examineSteps
+        self.isForegroundBusy = isForegroundBusy
+        self.residency = residency
+        self.volumeCache = volumeCache
+        self.images = images if images is not None else decodedImages()
+        self.queue = []
+        self.token = None
+        self.steps = None
+        self.timer = None
+
+    def schedule(self, studyUIDs, volumes=()):
+        """Prefetch these studies, in order, instead of what was queued.
+
+        volumes, (seriesUID, loadable) pairs such as the master volumes of
+        the next page of views, are decoded before the studies.
+        """
+        self.stop()
+        volumes = list(volumes)
+        self.queue = [functools.partial(self._decodeSteps, volumes, label='the next page')] if volumes else []
+        self.queue.extend(functools.partial(self._prefetchSteps, studyUID) for studyUID in studyUIDs)
+        if not self.queue:
+            return
+        if self.timer is None:
+            import qt
+            self.timer = qt.QTimer()
+            self.timer.setInterval(self.intervalMs)
+            self.timer.connect('timeout()', self._tick)
+        self.timer.start()
+
+    def stop(self):
+        self.queue = []
+        if self.token is not None:
+            self.token.cancel()
+        self.token = None
+        self.steps = None
+        if self.timer is not None:
+            self.timer.stop()
+
+    def isRunning(self):
+        return self.steps is not None or bool(self.queue)
+
+    def _tick(self):
+        start = time.perf_counter()
+        elapsedMs = 0.0
+        # small steps until the time slice is used; a step is at most one
+        # series examined or submitted for decoding
+        while elapsedMs < self.sliceMs and not self.isForegroundBusy():
+            if self.steps is None:
+                if not self.queue or self.images.isFull():
+                    self.stop()
+                    return
+                steps = self.queue.pop(0)
+                self.token = CancellationToken()
+                self.steps = steps(self.token)
+            try:
+                waiting = next(self.steps) == _WAITING
+            except (StopIteration, Cancelled):
+                self.steps = None
+                waiting = False
+            except Exception as e:
+                logging.warning('Prefetching failed: %s' % e)
+                self.steps = None
+                waiting = False
+            elapsedMs = (time.perf_counter() - start) * 1000.0
+            if waiting:
+                break
+        # a slow step (e.g. a plugin examining many files) puts off the next tick
+        if self.timer is not None:
+            self.timer.setInterval(int(max(self.intervalMs, self.idleFactor * elapsedMs)))
+
+    def _prefetchSteps(self, studyUID, token):
+        plan = {}
+        yield from self.examineSteps(studyUID, token, plan)
+        yield from self._decodeSteps(zip(plan['masterVolumeSeriesUIDs'], plan['masterVolumeLoadables']), token, 'study ' + studyUID)
+
+    def _decodeSteps(self, volumes, token, label):
+        for seriesUID, loadable in volumes:
+            if seriesUID in self.images or (self.residency is not None and seriesUID in self.residency):
+                continue
+            if self.images.isFull():
+                return
+            # one series at a time, so foreground loads keep the worker pool
+            future = workerPool().submit(readScalarVolume, seriesUID, loadable.files, self.volumeCache)
+            token.onCancel(future.cancel)
+            while not future.done():
+                yield _WAITING
+            token.raiseIfCancelled()
+            volumeArray = future.result()
+            if not volumeArray.isMapped:
+                # volumes found in the disk cache are already quick to load
+                self.images.put(seriesUID, loadable.files, volumeArray)
+            logging.debug('Prefetched %s of %s' % (loadable.name, label))
+            yield
@@ -0,0 +1,193 @@
+# RTStructure.py
+#
+# DICOM RT structure sets (RTSTRUCT) as SegmentationArrays.
+#
+# A structure set has no voxels: each ROI is a list of closed planar contours,
+# polygons in patient (LPS) coordinates on the slices of the image series it
+# references. They are rasterized here on the grid of that series, which is
+# read from the headers of its files (not their pixels), so a structure set
+# can be rasterized while the volume itself is decoded.
+#
+# All the contours are rasterized together instead of one polygon at a time:
+# the points are mapped to IJK with one matrix product, each polygon edge is
+# expanded to the pixel rows it crosses, and each crossing toggles the
+# pixels to its right. A cumulative sum along the rows then fills all the
+# polygons of a chunk of (ROI, slice) frames at once, with the even-odd rule,
+# so inner contours of a ROI are holes. Pixels are inside when their centre
+# is.
+#
+# The result is a SegmentationArray on the grid of the volume, so structure
+# sets are cached (in the SegmentationCache, validated against the files of
+# both series), previewed, shown and measured exactly like SEG objects.
+################################################################################
+
+from .Instrumentation import instrumentation
+from .SegmentationCache import SegmentationArray
+from .VolumeCache import ijkToRASMatrix
+
+# rasterized frames per chunk, in bytes
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def imageSeriesGeometry(files):
+    """((slices, rows, columns), origin, spacing, direction) of a single frame
+    image series, from the headers of its files, as SimpleITK reads it
+    (LPS, slices sorted along the normal of the image plane).
+    """
+    import numpy as np
+    import pydicom
+    positions = []
+    header = None
+    for fileName in files:
+        dataset = pydicom.dcmread(fileName, stop_before_pixels=True,
+                                  specific_tags=['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'Rows', 'Columns', 'SliceThickness'])
+        if 'ImagePositionPatient' not in dataset:
+            continue
+        positions.append([float(v) for v in dataset.ImagePositionPatient])
+        header = dataset
+    if header is None:
+        raise ValueError('No image positions in the source series')
+    orientation = [float(v) for v in header.ImageOrientationPatient]
+    rowDirection = np.array(orientation[:3])
+    columnDirection = np.array(orientation[3:])
+    normal = np.cross(rowDirection, columnDirection)
+    distances = np.array(positions).dot(normal)
+    order = np.argsort(distances)
+    if len(positions) > 1:
+        sliceSpacing = float(distances[order[1]] - distances[order[0]])
+    else:
+        sliceSpacing = float(getattr(header, 'SliceThickness', 0) or 1.0)
+    pixelSpacing = [float(v) for v in header.PixelSpacing]
+    # i runs along the rows (column index), j along the columns (row index)
+    direction = [rowDirection[0], columnDirection[0], normal[0],
+                 rowDirection[1], columnDirection[1], normal[1],
+                 rowDirection[2], columnDirection[2], normal[2]]
+    shape = (len(positions), int(header.Rows), int(header.Columns))
+    return shape, positions[order[0]], [pixelSpacing[1], pixelSpacing[0], sliceSpacing], direction
+
+
+def readContours(files):
+    """(segments, contours) of a structure set: the segments as in
+    SegmentationArray and [(ROI number, (n, 3) LPS points)] of its closed
+    planar contours.
+    """
+    import numpy as np
+    import pydicom
+    segments, contours = [], []
+    for fileName in files:
+        dataset = pydicom.dcmread(fileName)
+        names = dict((int(item.ROINumber), str(item.ROIName)) for item in dataset.get('StructureSetROISequence', []))
+        for item in dataset.get('ROIContourSequence', []):
+            number = int(item.ReferencedROINumber)
+            color = [float(v) / 255.0 for v in item.ROIDisplayColor] if 'ROIDisplayColor' in item else [1.0, 0.0, 0.0]
+            segments.append({'number': number, 'label': names.get(number, 'ROI %d' % number), 'color': color})
+            for contour in item.get('ContourSequence', []):
+                if contour.get('ContourGeometricType', 'CLOSED_PLANAR') != 'CLOSED_PLANAR':
+                    continue
+                points = np.array(contour.ContourData, dtype=np.float64).reshape(-1, 3)
+                if len(points) >= 3:
+                    contours.append((number, points))
+    return segments, contours
+
+
+def rasterizeContours(contours, shape, origin, spacing, direction):
+    """(frames, frameSegments, frameSlices) of the contours on the grid, as
+    in SegmentationArray; only the non-empty frames are kept.
+    """
+    import numpy as np
+    slices, rows, columns = shape
+    frameBytes = (rows * columns + 7) // 8
+    empty = (np.zeros((0, frameBytes), dtype=np.uint8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+    if not contours:
+        return empty
+
+    # all the points to IJK at once
+    lpsToIJK = np.linalg.inv(np.diag([-1.0, -1.0, 1.0, 1.0]).dot(np.array(ijkToRASMatrix(origin, spacing, direction))))
+    pointCounts = np.array([len(points) for number, points in contours])
+    points = np.vstack([points for number, points in contours])
+    ijk = lpsToIJK[:3, :3].dot(points.T) + lpsToIJK[:3, 3:4]
+    pointContours = np.repeat(np.arange(len(contours)), pointCounts)
+
+    # the frame (ROI, slice) of each contour; contours off the grid are dropped
+    contourSlices = np.rint(np.bincount(pointContours, weights=ijk[2]) / pointCounts).astype(np.int64)
+    roiNumbers = np.array([number for number, points in contours], dtype=np.int64)
+    onGrid = (contourSlices >= 0) & (contourSlices < slices)
+    frameKeys, frameOfContour = np.unique((roiNumbers * slices + contourSlices)[onGrid], return_inverse=True)
+    contourFrames = np.full(len(contours), -1, dtype=np.int64)
+    contourFrames[onGrid] = frameOfContour
+    if not len(frameKeys):
+        return empty
+
+    # edges from each point to the next one of its closed contour
+    ends = np.cumsum(pointCounts) - 1
+    nextPoint = np.arange(len(points)) + 1
+    nextPoint[ends] = ends - pointCounts + 1
+    x0, y0 = ijk[0], ijk[1]
+    x1, y1 = x0[nextPoint], y0[nextPoint]
+    edgeFrames = contourFrames[pointContours]
+    keep = (edgeFrames >= 0) & (y0 != y1)
+    x0, y0, x1, y1, edgeFrames = x0[keep], y0[keep], x1[keep], y1[keep], edgeFrames[keep]
+
+    # each edge crosses the pixel rows j with min(y) <= j < max(y)
+    firstRow = np.clip(np.ceil(np.minimum(y0, y1)), 0, rows).astype(np.int64)
+    endRow = np.clip(np.ceil(np.maximum(y0, y1)), 0, rows).astype(np.int64)
+    crossingCounts = endRow - firstRow
+    crossingEdges = np.repeat(np.arange(len(x0)), crossingCounts)
+    crossingRows = firstRow[crossingEdges] + np.arange(len(crossingEdges)) - np.repeat(np.cumsum(crossingCounts) - crossingCounts, crossingCounts)
+    crossingX = x0[crossingEdges] + (crossingRows - y0[crossingEdges]) * (x1 - x0)[crossingEdges] / (y1 - y0)[crossingEdges]
+    # the pixels whose centre is right of the crossing are toggled
+    crossingColumns = np.clip(np.floor(crossingX).astype(np.int64) + 1, 0, columns)
+    crossingFrames = edgeFrames[crossingEdges]
+    order = np.argsort(crossingFrames, kind='stable')
+    crossingFrames, crossingRows, crossingColumns = crossingFrames[order], crossingRows[order], crossingColumns[order]
+
+    frames = []
+    chunkFrames = max(1, CHUNK_BYTES // (rows * (columns + 1)))
+    bounds = np.searchsorted(crossingFrames, np.arange(0, len(frameKeys) + chunkFrames, chunkFrames))
+    for chunk, start in enumerate(range(0, len(frameKeys), chunkFrames)):
+        count = min(chunkFrames, len(frameKeys) - start)
+        toggles = np.zeros((count, rows, columns + 1), dtype=np.uint8)
+        selected = slice(bounds[chunk], bounds[chunk + 1])
+        np.add.at(toggles, (crossingFrames[selected] - start, crossingRows[selected], crossingColumns[selected]), 1)
+        # the parity of the crossings left of each pixel (uint8 wraps, the parity stays)
+        masks = np.cumsum(toggles, axis=2, dtype=np.uint8)[:, :, :columns] & 1
+        frames.append(np.packbits(masks.reshape(count, -1), axis=1))
+    frames = np.concatenate(frames)
+    nonEmpty = frames.any(axis=1)
+    frameKeys = frameKeys[nonEmpty]
+    if not len(frameKeys):
+        return empty
+    return frames[nonEmpty], (frameKeys // slices).astype(np.int32), (frameKeys % slices).astype(np.int32)
+
+
+def decodeRTStructure(files, geometry, referencedSeriesUID=''):
+    """Rasterize the structure set files on the grid of the image series
+    (see imageSeriesGeometry) into a SegmentationArray.
+    """
+    shape, origin, spacing, direction = geometry
+    segments, contours = readContours(files)
+    frames, frameSegments, frameSlices = rasterizeContours(contours, shape, origin, spacing, direction)
+    return SegmentationArray(frames, frameSegments, frameSlices, shape, origin, spacing, direction, segments, referencedSeriesUID)
+
+
+def readRTStructure(seriesUID, files, cache=None, sourceSeriesUID='', sourceFiles=()):
+    """SegmentationArray of an RTSTRUCT series on the grid of its source
+    series, from the cache or rasterized (and then cached). The cache entry
+    depends on the files of both series.
+
+    Runs in the worker threads: no MRML access.
+    """
+    cacheFiles = list(files) + list(sourceFiles)
+    if cache is not None and seriesUID:
+        with instrumentation().span('segmentationCache.read'):
+            segmentationArray = cache.get(seriesUID, cacheFiles)
+        if segmentationArray is not None:
+            return segmentationArray
+    with instrumentation().span('decode.rtstruct'):
+        segmentationArray = decodeRTStructure(files, imageSeriesGeometry(sourceFiles), sourceSeriesUID)
+    instrumentation().count('files.decoded', len(files))
+    instrumentation().count('bytes.decoded', segmentationArray.nbytes)
+    if cache is not None and seriesUID:
+        with instrumentation().span('segmentationCache.write'):
+            cache.put(seriesUID, cacheFiles, segmentationArray)
+    return segmentationArray
@@ -0,0 +1,106 @@
+# RecordLists.py
+#
+# Rows of the patient and study lists, fetched in batches.
+#
+# The lists used to be QListWidgets with one QListWidgetItem per patient,
+# all created up front. A LazyRecordList is only the ordered keys (patient or
+# study UIDs) of the rows plus how many of them the view has fetched so far;
+# the text of a row is read from the DICOMHierarchyIndex when it is drawn.
+# The Qt list model in ViewSeries.py fetches one batch at a time as the view
+# scrolls, and sorting or filtering only changes the list of keys.
+#
+# No Qt here, so the lists can be used (and timed) without the GUI.
+################################################################################
+
+SORT_BY_NAME = 'name'
+SORT_BY_ID = 'patientID'
+SORT_BY_DATE = 'date'
+
+
+class LazyRecordList(object):
+    """Ordered keys of a list view, fetched batchSize rows at a time.
+
+    text(key) is the displayed text of a row, and sortKeys maps a sort
+    name to a function of the key giving the value to sort on.
+    """
+
+    batchSize = 256
+
+    def __init__(self, keys, text, sortKeys=None):
+        self.databaseOrder = list(keys)
+        self.keys = list(keys)
+        self.text = text
+        self.sortKeys = sortKeys or {}
+        self.sortBy = None
+        self.visibleKeys = None
+        self.sortedKeys = list(keys)
+        self.fetched = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, row):
+        return self.keys[row]
+
+    def row(self, key):
+        """Row of the key, or -1."""
+        try:
+            return self.keys.index(key)
+        except ValueError:
+            return -1
+
+    def canFetchMore(self):
+        return self.fetched < len(self.keys)
+
+    def nextBatch(self):
+        """(first, last) rows of the next batch to fetch; last < first if there is none."""
+        return self.fetched, min(len(self.keys), self.fetched + self.batchSize) - 1
+
+    def sort(self, sortBy, descending=False):
+        """Reorder the keys. An unknown sortBy restores the database order."""
+        sortKey = self.sortKeys.get(sortBy)
+        if sortKey is None:
+            self.sortedKeys = list(self.databaseOrder)
+        else:
+            # the sort is stable, so equal values stay in database order
+            self.sortedKeys = sorted(self.databaseOrder, key=sortKey, reverse=descending)
+        self.sortBy = sortBy if sortKey is not None else None
+        self.filter(self.visibleKeys)
+
+    def filter(self, visibleKeys):
+        """Only list the keys in visibleKeys (a set), or all of them if it is None."""
+        self.visibleKeys = visibleKeys
+        if visibleKeys is None:
+            self.keys = list(self.sortedKeys)
+        else:
+            self.keys = [key for key in self.sortedKeys if key in visibleKeys]
+
+
+def patientList(index, sortBy=None):
+    """LazyRecordList of the patients of a DICOMHierarchyIndex."""
+    patientRecords = index.patientRecords
+    studyRecords = index.studyRecords
+
+    def latestStudyDate(patientUID):
+        dates = [studyRecords[studyUID].date for studyUID in patientRecords[patientUID].studyUIDs if studyUID in studyRecords]
+        return max(dates) if dates else ''
+
+    records = LazyRecordList(index.patientOrder,
+                             lambda patientUID: patientRecords[patientUID].name,
+                             {SORT_BY_NAME: lambda patientUID: patientRecords[patientUID].name.lower(),
+                              SORT_BY_ID: lambda patientUID: patientRecords[patientUID].patientID,
+                              SORT_BY_DATE: latestStudyDate})
+    records.sort(sortBy)
+    return records
+
+
+def studyList(index, patientUID, sortBy=None):
+    """LazyRecordList of the studies of one patient of a DICOMHierarchyIndex.
+
+    Studies can only be sorted by date; other sorts keep the database order.
+    """
+    records = LazyRecordList([study.studyUID for study in index.studiesForPatient(patientUID)],
+                             lambda studyUID: studyUID,
+                             {SORT_BY_DATE: lambda studyUID: index.studyRecords[studyUID].date})
+    records.sort(sortBy)
+    return records
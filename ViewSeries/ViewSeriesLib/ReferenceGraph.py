@@ -0,0 +1,191 @@
+# ReferenceGraph.py
+#
+# Database wide graph of the series referenced by SEG and RTSTRUCT series.
+#
+# A SEG used to be matched to its source volume by examining it with
+# DICOMSegmentationPlugin (which reads the whole object) to get its
+# referencedSeriesUID, and then looking that UID up with list.index() among
+# the MR/CT series of the same study, which failed with a ValueError when the
+# source was in another study or not in the database at all.
+#
+# The graph maps each SEG/RTSTRUCT series to the SeriesInstanceUIDs it
+# references, read once from the header of one of its files (without pixel
+# data), plus the reverse map. It is saved as a JSON file in the Slicer cache
+# directory, so later sessions only read the headers of new or changed
+# series. Matching a series to its source is then a dictionary lookup, and a
+# series whose source is not in the database gets a SourceMatch without a
+# source instead of an exception.
+################################################################################
+
+import json
+import logging
+import os
+
+from .Instrumentation import instrumentation
+from .VolumeCache import sourceFingerprint
+
+# modalities whose series reference other series
+REFERENCING_MODALITIES = ('SEG', 'RTSTRUCT')
+
+
+def readReferencedSeries(fileName):
+    """SeriesInstanceUIDs referenced by a SEG or RTSTRUCT file, from its header."""
+    import pydicom
+    dataset = pydicom.dcmread(fileName, stop_before_pixels=True,
+                              specific_tags=['ReferencedSeriesSequence', 'ReferencedFrameOfReferenceSequence'])
+    referenced = []
+    # SEG: ReferencedSeriesSequence
+    for item in dataset.get('ReferencedSeriesSequence', []):
+        if 'SeriesInstanceUID' in item:
+            referenced.append(str(item.SeriesInstanceUID))
+    # RTSTRUCT: ReferencedFrameOfReferenceSequence > RTReferencedStudySequence > RTReferencedSeriesSequence
+    for frameOfReference in dataset.get('ReferencedFrameOfReferenceSequence', []):
+        for study in frameOfReference.get('RTReferencedStudySequence', []):
+            for item in study.get('RTReferencedSeriesSequence', []):
+                if 'SeriesInstanceUID' in item:
+                    referenced.append(str(item.SeriesInstanceUID))
+    # keep the order, without duplicates
+    return list(dict.fromkeys(referenced))
+
+
+class SourceMatch(object):
+    """The source series chosen for a referencing series.
+
+    sourceSeriesUID is '' when none of referencedSeriesUIDs is available.
+    """
+
+    def __init__(self, seriesUID, sourceSeriesUID='', referencedSeriesUIDs=()):
+        self.seriesUID = seriesUID
+        self.sourceSeriesUID = sourceSeriesUID
+        self.referencedSeriesUIDs = list(referencedSeriesUIDs)
+
+    @property
+    def isMissing(self):
+        return not self.sourceSeriesUID
+
+
+class ReferenceGraph(object):
+    """Referencing series -> referenced series, and back, saved to path."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}  # seriesUID -> (fingerprint, [referenced seriesUIDs])
+        self.referencing = {}  # referenced seriesUID -> set of referencing seriesUIDs
+        self.dirty = False
+        self.headerReads = 0
+        if path:
+            self.load()
+
+    def __contains__(self, seriesUID):
+        return seriesUID in self.entries
+
+    def load(self):
+        try:
+            with open(self.path) as graphFile:
+                entries = json.load(graphFile)
+        except (OSError, ValueError):
+            return
+        for seriesUID, (fingerprint, referenced) in entries.items():
+            self._set(seriesUID, fingerprint, referenced)
+        self.dirty = False
+
+    def save(self):
+        """Write the graph if it changed. Failures are logged, not raised."""
+        if not self.path or not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as graphFile:
+                json.dump(self.entries, graphFile)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logging.warning('Could not save the referenced series graph: %s' % e)
+            return
+        self.dirty = False
+
+    def _set(self, seriesUID, fingerprint, referenced):
+        self.discard(seriesUID)
+        self.entries[seriesUID] = (fingerprint, list(referenced))
+        for referencedUID in referenced:
+            self.referencing.setdefault(referencedUID, set()).add(seriesUID)
+        self.dirty = True
+
+    def discard(self, seriesUID):
+        entry = self.entries.pop(seriesUID, None)
+        if entry is None:
+            return
+        for referencedUID in entry[1]:
+            self.referencing.get(referencedUID, set()).discard(seriesUID)
+        self.dirty = True
+
+    def references(self, seriesUID, fileName):
+        """Series referenced by seriesUID, read from the header of fileName
+        unless the graph already has them for the current version of the file.
+        """
+        fingerprint = sourceFingerprint([fileName]) if fileName else None
+        entry = self.entries.get(seriesUID)
+        if entry is not None and (fingerprint is None or entry[0] == fingerprint):
+            return entry[1]
+        if fingerprint is None:
+            return []
+        try:
+            referenced = readReferencedSeries(fileName)
+        except Exception as e:
+            logging.warning('Could not read the references of %s: %s' % (seriesUID, e))
+            referenced = []
+        self.headerReads += 1
+        instrumentation().count('headers.references')
+        self._set(seriesUID, fingerprint, referenced)
+        return referenced
+
+    def referencingSeries(self, seriesUID):
+        """Series (SEG, RTSTRUCT) that reference seriesUID."""
+        return set(self.referencing.get(seriesUID, ()))
+
+    def matchSource(self, seriesUID, fileName, isSource, preferred=()):
+        """SourceMatch of a referencing series.
+
+        isSource(seriesUID) tells whether a referenced series can be used as
+        the source (e.g. it is an MR or CT series in the database). Referenced
+        series in preferred (e.g. the series of the same study) are chosen
+        first.
+        """
+        referenced = self.references(seriesUID, fileName)
+        candidates = [uid for uid in referenced if uid in preferred] + [uid for uid in referenced if uid not in preferred]
+        for candidate in candidates:
+            if isSource(candidate):
+                return SourceMatch(seriesUID, candidate, referenced)
+        return SourceMatch(seriesUID, '', referenced)
+
+    def updateSteps(self, index, chunkSize=50, saveEvery=500):
+        """Read the references of all the SEG/RTSTRUCT series of a
+        DICOMHierarchyIndex that are not in the graph yet, yielding the number
+        of series checked after every chunkSize of them, and save the graph.
+        """
+        checked = 0
+        savedReads = self.headerReads
+        for series in list(index.seriesRecords.values()):
+            if series.modality not in REFERENCING_MODALITIES:
+                continue
+            self.references(series.seriesUID, series.representativeFile)
+            checked += 1
+            if self.headerReads - savedReads >= saveEvery:
+                # saved as it goes, so an interrupted update is not lost
+                savedReads = self.headerReads
+                self.save()
+            if checked % chunkSize == 0:
+                yield checked
+        self.save()
+        yield checked
+
+
+_referenceGraph = None
+
+
+def referenceGraph():
+    """The ReferenceGraph saved in the Slicer cache directory."""
+    global _referenceGraph
+    if _referenceGraph is None:
+        import slicer
+        _referenceGraph = ReferenceGraph(os.path.join(slicer.app.cachePath, 'ViewSeries', 'references.json'))
+    return _referenceGraph
@@ -0,0 +1,139 @@
+# SQLiteDatabase.py
+#
+# Read access to a ctkDICOMDatabase file (ctkDICOM.sql) without Slicer.
+#
+# ViewSeries only needs a handful of ctkDICOMDatabase queries (see
+# StudyBrowser); here they are run with sqlite3 on the database file, so the
+# data side of the module can be used by plain Python processes: the batch
+# cache warming (see CacheWarming) and the benchmarks. The tag cache is a
+# separate file next to the database (ctkDICOMTagCache.sql), attached when it
+# exists; otherwise the tags read are only cached for the session.
+#
+# File names stored relative to the database directory are returned as
+# absolute paths, as ctkDICOMDatabase does.
+#
+# Opened read-only, it also gives the batched queries (instancesForFiles,
+# cachedTags) on the file of the ctkDICOMDatabase Slicer has open, which
+# only answers one file or one tag per call (see TagFetch).
+################################################################################
+
+import os
+import pathlib
+import sqlite3
+
+
+class SQLiteDICOMDatabase(object):
+    """The parts of ctkDICOMDatabase used by ViewSeries, on an sqlite file."""
+
+    schema = """
+        CREATE TABLE Patients (UID INTEGER PRIMARY KEY, PatientsName TEXT, PatientID TEXT);
+        CREATE TABLE Studies (StudyInstanceUID TEXT PRIMARY KEY, PatientsUID INTEGER, StudyDate TEXT, StudyDescription TEXT);
+        CREATE TABLE Series (SeriesInstanceUID TEXT PRIMARY KEY, StudyInstanceUID TEXT, Modality TEXT, SeriesDescription TEXT, SeriesNumber TEXT);
+        CREATE TABLE Images (SOPInstanceUID TEXT PRIMARY KEY, Filename TEXT, SeriesInstanceUID TEXT);
+        CREATE TABLE TagCache (SOPInstanceUID TEXT, Tag TEXT, Value TEXT, PRIMARY KEY (SOPInstanceUID, Tag));
+        CREATE INDEX StudiesPatientIndex ON Studies (PatientsUID);
+        CREATE INDEX SeriesStudyIndex ON Series (StudyInstanceUID);
+        CREATE INDEX ImagesSeriesIndex ON Images (SeriesInstanceUID);
+        CREATE INDEX ImagesFilenameIndex ON Images (Filename);
+        """
+
+    tagCacheFileName = 'ctkDICOMTagCache.sql'
+
+    # bound variables per query (SQLITE_MAX_VARIABLE_NUMBER of older sqlite)
+    maxQueryParameters = 900
+
+    def __init__(self, path, tagCachePath=None, readOnly=False):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.readOnly = readOnly
+        self.connection = sqlite3.connect(self._uri(path), uri=True)
+        tables = self._column("SELECT name FROM sqlite_master WHERE type = 'table'")
+        if 'TagCache' not in tables:
+            tagCachePath = tagCachePath or os.path.join(self.directory, self.tagCacheFileName)
+            if os.path.exists(tagCachePath):
+                self.connection.execute('ATTACH DATABASE ? AS tags', (self._uri(tagCachePath),))
+            else:
+                self.connection.execute('CREATE TEMP TABLE TagCache (SOPInstanceUID TEXT, Tag TEXT, Value TEXT, PRIMARY KEY (SOPInstanceUID, Tag))')
+
+    def _uri(self, path):
+        return pathlib.Path(os.path.abspath(path)).as_uri() + ('?mode=ro' if self.readOnly else '')
+
+    def close(self):
+        self.connection.close()
+
+    def _column(self, query, *args):
+        return [row[0] for row in self.connection.execute(query, args)]
+
+    def _value(self, query, *args):
+        row = self.connection.execute(query, args).fetchone()
+        return '' if row is None or row[0] is None else str(row[0])
+
+    def patients(self):
+        return [str(uid) for uid in self._column('SELECT UID FROM Patients ORDER BY UID')]
+
+    def studiesForPatient(self, patientUID):
+        return self._column('SELECT StudyInstanceUID FROM Studies WHERE PatientsUID = ? ORDER BY rowid', int(patientUID))
+
+    def seriesForStudy(self, studyUID):
+        return self._column('SELECT SeriesInstanceUID FROM Series WHERE StudyInstanceUID = ? ORDER BY rowid', studyUID)
+
+    def filesForSeries(self, seriesUID, hits=-1):
+        return [os.path.join(self.directory, fileName) for fileName in
+                self._column('SELECT Filename FROM Images WHERE SeriesInstanceUID = ? ORDER BY rowid LIMIT ?', seriesUID, hits)]
+
+    def fieldForPatient(self, field, patientUID):
+        return self._value('SELECT %s FROM Patients WHERE UID = ?' % field, int(patientUID))
+
+    def fieldForStudy(self, field, studyUID):
+        return self._value('SELECT %s FROM Studies WHERE StudyInstanceUID = ?' % field, studyUID)
+
+    def fieldForSeries(self, field, seriesUID):
+        return self._value('SELECT %s FROM Series WHERE SeriesInstanceUID = ?' % field, seriesUID)
+
+    def studyForSeries(self, seriesUID):
+        return self.fieldForSeries('StudyInstanceUID', seriesUID)
+
+    def patientForStudy(self, studyUID):
+        return self.fieldForStudy('PatientsUID', studyUID)
+
+    def instanceForFile(self, fileName):
+        instanceUID = self._value('SELECT SOPInstanceUID FROM Images WHERE Filename = ?', fileName)
+        if not instanceUID and fileName.startswith(self.directory + os.sep):
+            instanceUID = self._value('SELECT SOPInstanceUID FROM Images WHERE Filename = ?', os.path.relpath(fileName, self.directory))
+        return instanceUID
+
+    def cachedTag(self, instanceUID, tag):
+        return self._value('SELECT Value FROM TagCache WHERE SOPInstanceUID = ? AND Tag = ?', instanceUID, tag)
+
+    def instancesForFiles(self, fileNames):
+        """{fileName: SOPInstanceUID} of many files, in one query."""
+        relativeNames = dict((os.path.relpath(fileName, self.directory) if fileName.startswith(self.directory + os.sep) else fileName, fileName)
+                             for fileName in fileNames)
+        names = list(set(fileNames) | set(relativeNames))
+        instances = dict((fileName, '') for fileName in fileNames)
+        for start in range(0, len(names), self.maxQueryParameters):
+            chunk = names[start:start + self.maxQueryParameters]
+            query = 'SELECT Filename, SOPInstanceUID FROM Images WHERE Filename IN (%s)' % ','.join('?' * len(chunk))
+            for fileName, instanceUID in self.connection.execute(query, chunk):
+                instances[relativeNames.get(fileName, fileName)] = instanceUID or ''
+        return instances
+
+    def cachedTags(self, requests):
+        """{(SOPInstanceUID, tag): value} of many (SOPInstanceUID, tag) pairs, in one query."""
+        requests = list(requests)
+        values = dict((request, '') for request in requests)
+        instanceUIDs = list(set(instanceUID for instanceUID, tag in requests))
+        tags = list(set(tag for instanceUID, tag in requests))
+        chunkSize = max(1, self.maxQueryParameters - len(tags))
+        for start in range(0, len(instanceUIDs), chunkSize):
+            chunk = instanceUIDs[start:start + chunkSize]
+            query = 'SELECT SOPInstanceUID, Tag, Value FROM TagCache WHERE SOPInstanceUID IN (%s) AND Tag IN (%s)' % (
+                ','.join('?' * len(chunk)), ','.join('?' * len(tags)))
+            for instanceUID, tag, value in self.connection.execute(query, chunk + tags):
+                if (instanceUID, tag) in values:
+                    values[(instanceUID, tag)] = '' if value is None else str(value)
+        return values
+
+    def cacheTags(self, instanceUIDs, tags, values):
+        self.connection.executemany('INSERT OR REPLACE INTO TagCache VALUES (?, ?, ?)', zip(instanceUIDs, tags, values))
+        self.connection.commit()
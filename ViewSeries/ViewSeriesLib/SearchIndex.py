@@ -0,0 +1,234 @@
+# SearchIndex.py
+#
+# In-memory search index over the patients, studies and series of a
+# DICOMHierarchyIndex, for filtering the patient and study lists as the user
+# types.
+#
+# - patient names and IDs: a sorted list of their words for prefix lookups,
+#   and a trigram -> patients map for substring lookups,
+# - study dates and series descriptions: sorted lists for range and prefix
+#   lookups by bisection,
+# - modalities: modality -> studies map (so "has segmentation" is the union
+#   of the SEG and RTSTRUCT entries).
+#
+# A query combines these with set intersections, so it does not depend on
+# walking all the patients. The index follows the hierarchy index: it is an
+# observer of it and re-indexes a patient whenever that patient is added,
+# re-read or removed.
+################################################################################
+
+import bisect
+
+# sorts after any string value, for the upper end of a range
+_MAX = '\U0010ffff'
+
+# modalities of the series a study "has segmentation" with
+SEGMENTATION_MODALITIES = ('SEG', 'RTSTRUCT')
+
+
+def normalize(text):
+    """Lower case, with the DICOM name separators as spaces."""
+    return ' '.join((text or '').replace('^', ' ').lower().split())
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class SortedIndex(object):
+    """Sorted (value, uid) pairs, for prefix and range lookups."""
+
+    def __init__(self, pairs=()):
+        self.entries = sorted(pairs)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, value, uid):
+        bisect.insort(self.entries, (value, uid))
+
+    def remove(self, value, uid):
+        position = bisect.bisect_left(self.entries, (value, uid))
+        if position < len(self.entries) and self.entries[position] == (value, uid):
+            del self.entries[position]
+
+    def range(self, low='', high=''):
+        """uids with low <= value <= high; an empty bound is open."""
+        start = bisect.bisect_left(self.entries, (low,)) if low else 0
+        end = bisect.bisect_right(self.entries, (high, _MAX)) if high else len(self.entries)
+        return [uid for value, uid in self.entries[start:end]]
+
+    def prefix(self, prefix):
+        """uids whose value starts with prefix."""
+        start = bisect.bisect_left(self.entries, (prefix,))
+        end = bisect.bisect_left(self.entries, (prefix + _MAX,))
+        return [uid for value, uid in self.entries[start:end]]
+
+
+class SearchResult(object):
+    """UIDs of the patients and studies matching a query.
+
+    None means no filter applies at that level (everything matches).
+    """
+
+    def __init__(self, patientUIDs=None, studyUIDs=None):
+        self.patientUIDs = patientUIDs
+        self.studyUIDs = studyUIDs
+
+
+class PatientSearchIndex(object):
+    """Name/ID, date, modality and series description index of the patients."""
+
+    def __init__(self, index):
+        self.index = index
+        self.words = SortedIndex()  # (name or ID word, patientUID)
+        self.trigrams = {}  # trigram -> set of patientUIDs
+        self.studyDates = SortedIndex()  # (StudyDate, studyUID)
+        self.seriesDescriptions = SortedIndex()  # (normalized description, studyUID)
+        self.modalities = {}  # modality -> set of studyUIDs
+        self.texts = {}  # patientUID -> normalized 'name id'
+        self.contents = {}  # patientUID -> what was indexed for it, to remove it again
+
+    def build(self):
+        """Index all the patients of the hierarchy index, and follow its changes."""
+        for patientCount in self.buildSteps():
+            pass
+
+    def buildSteps(self, chunkSize=100):
+        """build() as a generator, yielding the number of patients indexed so
+        far after every chunkSize patients.
+
+        The index follows the changes of the hierarchy index from the start,
+        so patients changed while it is being built are indexed correctly.
+        """
+        self.words = SortedIndex()
+        self.studyDates = SortedIndex()
+        self.seriesDescriptions = SortedIndex()
+        self.trigrams = {}
+        self.modalities = {}
+        self.texts = {}
+        self.contents = {}
+        if self.patientChanged not in self.index.observers:
+            self.index.observers.append(self.patientChanged)
+        for patientCount, patientUID in enumerate(list(self.index.patientOrder), 1):
+            if patientUID not in self.contents and patientUID in self.index.patientRecords:
+                self._addSets(patientUID, self._content(patientUID))
+            if patientCount % chunkSize == 0:
+                yield patientCount
+        # sorted once, instead of one insertion per entry
+        contents = list(self.contents.values())
+        self.words = SortedIndex(entry for content in contents for entry in content['words'])
+        self.studyDates = SortedIndex(entry for content in contents for entry in content['dates'])
+        self.seriesDescriptions = SortedIndex(entry for content in contents for entry in content['descriptions'])
+        yield len(self.contents)
+
+    def _content(self, patientUID):
+        patient = self.index.patientRecords[patientUID]
+        name, patientID = normalize(patient.name), normalize(patient.patientID)
+        text = name + ' ' + patientID
+        content = {'text': text,
+                   'words': [(word, patientUID) for word in set(text.split())],
+                   'trigrams': trigrams(name) | trigrams(patientID),
+                   'dates': [], 'descriptions': [], 'modalities': []}
+        for studyUID in patient.studyUIDs:
+            study = self.index.studyRecords.get(studyUID)
+            if study is None:
+                continue
+            content['dates'].append((study.date, studyUID))
+            for seriesUID in study.seriesUIDs:
+                series = self.index.seriesRecords.get(seriesUID)
+                if series is None:
+                    continue
+                content['modalities'].append((series.modality, studyUID))
+                if series.description:
+                    content['descriptions'].append((normalize(series.description), studyUID))
+        return content
+
+    def _addSets(self, patientUID, content):
+        self.texts[patientUID] = content['text']
+        self.contents[patientUID] = content
+        for gram in content['trigrams']:
+            self.trigrams.setdefault(gram, set()).add(patientUID)
+        for modality, studyUID in content['modalities']:
+            self.modalities.setdefault(modality, set()).add(studyUID)
+
+    def patientChanged(self, patientUID):
+        """Observer of the hierarchy index: re-index one patient."""
+        content = self.contents.pop(patientUID, None)
+        if content is not None:
+            self.texts.pop(patientUID, None)
+            for entry in content['words']:
+                self.words.remove(*entry)
+            for entry in content['dates']:
+                self.studyDates.remove(*entry)
+            for entry in content['descriptions']:
+                self.seriesDescriptions.remove(*entry)
+            for gram in content['trigrams']:
+                self.trigrams.get(gram, set()).discard(patientUID)
+            for modality, studyUID in content['modalities']:
+                self.modalities.get(modality, set()).discard(studyUID)
+        if patientUID not in self.index.patientRecords:
+            return
+        content = self._content(patientUID)
+        for entry in content['words']:
+            self.words.add(*entry)
+        for entry in content['dates']:
+            self.studyDates.add(*entry)
+        for entry in content['descriptions']:
+            self.seriesDescriptions.add(*entry)
+        self._addSets(patientUID, content)
+
+    def modalityNames(self):
+        return sorted(modality for modality, studyUIDs in self.modalities.items() if modality and studyUIDs)
+
+    def matchText(self, text):
+        """Patients whose name or ID has a word starting with text, or contains it."""
+        query = normalize(text)
+        if not query:
+            return None
+        queryWords = query.split()
+        # every word of the query must start a word of the name or ID
+        patientUIDs = None
+        for word in queryWords:
+            matches = set(self.words.prefix(word))
+            patientUIDs = matches if patientUIDs is None else patientUIDs & matches
+        # or the whole query appears somewhere inside the name or ID; only the
+        # patients not matched above need to be checked, and the trigram sets
+        # are intersected smallest first
+        gramSets = sorted((self.trigrams.get(gram, set()) for gram in trigrams(query)), key=len)
+        if gramSets:
+            candidates = gramSets[0] - patientUIDs
+            for gramSet in gramSets[1:]:
+                if not candidates:
+                    break
+                candidates &= gramSet
+            patientUIDs.update(patientUID for patientUID in candidates if query in self.texts[patientUID])
+        return patientUIDs
+
+    def search(self, text='', modality='', hasSegmentation=False, dateFrom='', dateTo='', seriesDescription=''):
+        """SearchResult of the patients and studies matching all the given filters.
+
+        Dates are DICOM dates (YYYYMMDD), seriesDescription is a prefix of
+        the description of one of the series of the study, and
+        hasSegmentation keeps the studies with a SEG or RTSTRUCT series.
+        """
+        studyUIDs = None
+
+        def restrict(matches):
+            return set(matches) if studyUIDs is None else studyUIDs & set(matches)
+
+        if modality:
+            studyUIDs = restrict(self.modalities.get(modality, ()))
+        if hasSegmentation:
+            studyUIDs = restrict(set().union(*[self.modalities.get(name, ()) for name in SEGMENTATION_MODALITIES]))
+        if dateFrom or dateTo:
+            studyUIDs = restrict(self.studyDates.range(dateFrom, dateTo))
+        if normalize(seriesDescription):
+            studyUIDs = restrict(self.seriesDescriptions.prefix(normalize(seriesDescription)))
+
+        patientUIDs = self.matchText(text)
+        if studyUIDs is not None:
+            studyRecords = self.index.studyRecords
+            studyPatients = set(studyRecords[studyUID].patientUID for studyUID in studyUIDs if studyUID in studyRecords)
+            patientUIDs = studyPatients if patientUIDs is None else patientUIDs & studyPatients
+        return SearchResult(patientUIDs, studyUIDs)
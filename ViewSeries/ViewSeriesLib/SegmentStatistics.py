@@ -0,0 +1,226 @@
+# SegmentStatistics.py
+#
+# Per-segment voxel count, volume and intensity statistics (mean, min and max
+# of the source volume) of a SEG/volume pair, computed in one vectorized pass.
+#
+# Segment Statistics works one segment at a time on the segmentation node.
+# Here the bit-packed frames of the SegmentationArray are unpacked a chunk at
+# a time, the voxels of all the segments are gathered with one nonzero(), and
+# the per-segment counts and sums are np.bincount reductions (min and max are
+# reduceat over the voxels, which come sorted by segment). Segments may
+# overlap: a voxel in two segments counts for both. When the segmentation
+# grid is not the grid of the volume, each segment voxel takes the nearest
+# volume voxel.
+#
+# The results are small, so they are kept in memory and in one .json file
+# per (SEG series UID, source series UID), validated against the files of
+# both series like the VolumeCache. Nothing here touches MRML, so the
+# statistics are computed in the worker threads while the study loads.
+################################################################################
+
+import hashlib
+import json
+import logging
+import os
+
+from .Instrumentation import instrumentation
+from .VolumeCache import sourceFingerprint
+
+# unpacked frames per chunk, in bytes
+CHUNK_BYTES = 32 * 1024 * 1024
+
+
+def _ijkToLPS(origin, spacing, direction):
+    import numpy as np
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.array(direction, dtype=np.float64).reshape(3, 3) * np.array(spacing, dtype=np.float64)
+    matrix[:3, 3] = origin
+    return matrix
+
+
+def segmentStatistics(segmentationArray, volumeArray):
+    """[{'number', 'label', 'voxels', 'volumeMl', 'mean', 'min', 'max'}], one
+    per segment of segmentationArray, with the intensities of volumeArray
+    (None for a segment that has no voxel inside the volume).
+    """
+    import numpy as np
+    segments = segmentationArray.segments
+    slices, rows, columns = segmentationArray.shape
+    frameSize = rows * columns
+    segmentCount = len(segments)
+
+    # segment number -> row of the result
+    numbers = np.array([segment['number'] for segment in segments], dtype=np.int64)
+    frameSegments = np.asarray(segmentationArray.frameSegments, dtype=np.int64)
+    lookup = np.full(int(max(numbers.max(initial=0), frameSegments.max(initial=0))) + 1, -1, dtype=np.int64)
+    lookup[numbers] = np.arange(segmentCount)
+    frameRows = lookup[frameSegments]
+    known = frameRows >= 0
+    # one frame per (segment, slice), sorted by segment; frames of the same
+    # segment and slice are merged
+    keys = frameRows[known] * slices + np.asarray(segmentationArray.frameSlices, dtype=np.int64)[known]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    frames = segmentationArray.frames[known]
+    if len(keys) < len(frames):
+        merged = np.zeros((len(keys), frames.shape[1]), dtype=np.uint8)
+        np.bitwise_or.at(merged, inverse, frames)
+        frames = merged
+    else:
+        frames = frames[np.argsort(inverse)]
+    frameRows, frameSlices = keys // slices, keys % slices
+
+    voxels = np.asarray(volumeArray.voxels)
+    segmentationToLPS = _ijkToLPS(segmentationArray.origin, segmentationArray.spacing, segmentationArray.direction)
+    volumeToLPS = _ijkToLPS(volumeArray.origin, volumeArray.spacing, volumeArray.direction)
+    sameGrid = voxels.shape == (slices, rows, columns) and np.allclose(segmentationToLPS, volumeToLPS, atol=1e-3)
+    if sameGrid:
+        flatVoxels = voxels.reshape(-1)
+    else:
+        segmentationToVolume = np.linalg.inv(volumeToLPS).dot(segmentationToLPS)
+        volumeSize = np.array(voxels.shape[::-1]).reshape(3, 1)
+
+    counts = np.zeros(segmentCount, dtype=np.int64)
+    sampled = np.zeros(segmentCount, dtype=np.int64)
+    sums = np.zeros(segmentCount, dtype=np.float64)
+    minima = np.full(segmentCount, np.inf)
+    maxima = np.full(segmentCount, -np.inf)
+    chunkFrames = max(1, CHUNK_BYTES // max(1, frameSize))
+    for start in range(0, len(frames), chunkFrames):
+        masks = np.unpackbits(frames[start:start + chunkFrames], axis=1, count=frameSize)
+        frameIndex, pixelIndex = np.nonzero(masks)
+        segmentRows = frameRows[start:start + chunkFrames][frameIndex]
+        sliceIndex = frameSlices[start:start + chunkFrames][frameIndex]
+        counts += np.bincount(segmentRows, minlength=segmentCount)
+        if sameGrid:
+            values = flatVoxels[sliceIndex * frameSize + pixelIndex]
+        else:
+            ijk = np.stack([pixelIndex % columns, pixelIndex // columns, sliceIndex]).astype(np.float64)
+            volumeIJK = np.rint(segmentationToVolume[:3, :3].dot(ijk) + segmentationToVolume[:3, 3:4]).astype(np.int64)
+            inside = np.all((volumeIJK >= 0) & (volumeIJK < volumeSize), axis=0)
+            i, j, k = volumeIJK[:, inside]
+            values = voxels[k, j, i]
+            segmentRows = segmentRows[inside]
+        if not len(values):
+            continue
+        values = values.astype(np.float64)
+        sampled += np.bincount(segmentRows, minlength=segmentCount)
+        sums += np.bincount(segmentRows, weights=values, minlength=segmentCount)
+        # the voxels come sorted by segment: one run per segment
+        starts = np.flatnonzero(np.r_[True, segmentRows[1:] != segmentRows[:-1]])
+        runRows = segmentRows[starts]
+        minima[runRows] = np.minimum(minima[runRows], np.minimum.reduceat(values, starts))
+        maxima[runRows] = np.maximum(maxima[runRows], np.maximum.reduceat(values, starts))
+
+    voxelVolumeMl = float(np.prod(segmentationArray.spacing)) / 1000.0
+    statistics = []
+    for row, segment in enumerate(segments):
+        hasValues = sampled[row] > 0
+        statistics.append({'number': segment['number'], 'label': segment['label'],
+                           'voxels': int(counts[row]), 'volumeMl': float(counts[row] * voxelVolumeMl),
+                           'mean': float(sums[row] / sampled[row]) if hasValues else None,
+                           'min': float(minima[row]) if hasValues else None,
+                           'max': float(maxima[row]) if hasValues else None})
+    return statistics
+
+
+class SegmentStatisticsCache(object):
+    """Segment statistics by (SEG series UID, source series UID), in memory
+    and in a directory of .json files.
+    """
+
+    counterName = 'statisticsCache'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}  # (segmentationSeriesUID, sourceSeriesUID) -> (fingerprint, statistics)
+
+    def _path(self, segmentationSeriesUID, sourceSeriesUID):
+        key = hashlib.sha1(('%s\0%s' % (segmentationSeriesUID, sourceSeriesUID)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, segmentationSeriesUID, sourceSeriesUID, files):
+        """The statistics of the pair if they are up to date with files, or None."""
+        fingerprint = sourceFingerprint(files)
+        key = (segmentationSeriesUID, sourceSeriesUID)
+        entry = self.entries.get(key)
+        if entry is None:
+            try:
+                with open(self._path(*key)) as entryFile:
+                    metadata = json.load(entryFile)
+                entry = (metadata['fingerprint'], metadata['statistics'])
+            except (OSError, ValueError, KeyError):
+                entry = None
+        if entry is None or fingerprint is None or entry[0] != fingerprint:
+            instrumentation().count(self.counterName + '.miss')
+            return None
+        self.entries[key] = entry
+        instrumentation().count(self.counterName + '.hit')
+        return entry[1]
+
+    def put(self, segmentationSeriesUID, sourceSeriesUID, files, statistics):
+        """Store the statistics of a pair. Failures are logged, not raised."""
+        fingerprint = sourceFingerprint(files)
+        if fingerprint is None:
+            return
+        key = (segmentationSeriesUID, sourceSeriesUID)
+        self.entries[key] = (fingerprint, statistics)
+        path = self._path(*key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as entryFile:
+                json.dump({'segmentationSeriesUID': segmentationSeriesUID, 'sourceSeriesUID': sourceSeriesUID,
+                           'fingerprint': fingerprint, 'statistics': statistics}, entryFile)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logging.warning('Could not write the segment statistics of %s: %s' % (segmentationSeriesUID, e))
+
+    def clear(self):
+        self.entries = {}
+        if not os.path.isdir(self.directory):
+            return
+        for fileName in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, fileName))
+            except OSError:
+                pass
+
+
+def readSegmentStatistics(segmentationSeriesUID, segmentationFiles, sourceSeriesUID, sourceFiles, cache=None,
+                          segmentationArray=None, volumeArray=None, segmentationCache=None, volumeCache=None,
+                          segmentationReader=None):
+    """Statistics of a SEG/volume pair, from the cache or computed (and then cached).
+
+    The arrays are read from their caches (or decoded) when not given; the
+    segmentation with segmentationReader(seriesUID, files, cache), by
+    default readSegmentation.
+    Runs in the worker threads: no MRML access.
+    """
+    files = list(segmentationFiles) + list(sourceFiles)
+    if cache is not None:
+        statistics = cache.get(segmentationSeriesUID, sourceSeriesUID, files)
+        if statistics is not None:
+            return statistics
+    if segmentationArray is None:
+        if segmentationReader is None:
+            from .SegmentationCache import readSegmentation as segmentationReader
+        segmentationArray = segmentationReader(segmentationSeriesUID, segmentationFiles, segmentationCache)
+    if volumeArray is None:
+        from .VolumeCache import readScalarVolume
+        volumeArray = readScalarVolume(sourceSeriesUID, sourceFiles, volumeCache)
+    with instrumentation().span('statistics'):
+        statistics = segmentStatistics(segmentationArray, volumeArray)
+    if cache is not None:
+        cache.put(segmentationSeriesUID, sourceSeriesUID, files, statistics)
+    return statistics
+
+
+_segmentStatisticsCache = None
+
+
+def segmentStatisticsCache():
+    """The SegmentStatisticsCache in the Slicer cache directory."""
+    global _segmentStatisticsCache
+    if _segmentStatisticsCache is None:
+        import slicer
+        _segmentStatisticsCache = SegmentStatisticsCache(os.path.join(slicer.app.cachePath, 'ViewSeries', 'statistics'))
+    return _segmentStatisticsCache
@@ -0,0 +1,313 @@
+# SegmentationCache.py
+#
+# Compact cache of decoded DICOM segmentation (SEG) objects.
+#
+# DICOMSegmentationPlugin.load() converts the whole SEG object every time it
+# is loaded. Here the frames of a SEG are decoded once with pydicom into a
+# SegmentationArray: the non-empty frames are kept bit-packed, with the
+# segment and slice each frame belongs to, plus the geometry of the frame
+# grid and the segment metadata (number, label, color and the referenced
+# series UID). Entries are stored as compressed .npz files, which for sparse
+# masks are much smaller than the original SEG, with the metadata in a .json
+# file validated against the source files like the VolumeCache.
+#
+# Decoding and reading entries does not touch MRML, so it can be done in the
+# worker threads; segmentationNodeFromArray() builds the segmentation node on
+# the main thread directly from the cached labelmaps.
+################################################################################
+
+import json
+import logging
+import os
+
+from .Instrumentation import instrumentation
+from .VolumeCache import VolumeCache, ijkToRASMatrix, sourceFingerprint
+
+DEFAULT_SEGMENTATION_CACHE_MB = 2048
+
+
+def dicomLabToRGB(lab):
+    """DICOM scaled CIELab (0..65535) to sRGB (0..1)."""
+    L = lab[0] * 100.0 / 65535.0
+    a = lab[1] * 255.0 / 65535.0 - 128.0
+    b = lab[2] * 255.0 / 65535.0 - 128.0
+    fy = (L + 16.0) / 116.0
+    fx = fy + a / 500.0
+    fz = fy - b / 200.0
+
+    def finv(t):
+        return t ** 3 if t ** 3 > 0.008856 else (t - 16.0 / 116.0) / 7.787
+
+    # D65 white point
+    X = 0.950456 * finv(fx)
+    Y = finv(fy)
+    Z = 1.088754 * finv(fz)
+    linear = [3.2404542 * X - 1.5371385 * Y - 0.4985314 * Z,
+              -0.9692660 * X + 1.8760108 * Y + 0.0415560 * Z,
+              0.0556434 * X - 0.2040259 * Y + 1.0572252 * Z]
+    rgb = []
+    for c in linear:
+        c = 1.055 * c ** (1.0 / 2.4) - 0.055 if c > 0.0031308 else 12.92 * c
+        rgb.append(min(1.0, max(0.0, c)))
+    return rgb
+
+
+class SegmentationArray(object):
+    """Bit-packed frames and metadata of a decoded SEG object.
+
+    frames[f] is the packed binary mask of frame f, which belongs to segment
+    frameSegments[f] and to slice frameSlices[f] of a (slices, rows, columns)
+    grid whose LPS geometry is origin/spacing/direction (as in VolumeArray).
+    """
+
+    def __init__(self, frames, frameSegments, frameSlices, shape, origin, spacing, direction, segments, referencedSeriesUID=''):
+        self.frames = frames
+        self.frameSegments = frameSegments
+        self.frameSlices = frameSlices
+        self.shape = tuple(int(v) for v in shape)
+        self.origin = [float(v) for v in origin]
+        self.spacing = [float(v) for v in spacing]
+        self.direction = [float(v) for v in direction]
+        self.segments = segments  # [{'number', 'label', 'color'}]
+        self.referencedSeriesUID = referencedSeriesUID
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def ijkToRAS(self):
+        return ijkToRASMatrix(self.origin, self.spacing, self.direction)
+
+    def labelmap(self, segmentNumber):
+        """Binary (slices, rows, columns) uint8 array of one segment."""
+        import numpy as np
+        labelmap = np.zeros(self.shape, dtype=np.uint8)
+        frameSize = self.shape[1] * self.shape[2]
+        for frame in np.nonzero(self.frameSegments == segmentNumber)[0]:
+            mask = np.unpackbits(self.frames[frame])[:frameSize]
+            labelmap[self.frameSlices[frame]] |= mask.reshape(self.shape[1:])
+        return labelmap
+
+    def subsampled(self, sliceStep=1, shrink=1):
+        """Every sliceStep-th slice and every shrink-th row and column, as in
+        VolumeArray.subsampled.
+        """
+        import numpy as np
+        slices, rows, columns = self.shape
+        keep = np.nonzero(self.frameSlices % sliceStep == 0)[0]
+        frames = [np.packbits(np.unpackbits(self.frames[frame])[:rows * columns].reshape(rows, columns)[::shrink, ::shrink])
+                  for frame in keep]
+        shape = ((slices - 1) // sliceStep + 1, (rows - 1) // shrink + 1, (columns - 1) // shrink + 1)
+        frames = np.array(frames, dtype=np.uint8) if frames else np.zeros((0, (shape[1] * shape[2] + 7) // 8), dtype=np.uint8)
+        spacing = [self.spacing[0] * shrink, self.spacing[1] * shrink, self.spacing[2] * sliceStep]
+        return SegmentationArray(frames, self.frameSegments[keep], self.frameSlices[keep] // sliceStep, shape,
+                                 self.origin, spacing, self.direction, self.segments, self.referencedSeriesUID)
+
+    def metadata(self):
+        return {'shape': list(self.shape),
+                'geometry': {'origin': self.origin, 'spacing': self.spacing, 'direction': self.direction},
+                'segments': self.segments,
+                'referencedSeriesUID': self.referencedSeriesUID}
+
+
+def decodeSegmentation(files):
+    """Decode the frames of a DICOM SEG series into a SegmentationArray.
+
+    The grid spans the positions of all the frames, empty ones included;
+    only the non-empty frames are kept. Segments listed by several files of
+    the series are kept once.
+    """
+    import numpy as np
+    import pydicom
+
+    packedFrames, frameSegments, positions = [], [], []
+    allPositions = []  # of every frame, for the grid
+    segments, referencedSeriesUID = {}, ''  # segment number -> segment
+    declaredSpacing = None
+    for fileName in files:
+        dataset = pydicom.dcmread(fileName)
+        shared = dataset.SharedFunctionalGroupsSequence[0]
+        orientation = [float(v) for v in shared.PlaneOrientationSequence[0].ImageOrientationPatient]
+        pixelMeasures = shared.PixelMeasuresSequence[0]
+        pixelSpacing = [float(v) for v in pixelMeasures.PixelSpacing]
+        if declaredSpacing is None and getattr(pixelMeasures, 'SpacingBetweenSlices', None):
+            declaredSpacing = float(pixelMeasures.SpacingBetweenSlices)
+        sliceThickness = float(getattr(pixelMeasures, 'SliceThickness', 0) or 1.0)
+        rows, columns = int(dataset.Rows), int(dataset.Columns)
+
+        if not referencedSeriesUID and 'ReferencedSeriesSequence' in dataset:
+            referencedSeriesUID = dataset.ReferencedSeriesSequence[0].SeriesInstanceUID
+        for item in dataset.SegmentSequence:
+            if int(item.SegmentNumber) in segments:
+                continue
+            color = dicomLabToRGB(item.RecommendedDisplayCIELabValue) if 'RecommendedDisplayCIELabValue' in item else [1.0, 0.0, 0.0]
+            segments[int(item.SegmentNumber)] = {'number': int(item.SegmentNumber), 'label': str(item.SegmentLabel), 'color': color}
+
+        pixels = dataset.pixel_array.reshape(-1, rows * columns)
+        if getattr(dataset, 'SegmentationType', 'BINARY') == 'FRACTIONAL':
+            pixels = pixels >= (int(getattr(dataset, 'MaximumFractionalValue', 255)) + 1) // 2
+        for frame, frameGroup in enumerate(dataset.PerFrameFunctionalGroupsSequence):
+            position = [float(v) for v in frameGroup.PlanePositionSequence[0].ImagePositionPatient]
+            allPositions.append(position)
+            if not pixels[frame].any():
+                continue
+            frameSegments.append(int(frameGroup.SegmentIdentificationSequence[0].ReferencedSegmentNumber))
+            positions.append(position)
+            packedFrames.append(np.packbits(pixels[frame] != 0))
+
+    rowDirection = np.array(orientation[:3])
+    columnDirection = np.array(orientation[3:])
+    normal = np.cross(rowDirection, columnDirection)
+    if positions:
+        allDistances = np.array(allPositions).dot(normal)
+        # the declared spacing, or else the spacing of the frame positions
+        # (of all the frames: empty frames fill the gaps between segments)
+        sliceDistances = np.unique(np.round(allDistances, 3))
+        if declaredSpacing:
+            sliceThickness = declaredSpacing
+        elif len(sliceDistances) > 1:
+            sliceThickness = float(np.min(np.diff(sliceDistances)))
+        firstSlice = int(np.argmin(allDistances))
+        origin = allPositions[firstSlice]
+        distances = np.array(positions).dot(normal)
+        frameSlices = np.round((distances - allDistances[firstSlice]) / sliceThickness).astype(np.int32)
+        slices = int(np.round((allDistances.max() - allDistances[firstSlice]) / sliceThickness)) + 1
+        frames = np.array(packedFrames, dtype=np.uint8)
+    else:
+        origin, slices = [0.0, 0.0, 0.0], 1
+        frameSlices = np.zeros(0, dtype=np.int32)
+        frames = np.zeros((0, (rows * columns + 7) // 8), dtype=np.uint8)
+
+    # i runs along the rows (column index), j along the columns (row index)
+    direction = [rowDirection[0], columnDirection[0], normal[0],
+                 rowDirection[1], columnDirection[1], normal[1],
+                 rowDirection[2], columnDirection[2], normal[2]]
+    return SegmentationArray(frames, np.array(frameSegments, dtype=np.int32), frameSlices,
+                             (slices, rows, columns), origin, [pixelSpacing[1], pixelSpacing[0], sliceThickness],
+                             direction, list(segments.values()), referencedSeriesUID)
+
+
+def segmentationNodeFromArray(segmentationArray, name):
+    """Create a segmentation node from a SegmentationArray (main thread only)."""
+    import slicer
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', name)
+    segmentationNode.CreateDefaultDisplayNodes()
+    fillSegmentationNode(segmentationNode, segmentationArray)
+    return segmentationNode
+
+
+def fillSegmentationNode(segmentationNode, segmentationArray):
+    """Replace the segments of a segmentation node with those of a
+    SegmentationArray (main thread only). The node and its display node are
+    kept, so the views showing it keep their slice position.
+    """
+    import numpy as np
+    import vtk
+    import slicer
+    from vtk.util import numpy_support
+    segmentationNode.GetSegmentation().RemoveAllSegments()
+    imageToWorld = slicer.util.vtkMatrixFromArray(np.array(segmentationArray.ijkToRAS()))
+    slices, rows, columns = segmentationArray.shape
+    for segment in segmentationArray.segments:
+        image = slicer.vtkOrientedImageData()
+        image.SetDimensions(columns, rows, slices)
+        image.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())[:] = segmentationArray.labelmap(segment['number']).ravel()
+        image.SetImageToWorldMatrix(imageToWorld)
+        segmentId = segmentationNode.GetSegmentation().AddEmptySegment('', segment['label'], segment['color'])
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(image, segmentationNode, segmentId)
+
+
+class SegmentationCache(VolumeCache):
+    """Size bounded directory of compressed SegmentationArrays."""
+
+    dataSuffix = '.npz'
+    counterName = 'segmentationCache'
+    # of the decoded grid; entries of an older version are misses
+    formatVersion = 2
+
+    def __init__(self, directory, maxBytes=DEFAULT_SEGMENTATION_CACHE_MB * 1024 * 1024):
+        VolumeCache.__init__(self, directory, maxBytes)
+
+    def get(self, seriesUID, files):
+        """The cached SegmentationArray of the series, or None."""
+        import numpy as np
+        dataPath, metadataPath = self._paths(seriesUID)
+        try:
+            with open(metadataPath) as metadataFile:
+                metadata = json.load(metadataFile)
+            if (metadata['seriesUID'] != seriesUID or metadata.get('version') != self.formatVersion
+                    or metadata['fingerprint'] != sourceFingerprint(files)):
+                self.misses += 1
+                instrumentation().count(self.counterName + '.miss')
+                return None
+            with np.load(dataPath) as data:
+                frames, frameSegments, frameSlices = data['frames'], data['frameSegments'], data['frameSlices']
+            # the modification time of the metadata file is the last use (an
+            # entry evicted meanwhile, e.g. by another process, is a miss)
+            os.utime(metadataPath)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            instrumentation().count(self.counterName + '.miss')
+            return None
+        self.hits += 1
+        instrumentation().count(self.counterName + '.hit')
+        return SegmentationArray(frames, frameSegments, frameSlices, metadata['shape'], segments=metadata['segments'],
+                                 referencedSeriesUID=metadata['referencedSeriesUID'], **metadata['geometry'])
+
+    def put(self, seriesUID, files, segmentationArray):
+        """Store a decoded segmentation. Failures are logged, not raised."""
+        import numpy as np
+        if self.maxBytes <= 0:
+            return
+        fingerprint = sourceFingerprint(files)
+        if fingerprint is None:
+            return
+        dataPath, metadataPath = self._paths(seriesUID)
+        metadata = segmentationArray.metadata()
+        metadata.update({'seriesUID': seriesUID, 'fingerprint': fingerprint, 'version': self.formatVersion})
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(dataPath + '.tmp', 'wb') as dataFile:
+                np.savez_compressed(dataFile, frames=segmentationArray.frames,
+                                    frameSegments=segmentationArray.frameSegments, frameSlices=segmentationArray.frameSlices)
+            with open(metadataPath + '.tmp', 'w') as metadataFile:
+                json.dump(metadata, metadataFile)
+            os.replace(dataPath + '.tmp', dataPath)
+            os.replace(metadataPath + '.tmp', metadataPath)
+        except OSError as e:
+            logging.warning('Could not write segmentation cache entry for %s: %s' % (seriesUID, e))
+            return
+        self.evict()
+
+
+def readSegmentation(seriesUID, files, cache=None):
+    """SegmentationArray of a SEG series, from the cache or decoded (and then cached).
+
+    Runs in the worker threads: no MRML access.
+    """
+    if cache is not None and seriesUID:
+        with instrumentation().span('segmentationCache.read'):
+            segmentationArray = cache.get(seriesUID, files)
+        if segmentationArray is not None:
+            return segmentationArray
+    with instrumentation().span('decode.segmentation'):
+        segmentationArray = decodeSegmentation(files)
+    instrumentation().count('files.decoded', len(files))
+    instrumentation().count('bytes.decoded', segmentationArray.nbytes)
+    if cache is not None and seriesUID:
+        with instrumentation().span('segmentationCache.write'):
+            cache.put(seriesUID, files, segmentationArray)
+    return segmentationArray
+
+
+_segmentationCache = None
+
+
+def segmentationCache():
+    """The SegmentationCache in the Slicer cache directory."""
+    global _segmentationCache
+    if _segmentationCache is None:
+        import slicer
+        _segmentationCache = SegmentationCache(os.path.join(slicer.app.cachePath, 'ViewSeries', 'segmentations'))
+    return _segmentationCache
@@ -0,0 +1,231 @@
+# SeriesIndex.py
+#
+# In-memory patient -> study -> series index of the Slicer DICOM database.
+#
+# The widget used to walk the whole database (patients, studiesForPatient,
+# seriesForStudy, filesForSeries and fileValue) every time a patient was
+# clicked. The index walks it once, using the normalized database tables
+# (fieldForPatient/fieldForStudy/fieldForSeries) instead of file headers, and
+# is kept up to date incrementally from the database signals.
+#
+# Only the database object is needed, so this can be used without the GUI.
+################################################################################
+
+
+class PatientRecord(object):
+    """One patient of the DICOM database."""
+
+    def __init__(self, patientUID, name='', patientID=''):
+        self.patientUID = patientUID
+        self.name = name
+        self.patientID = patientID
+        self.studyUIDs = []
+
+
+class StudyRecord(object):
+    """One study of a patient."""
+
+    def __init__(self, studyUID, patientUID, date='', description=''):
+        self.studyUID = studyUID
+        self.patientUID = patientUID
+        self.date = date
+        self.description = description
+        self.seriesUIDs = []
+
+
+class SeriesRecord(object):
+    """One series of a study, with a representative file for header lookups."""
+
+    def __init__(self, seriesUID, studyUID, modality='', description='', seriesNumber='', representativeFile=''):
+        self.seriesUID = seriesUID
+        self.studyUID = studyUID
+        self.modality = modality
+        self.description = description
+        self.seriesNumber = seriesNumber
+        self.representativeFile = representativeFile
+
+
+class DICOMHierarchyIndex(object):
+    """Patient -> studies -> series index built once from the DICOM database.
+
+    Lookups (patients, studiesForPatient, seriesForStudy) are dictionary
+    lookups. Call seriesAdded() and databaseChanged() from the matching
+    ctkDICOMDatabase signals to keep the index current: new series are added
+    directly, and a database change only re-walks the patients it affects,
+    lazily, the next time they are looked up.
+
+    Functions in observers are called with the UID of each patient that was
+    added, re-read, given a new series or removed.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.patientRecords = {}
+        self.studyRecords = {}
+        self.seriesRecords = {}
+        self.patientOrder = []
+        self._stalePatients = set()
+        self.observers = []
+
+    def _notify(self, patientUID):
+        for observer in self.observers:
+            observer(patientUID)
+
+    #
+    # Building
+    #
+
+    def build(self):
+        """Walk the whole database once."""
+        for patientCount in self.buildSteps():
+            pass
+
+    def buildSteps(self, chunkSize=100):
+        """build() as a generator, yielding the number of patients indexed so
+        far after every chunkSize patients, so it can be run a slice at a time.
+        """
+        self.patientRecords = {}
+        self.studyRecords = {}
+        self.seriesRecords = {}
+        self.patientOrder = []
+        self._stalePatients = set()
+        for patientCount, patientUID in enumerate(self.db.patients(), 1):
+            self.addPatient(patientUID)
+            if patientCount % chunkSize == 0:
+                yield patientCount
+        yield len(self.patientOrder)
+
+    def addPatient(self, patientUID):
+        """Add (or re-read) one patient with all of its studies and series."""
+        if patientUID in self.patientRecords:
+            self._forgetPatient(patientUID, keepOrder=True)
+        else:
+            self.patientOrder.append(patientUID)
+        patient = PatientRecord(patientUID,
+                                name=self.db.fieldForPatient('PatientsName', patientUID),
+                                patientID=self.db.fieldForPatient('PatientID', patientUID))
+        self.patientRecords[patientUID] = patient
+        for studyUID in self.db.studiesForPatient(patientUID):
+            self._addStudy(patient, studyUID)
+        self._stalePatients.discard(patientUID)
+        self._notify(patientUID)
+        return patient
+
+    def _addStudy(self, patient, studyUID):
+        study = StudyRecord(studyUID, patient.patientUID,
+                            date=self.db.fieldForStudy('StudyDate', studyUID),
+                            description=self.db.fieldForStudy('StudyDescription', studyUID))
+        self.studyRecords[studyUID] = study
+        patient.studyUIDs.append(studyUID)
+        for seriesUID in self.db.seriesForStudy(studyUID):
+            self._addSeries(study, seriesUID)
+        return study
+
+    def _addSeries(self, study, seriesUID):
+        files = self.db.filesForSeries(seriesUID, 1)
+        series = SeriesRecord(seriesUID, study.studyUID,
+                              modality=self.db.fieldForSeries('Modality', seriesUID),
+                              description=self.db.fieldForSeries('SeriesDescription', seriesUID),
+                              seriesNumber=self.db.fieldForSeries('SeriesNumber', seriesUID),
+                              representativeFile=files[0] if files else '')
+        self.seriesRecords[seriesUID] = series
+        if seriesUID not in study.seriesUIDs:
+            study.seriesUIDs.append(seriesUID)
+        return series
+
+    def _forgetPatient(self, patientUID, keepOrder=False):
+        patient = self.patientRecords.pop(patientUID, None)
+        if patient is None:
+            return
+        for studyUID in patient.studyUIDs:
+            study = self.studyRecords.pop(studyUID, None)
+            if study is None:
+                continue
+            for seriesUID in study.seriesUIDs:
+                self.seriesRecords.pop(seriesUID, None)
+        if not keepOrder:
+            self.patientOrder.remove(patientUID)
+            self._notify(patientUID)
+        self._stalePatients.discard(patientUID)
+
+    #
+    # Incremental updates
+    #
+
+    def seriesAdded(self, seriesUID):
+        """Slot for ctkDICOMDatabase.seriesAdded: index one new series."""
+        if seriesUID in self.seriesRecords:
+            return
+        studyUID = self.db.studyForSeries(seriesUID)
+        patientUID = self.db.patientForStudy(studyUID)
+        if patientUID not in self.patientRecords:
+            self.addPatient(patientUID)
+            return
+        patient = self.patientRecords[patientUID]
+        study = self.studyRecords.get(studyUID)
+        if study is None:
+            self._addStudy(patient, studyUID)
+        else:
+            self._addSeries(study, seriesUID)
+        self._notify(patientUID)
+
+    def databaseChanged(self):
+        """Slot for ctkDICOMDatabase.databaseChanged.
+
+        New and removed patients are handled right away; the patients that
+        are kept are marked stale and re-read one at a time when next used.
+        """
+        current = list(self.db.patients())
+        currentSet = set(current)
+        for patientUID in list(self.patientOrder):
+            if patientUID not in currentSet:
+                self._forgetPatient(patientUID)
+        for patientUID in current:
+            if patientUID not in self.patientRecords:
+                self.addPatient(patientUID)
+            else:
+                self._stalePatients.add(patientUID)
+
+    def _fresh(self, patientUID):
+        if patientUID in self._stalePatients:
+            self.addPatient(patientUID)
+        return self.patientRecords.get(patientUID)
+
+    #
+    # Lookups
+    #
+
+    def patients(self):
+        """All patient records, in database order; stale patients are re-read."""
+        for patientUID in [patientUID for patientUID in self.patientOrder if patientUID in self._stalePatients]:
+            self.addPatient(patientUID)
+        return [self.patientRecords[patientUID] for patientUID in self.patientOrder]
+
+    def patient(self, patientUID):
+        return self._fresh(patientUID)
+
+    def studiesForPatient(self, patientUID):
+        patient = self._fresh(patientUID)
+        if patient is None:
+            return []
+        return [self.studyRecords[studyUID] for studyUID in patient.studyUIDs]
+
+    def study(self, studyUID):
+        study = self.studyRecords.get(studyUID)
+        if study is not None and study.patientUID in self._stalePatients:
+            self._fresh(study.patientUID)
+            study = self.studyRecords.get(studyUID)
+        return study
+
+    def seriesForStudy(self, studyUID):
+        study = self.study(studyUID)
+        if study is None:
+            return []
+        return [self.seriesRecords[seriesUID] for seriesUID in study.seriesUIDs]
+
+    def series(self, seriesUID):
+        series = self.seriesRecords.get(seriesUID)
+        if series is not None:
+            study = self.study(series.studyUID)
+            series = self.seriesRecords.get(seriesUID) if study is not None else None
+        return series
@@ -0,0 +1,95 @@
+# SliceLayout.py
+#
+# Reusable grid of slice views for viewerPerSEG.
+#
+# The views used to be named after the series they showed, so every study
+# produced a new layout XML and new slice widgets. Here the views are slots
+# with fixed names (ViewSeries1, ViewSeries2, ...) whose label is changed to
+# the series they show. The layout description of each (rows, columns,
+# orientation) grid is registered with the layout node under a layout ID
+# derived from the grid shape (a description left by an earlier engine, e.g.
+# before a module reload, is replaced), and the arrangement is only switched
+# when the grid shape changes; the layout manager keeps the widgets of views
+# that remain, so moving between two studies with the same grid does not
+# rebuild anything.
+################################################################################
+
+
+class SliceLayoutEngine(object):
+    """Registers and switches grid layouts of slot views."""
+
+    viewNamePrefix = 'ViewSeries'
+    # custom layout IDs, one per grid shape: derived from the shape, so they
+    # are the same for every engine (e.g. after a module reload)
+    firstLayoutId = 3300
+    orientations = ('Axial', 'Sagittal', 'Coronal', 'Reformat')
+
+    sliceViewItemPattern = """
+          <item><view class="vtkMRMLSliceNode" singletontag="{viewName}">
+            <property name="orientation" action="default">{orientation}</property>
+            <property name="viewlabel" action="default">{viewName}</property>
+            <property name="viewcolor" action="default">{color}</property>
+          </view></item>
+         """
+
+    def __init__(self, lookupTable):
+        self.lookupTable = lookupTable
+        self.layoutIds = {}  # (rows, columns, orientation) -> layout ID
+
+    def slotViewName(self, index):
+        """Name (singleton tag) of the view in grid position index (0-based)."""
+        return '%s%d' % (self.viewNamePrefix, index + 1)
+
+    def layoutDescription(self, rows, columns, orientation):
+        index = 0
+        layoutDescription = '<layout type="vertical">\n'
+        for row in range(rows):
+            layoutDescription += ' <item> <layout type="horizontal">\n'
+            for column in range(columns):
+                rgb = [int(round(v * 255)) for v in self.lookupTable.GetTableValue(index + 1)[:-1]]
+                color = '#%0.2X%0.2X%0.2X' % tuple(rgb)
+                layoutDescription += self.sliceViewItemPattern.format(viewName=self.slotViewName(index), orientation=orientation, color=color)
+                index += 1
+            layoutDescription += '</layout></item>\n'
+        layoutDescription += '</layout>'
+        return layoutDescription
+
+    def layoutId(self, rows, columns, orientation):
+        """Layout ID of the grid, with its description registered with the
+        layout node (or replaced, if it is not the one built here).
+        """
+        import slicer
+        key = (rows, columns, orientation)
+        layoutNode = slicer.app.layoutManager().layoutLogic().GetLayoutNode()
+        layoutId = self.layoutIds.get(key)
+        if layoutId is None:
+            layoutId = self.firstLayoutId + 10000 * self.orientations.index(orientation) + 100 * rows + columns
+            self.layoutIds[key] = layoutId
+        description = self.layoutDescription(rows, columns, orientation)
+        if not layoutNode.IsLayoutDescription(layoutId):
+            layoutNode.AddLayoutDescription(layoutId, description)
+        elif layoutNode.GetLayoutDescription(layoutId) != description:
+            layoutNode.SetLayoutDescription(layoutId, description)
+        return layoutId
+
+    def showGrid(self, rows, columns, orientation, labels):
+        """Show a rows x columns grid and label its views.
+
+        Returns the view names of the slots, in grid order. The arrangement
+        is only changed (and the GUI only updated) if the grid shape changed.
+        """
+        import slicer
+        layoutManager = slicer.app.layoutManager()
+        layoutId = self.layoutId(rows, columns, orientation)
+        layoutNode = layoutManager.layoutLogic().GetLayoutNode()
+        if layoutNode.GetViewArrangement() != layoutId:
+            layoutNode.SetViewArrangement(layoutId)
+            # let the new widgets all decide how big they should be
+            slicer.app.processEvents()
+        viewNames = []
+        for index in range(rows * columns):
+            viewName = self.slotViewName(index)
+            label = labels[index] if index < len(labels) else '%d_%d' % (index // columns, index % columns)
+            layoutManager.sliceWidget(viewName).mrmlSliceNode().SetLayoutLabel(label)
+            viewNames.append(viewName)
+        return viewNames
@@ -0,0 +1,254 @@
+# StudyBrowser.py
+#
+# The data side of ViewSeries, without any GUI: listing patients and studies,
+# classifying the series of a study and matching each SEG or RTSTRUCT to its
+# source volume, and building the plan of the pairs to load.
+#
+# This used to be done inside the widget's selectPatient/selectStudy, so it
+# could not be timed or tested on its own. ViewSeriesLogic is a StudyBrowser
+# (and adds the viewers); the benchmarks in Testing/Python use StudyBrowser
+# directly on a stand-in database.
+#
+# Only a ctkDICOMDatabase-like db object is needed. Examining series with the
+# DICOM plugins is left to subclasses (see examineSeries), so without Slicer a
+# load plan has the series and files but no loadables.
+################################################################################
+
+import logging
+
+from . import TagFetch
+from .Instrumentation import instrumentation
+from .SeriesIndex import DICOMHierarchyIndex
+from .SearchIndex import PatientSearchIndex
+from .RecordLists import patientList, studyList
+from .ReferenceGraph import ReferenceGraph, SourceMatch
+from .StudyPipeline import CancellationToken
+
+SOURCE_MODALITIES = ('MR', 'CT')
+
+# keys of examineSeries()
+VOLUME = 'volume'
+SEGMENTATION = 'segmentation'
+RTSTRUCTURE = 'rtstructure'
+
+# kind of the series shown over a source volume, by modality
+STRUCTURE_KINDS = {'SEG': SEGMENTATION, 'RTSTRUCT': RTSTRUCTURE}
+
+
+class StudyBrowser(object):
+    """Patients, studies and load plans of a DICOM database."""
+
+    def __init__(self, db, referenceGraph=None, loadableCache=None):
+        self.db = db
+        self.index = DICOMHierarchyIndex(db)
+        # the search index follows the changes of self.index
+        self.searchIndex = PatientSearchIndex(self.index)
+        self.referenceGraph = referenceGraph if referenceGraph is not None else ReferenceGraph()
+        self.loadableCache = loadableCache
+
+    #
+    # Indexing
+    #
+
+    def buildIndexSteps(self):
+        """Build the hierarchy and search indexes and update the reference
+        graph, yielding (stage, count) pairs as it goes; stage is 'patients',
+        'search' or 'references'.
+        """
+        for patientCount in self.index.buildSteps():
+            yield 'patients', patientCount
+        for patientCount in self.searchIndex.buildSteps():
+            yield 'search', patientCount
+        for seriesCount in self.referenceGraph.updateSteps(self.index):
+            yield 'references', seriesCount
+
+    def buildIndex(self):
+        for stage, count in self.buildIndexSteps():
+            pass
+
+    #
+    # Listing
+    #
+
+    def listPatients(self, sortBy=None, **filters):
+        """PatientRecords, sorted (see RecordLists) and filtered with the
+        keyword arguments of PatientSearchIndex.search.
+        """
+        records = patientList(self.index, sortBy)
+        if filters:
+            records.filter(self.searchIndex.search(**filters).patientUIDs)
+        return [self.index.patient(patientUID) for patientUID in records.keys]
+
+    def listStudies(self, patientUID, sortBy=None):
+        """StudyRecords of a patient."""
+        return [self.index.study(studyUID) for studyUID in studyList(self.index, patientUID, sortBy).keys]
+
+    #
+    # Classifying and matching
+    #
+
+    def classifySeries(self, studyUID):
+        """(seriesRecords, {seriesUID: modality}, SeriesTagTable) of a study.
+
+        The modality and description of all the series are read in one batch.
+        """
+        with instrumentation().span('index'):
+            seriesRecords = self.index.seriesForStudy(studyUID)
+        seriesList = [series.seriesUID for series in seriesRecords]
+        instrumentation().count('series', len(seriesList))
+        with instrumentation().span('metadata'):
+            seriesTags = TagFetch.fetchSeriesTags(self.db, seriesList, [TagFetch.MODALITY, TagFetch.SERIES_DESCRIPTION], self.index)
+        modalities = {}
+        for series in seriesRecords:
+            modalities[series.seriesUID] = seriesTags.value(series.seriesUID, TagFetch.MODALITY) or series.modality
+        return seriesRecords, modalities, seriesTags
+
+    def isSourceVolume(self, seriesUID, modalities=None):
+        """True for an MR or CT series in the database, in any study."""
+        if modalities is not None and seriesUID in modalities:
+            return modalities[seriesUID] in SOURCE_MODALITIES
+        series = self.index.series(seriesUID)
+        return series is not None and series.modality in SOURCE_MODALITIES
+
+    def matchSegmentation(self, series, modalities=None):
+        """SourceMatch of one SEG or RTSTRUCT SeriesRecord. The series of
+        the study (the keys of modalities) are preferred as the source.
+        """
+        modalities = modalities or {}
+        match = self.referenceGraph.matchSource(series.seriesUID, series.representativeFile,
+                                                lambda seriesUID: self.isSourceVolume(seriesUID, modalities),
+                                                preferred=modalities)
+        if match.isMissing and not match.referencedSeriesUIDs and modalities.get(series.seriesUID, series.modality) == 'SEG':
+            # no references in the SEG header: ask the plugin
+            loadables = self.examineSeries(SEGMENTATION, series.seriesUID, self.db.filesForSeries(series.seriesUID))
+            referencedSeriesUID = loadables[0].referencedSeriesUID if loadables else ''
+            if referencedSeriesUID and self.isSourceVolume(referencedSeriesUID, modalities):
+                match = SourceMatch(series.seriesUID, referencedSeriesUID, [referencedSeriesUID])
+        return match
+
+    def matchSegmentations(self, studyUID):
+        """SourceMatches of all the SEGs and RTSTRUCTs of a study, missing sources included."""
+        seriesRecords, modalities, seriesTags = self.classifySeries(studyUID)
+        matches = [self.matchSegmentation(series, modalities) for series in seriesRecords if modalities[series.seriesUID] in STRUCTURE_KINDS]
+        self.referenceGraph.save()
+        return matches
+
+    def seriesDescription(self, seriesUID, seriesTags=None):
+        if seriesTags is not None and seriesUID in seriesTags:
+            return seriesTags.value(seriesUID, TagFetch.SERIES_DESCRIPTION)
+        series = self.index.series(seriesUID)
+        return series.description if series else seriesUID
+
+    def examineSeries(self, kind, seriesUID, files):
+        """Loadables of a series for kind (VOLUME, SEGMENTATION or RTSTRUCTURE), or None
+        when there are no DICOM plugins (see ViewSeriesLogic).
+        """
+        return None
+
+    #
+    # Load plans
+    #
+
+    def loadPlanSteps(self, studyUID, token, plan):
+        """Classify the series of a study and match each SEG or RTSTRUCT to
+        its volume.
+
+        Fills plan with the series UIDs, kinds (SEGMENTATION or RTSTRUCTURE),
+        files, loadables and view names of the pairs to show, and with the
+        SourceMatches of the SEGs and RTSTRUCTs whose volume
+        is not in the database or cannot be loaded (missingSources). The
+        volume may be in another study. Every yield is a point where the GUI can run, and where the
+        plan is abandoned if token was cancelled.
+        """
+        seriesRecords, modalities, seriesTags = self.classifySeries(studyUID)
+        logging.debug('Series of study %s: %s' % (studyUID, modalities))
+
+        ### Match each SEG and RTSTRUCT to its source volume ###
+        # The referenced series come from the reference graph (read once from
+        # the header and kept on disk); the series of this study are preferred.
+        segmentationSeriesUIDs = []
+        segmentationKinds = []
+        masterVolumeSeriesUIDs = []
+        viewNames = []
+        matches = []
+        missingSources = []
+        for series in seriesRecords:
+            if modalities[series.seriesUID] not in STRUCTURE_KINDS:
+                continue
+            with instrumentation().span('match'):
+                match = self.matchSegmentation(series, modalities)
+            if match.isMissing:
+                logging.warning('No source volume in the database for segmentation %s (references %s)' %
+                                (self.seriesDescription(series.seriesUID, seriesTags), ', '.join(match.referencedSeriesUIDs) or 'nothing'))
+                missingSources.append(match)
+                continue
+            segmentationSeriesUIDs.append(series.seriesUID)
+            segmentationKinds.append(STRUCTURE_KINDS[modalities[series.seriesUID]])
+            masterVolumeSeriesUIDs.append(match.sourceSeriesUID)
+            viewNames.append(self.seriesDescription(match.sourceSeriesUID, seriesTags))
+            matches.append(match)
+            yield
+            token.raiseIfCancelled()
+        self.referenceGraph.save()
+
+        files = {}
+        with instrumentation().span('files'):
+            for seriesUID in masterVolumeSeriesUIDs + segmentationSeriesUIDs:
+                if seriesUID not in files:
+                    files[seriesUID] = self.db.filesForSeries(seriesUID)
+        instrumentation().count('files.touched', sum(len(seriesFiles) for seriesFiles in files.values()))
+
+        # Get the master volume loadables
+        # (examineSeries gives None without DICOM plugins, [] when the plugin
+        # cannot load the series)
+        masterVolumeLoadables = []
+        unloadable = set()
+        for index, seriesUID in enumerate(masterVolumeSeriesUIDs):
+            with instrumentation().span('examine'):
+                loadables = self.examineSeries(VOLUME, seriesUID, files[seriesUID])
+            masterVolumeLoadables.append(loadables[0] if loadables else None)
+            if loadables is not None and not loadables:
+                unloadable.add(index)
+            # a plugin may take a while on each series
+            yield
+            token.raiseIfCancelled()
+
+        # Get the segmentation (or structure set) loadables
+        segmentationLoadables = []
+        for index, (seriesUID, kind) in enumerate(zip(segmentationSeriesUIDs, segmentationKinds)):
+            with instrumentation().span('examine'):
+                loadables = self.examineSeries(kind, seriesUID, files[seriesUID])
+            segmentationLoadables.append(loadables[0] if loadables else None)
+            if loadables is not None and not loadables:
+                unloadable.add(index)
+            yield
+            token.raiseIfCancelled()
+
+        # pairs whose volume (or SEG) the plugins cannot load are reported
+        # with the missing sources instead of being loaded
+        keep = [index for index in range(len(matches)) if index not in unloadable]
+        for index in sorted(unloadable):
+            logging.warning('Could not load the source volume %s of segmentation %s' %
+                            (matches[index].sourceSeriesUID, self.seriesDescription(matches[index].seriesUID, seriesTags)))
+            missingSources.append(matches[index])
+        if len(keep) < len(matches):
+            segmentationSeriesUIDs, segmentationKinds, masterVolumeSeriesUIDs, viewNames, masterVolumeLoadables, segmentationLoadables = [
+                [values[index] for index in keep] for values in
+                (segmentationSeriesUIDs, segmentationKinds, masterVolumeSeriesUIDs, viewNames, masterVolumeLoadables, segmentationLoadables)]
+
+        plan['seriesList'] = [series.seriesUID for series in seriesRecords]
+        plan['files'] = files
+        plan['segmentationLoadables'] = segmentationLoadables
+        plan['masterVolumeLoadables'] = masterVolumeLoadables
+        plan['segmentationSeriesUIDs'] = segmentationSeriesUIDs
+        plan['segmentationKinds'] = segmentationKinds
+        plan['masterVolumeSeriesUIDs'] = masterVolumeSeriesUIDs
+        plan['viewNames'] = viewNames
+        plan['missingSources'] = missingSources
+
+    def loadPlan(self, studyUID):
+        """loadPlanSteps run to the end."""
+        plan = {}
+        for step in self.loadPlanSteps(studyUID, CancellationToken(), plan):
+            pass
+        return plan
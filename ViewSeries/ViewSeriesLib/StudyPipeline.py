@@ -0,0 +1,147 @@
+# StudyPipeline.py
+#
+# Single, cancellable pipeline for loading the selected study.
+#
+# A study load is written as a generator: every yield is a point where the
+# load gives control back to the GUI and where it can be abandoned. The
+# pipeline steps the generator from a QTimer, so clicks are still handled
+# while a study loads. Selecting another study cancels the load in flight
+# (its CancellationToken tells the background loaders to stop and to remove
+# the nodes they already created); selecting the study that is already being
+# loaded is merged into the running load instead of starting a second one.
+################################################################################
+
+import logging
+
+
+class Cancelled(Exception):
+    """Raised by CancellationToken.raiseIfCancelled()."""
+
+
+class CancellationToken(object):
+    """Shared flag telling the parts of one load that it was abandoned."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error('Error while cancelling a load: %s' % e)
+
+    def onCancel(self, callback):
+        """Call callback when the token is cancelled (right away if it already is)."""
+        if self.cancelled:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def raiseIfCancelled(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+def timeSliced(steps, sliceSeconds=0.02):
+    """Run another generator for up to sliceSeconds at a time.
+
+    Yields the last value steps yielded at the end of each time slice, so a
+    pipeline step is about sliceSeconds long however small the steps are.
+    """
+    import time
+    deadline = time.perf_counter() + sliceSeconds
+    for value in steps:
+        if time.perf_counter() >= deadline:
+            yield value
+            deadline = time.perf_counter() + sliceSeconds
+
+
+class _Task(object):
+
+    def __init__(self, key, token, steps):
+        self.key = key
+        self.token = token
+        self.steps = steps
+        self.finished = False
+
+
+class StudyLoadPipeline(object):
+    """Runs at most one load at a time, keyed by what is being loaded.
+
+    submit(key, steps) starts steps(token), a generator function, unless a
+    load with the same key is already running, in which case the request is
+    merged into it. Any other running load is cancelled first.
+    """
+
+    stepIntervalMs = 0
+    waitIntervalMs = 20
+
+    def __init__(self):
+        self.task = None
+        self.timer = None
+
+    def isRunning(self, key=None):
+        if self.task is None or self.task.finished:
+            return False
+        return key is None or self.task.key == key
+
+    def submit(self, key, steps):
+        """Returns False if the request was merged into the running load."""
+        if self.isRunning(key):
+            logging.debug('Load of %s is already running' % key)
+            return False
+        self.cancel()
+        token = CancellationToken()
+        self.task = _Task(key, token, steps(token))
+        self._startTimer()
+        return True
+
+    def cancel(self):
+        task, self.task = self.task, None
+        if task is None or task.finished:
+            return
+        task.token.cancel()
+        try:
+            task.steps.close()
+        except ValueError:
+            # cancelled from inside one of its own steps (e.g. while processing
+            # events); it is not stepped again
+            pass
+
+    def _startTimer(self):
+        import qt
+        if self.timer is None:
+            self.timer = qt.QTimer()
+            self.timer.connect('timeout()', self._step)
+        self.timer.setInterval(self.stepIntervalMs)
+        self.timer.start()
+
+    def _step(self):
+        task = self.task
+        if task is None or task.finished:
+            self.timer.stop()
+            return
+        waiting = False
+        try:
+            # A step yields True while it only waits for background work
+            waiting = next(task.steps)
+        except (StopIteration, Cancelled):
+            task.finished = True
+        except Exception as e:
+            task.finished = True
+            logging.error('Loading %s failed: %s' % (task.key, e))
+            import traceback
+            traceback.print_exc()
+        if self.task is not task:
+            # a new load was submitted while this step ran
+            return
+        if task.finished:
+            self.timer.stop()
+        else:
+            self.timer.setInterval(self.waitIntervalMs if waiting else self.stepIntervalMs)
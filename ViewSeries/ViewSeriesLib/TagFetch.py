@@ -0,0 +1,223 @@
+# TagFetch.py
+#
+# Batched DICOM tag retrieval.
+#
+# db.fileValue() looks up one (file, tag) pair at a time and falls through to
+# parsing the file header whenever the tag cache misses, so reading two tags
+# for 60 series could parse up to 120 headers. fetchTags() instead takes all
+# the pairs at once: it fills what it can from the database tag cache, reads
+# each remaining file header only once (without pixel data) for all of the
+# tags still missing for that file, and writes the new values back to the tag
+# cache in one call. The tag cache lookups are two queries for all the pairs:
+# ctkDICOMDatabase only has per file (instanceForFile) and per tag
+# (cachedTag) calls, so its database file is read directly, with a read-only
+# SQLiteDICOMDatabase kept open for the session. fetchSeriesTags() first takes the tags that the hierarchy
+# index already holds (modality, description and number of each series, from
+# the database Series table), so classifying a study usually needs no tag
+# lookup at all.
+################################################################################
+
+import logging
+import os
+import sqlite3
+
+from .Instrumentation import instrumentation
+
+MODALITY = '0008,0060'
+SERIES_DESCRIPTION = '0008,103e'
+SERIES_NUMBER = '0020,0011'
+PATIENT_NAME = '0010,0010'
+PATIENT_ID = '0010,0020'
+STUDY_DATE = '0008,0020'
+SOP_CLASS_UID = '0008,0016'
+
+# Markers stored by ctkDICOMDatabase in the tag cache
+TAG_NOT_IN_INSTANCE = '__TAG_NOT_IN_INSTANCE__'
+VALUE_IS_EMPTY_STRING = '__VALUE_IS_EMPTY_STRING__'
+
+
+class SeriesTagTable(object):
+    """Tag values in columnar form: one column per tag, one row per series.
+
+    Rows are keyed by SeriesInstanceUID, so table.value(seriesUID, tag) and
+    table.column(tag) are both plain lookups.
+    """
+
+    def __init__(self, seriesUIDs, tags):
+        self.seriesUIDs = list(seriesUIDs)
+        self.tags = list(tags)
+        self.rows = dict((seriesUID, row) for row, seriesUID in enumerate(self.seriesUIDs))
+        self.columns = dict((tag, [''] * len(self.seriesUIDs)) for tag in self.tags)
+
+    def __len__(self):
+        return len(self.seriesUIDs)
+
+    def __contains__(self, seriesUID):
+        return seriesUID in self.rows
+
+    def column(self, tag):
+        return self.columns[tag]
+
+    def value(self, seriesUID, tag):
+        return self.columns[tag][self.rows[seriesUID]]
+
+    def setValue(self, seriesUID, tag, value):
+        self.columns[tag][self.rows[seriesUID]] = value
+
+    def row(self, seriesUID):
+        """All the tags of one series as a {tag: value} dictionary."""
+        row = self.rows[seriesUID]
+        return dict((tag, self.columns[tag][row]) for tag in self.tags)
+
+
+def _tagKey(tag):
+    """'0008,103e' -> 0x0008103e"""
+    group, element = tag.split(',')
+    return (int(group, 16) << 16) | int(element, 16)
+
+
+def _headerValue(element):
+    if element is None or element.value is None:
+        return ''
+    value = element.value
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return '\\'.join(str(v) for v in value)
+    if isinstance(value, bytes):
+        return value.decode('latin-1').strip('\x00 ')
+    return str(value)
+
+
+def readHeaderTags(fileName, tags):
+    """Read the given tags from one file header, without the pixel data.
+
+    Returns {tag: value}, with '' for tags that are not in the file.
+    """
+    import pydicom
+    keys = [_tagKey(tag) for tag in tags]
+    try:
+        dataset = pydicom.dcmread(fileName, stop_before_pixels=True, specific_tags=keys)
+    except Exception as e:
+        logging.warning('Could not read DICOM header of %s: %s' % (fileName, e))
+        return dict((tag, '') for tag in tags)
+    return dict((tag, _headerValue(dataset.get(key))) for tag, key in zip(tags, keys))
+
+
+_bulkDatabases = {}  # database file -> read-only SQLiteDICOMDatabase
+
+
+def bulkDatabase(db):
+    """What answers the batched queries (instancesForFiles, cachedTags) for
+    db: db itself if it has them (SQLiteDICOMDatabase), else a read-only
+    SQLiteDICOMDatabase on the file of a ctkDICOMDatabase, or None if that
+    file cannot be opened.
+    """
+    if hasattr(db, 'cachedTags'):
+        return db
+    path = getattr(db, 'databaseFilename', '')
+    if not path or not os.path.exists(path):
+        return None
+    bulk = _bulkDatabases.get(path)
+    if bulk is None:
+        from .SQLiteDatabase import SQLiteDICOMDatabase
+        try:
+            bulk = SQLiteDICOMDatabase(path, tagCachePath=getattr(db, 'tagCacheDatabaseFilename', None) or None, readOnly=True)
+        except sqlite3.Error as e:
+            logging.warning('Could not read %s directly, the tags are looked up one at a time: %s' % (path, e))
+            return None
+        _bulkDatabases[path] = bulk
+    return bulk
+
+
+def fetchTags(db, requests):
+    """Fill many (fileName, tag) pairs at once.
+
+    Returns {(fileName, tag): value}. The tag cache of db is used first, in
+    two queries for all the pairs (see bulkDatabase; one call per file and
+    per tag if the database file cannot be read); the files that still have
+    missing tags have their header parsed once, and the values read are
+    stored back to the tag cache.
+    """
+    # each (file, tag) once, in request order
+    requests = list(dict.fromkeys(requests))
+    fileNames = list(dict.fromkeys(fileName for fileName, tag in requests))
+    bulk = bulkDatabase(db)
+    try:
+        if bulk is None:
+            raise sqlite3.Error('no batched queries')
+        instanceByFile = bulk.instancesForFiles(fileNames)
+        cachedRequests = [(instanceByFile[fileName], tag) for fileName, tag in requests if instanceByFile.get(fileName)]
+        cached = bulk.cachedTags(cachedRequests)
+    except sqlite3.Error:
+        instanceByFile = dict((fileName, db.instanceForFile(fileName)) for fileName in fileNames)
+        cachedRequests = [(instanceByFile[fileName], tag) for fileName, tag in requests if instanceByFile.get(fileName)]
+        cached = dict((request, db.cachedTag(*request)) for request in cachedRequests)
+        instrumentation().count('tags.unbatched', len(cachedRequests))
+
+    values = {}
+    missingTagsByFile = {}
+    for fileName, tag in requests:
+        value = cached.get((instanceByFile.get(fileName), tag), '')
+        if value in (TAG_NOT_IN_INSTANCE, VALUE_IS_EMPTY_STRING):
+            values[(fileName, tag)] = ''
+        elif value:
+            values[(fileName, tag)] = value
+        else:
+            missingTagsByFile.setdefault(fileName, []).append(tag)
+
+    instrumentation().count('tags.cached', len(values))
+    instrumentation().count('headers.read', len(missingTagsByFile))
+    cacheInstances, cacheTags, cacheValues = [], [], []
+    for fileName, tags in missingTagsByFile.items():
+        headerValues = readHeaderTags(fileName, tags)
+        for tag in tags:
+            value = headerValues[tag]
+            values[(fileName, tag)] = value
+            if instanceByFile.get(fileName):
+                cacheInstances.append(instanceByFile[fileName])
+                cacheTags.append(tag)
+                cacheValues.append(value if value else VALUE_IS_EMPTY_STRING)
+    if cacheInstances:
+        db.cacheTags(cacheInstances, cacheTags, cacheValues)
+    return values
+
+
+# tags that are columns of the database Series table, kept in SeriesRecord
+SERIES_RECORD_FIELDS = {MODALITY: 'modality', SERIES_DESCRIPTION: 'description', SERIES_NUMBER: 'seriesNumber'}
+
+
+def fetchSeriesTags(db, seriesUIDs, tags, index=None):
+    """Read the given tags for many series in one batch.
+
+    With a hierarchy index, the tags it already holds (SERIES_RECORD_FIELDS)
+    are taken from its records, and the other tags from one representative
+    file per series. Returns a SeriesTagTable.
+    """
+    table = SeriesTagTable(seriesUIDs, tags)
+    requests = []
+    fileBySeries = {}
+    for seriesUID in table.seriesUIDs:
+        record = index.series(seriesUID) if index is not None else None
+        missingTags = []
+        for tag in table.tags:
+            value = getattr(record, SERIES_RECORD_FIELDS[tag]) if record is not None and tag in SERIES_RECORD_FIELDS else ''
+            if value:
+                table.setValue(seriesUID, tag, value)
+            else:
+                missingTags.append(tag)
+        if not missingTags:
+            continue
+        if record is not None and record.representativeFile:
+            fileBySeries[seriesUID] = record.representativeFile
+        else:
+            files = db.filesForSeries(seriesUID, 1)
+            if not files:
+                continue
+            fileBySeries[seriesUID] = files[0]
+        requests.extend((seriesUID, tag) for tag in missingTags)
+    instrumentation().count('tags.indexed', len(table) * len(table.tags) - len(requests))
+    if not requests:
+        return table
+    values = fetchTags(db, [(fileBySeries[seriesUID], tag) for seriesUID, tag in requests])
+    for seriesUID, tag in requests:
+        table.setValue(seriesUID, tag, values[(fileBySeries[seriesUID], tag)])
+    return table
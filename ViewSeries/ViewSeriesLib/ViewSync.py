@@ -0,0 +1,274 @@
+# ViewSync.py
+#
+# Linked navigation of the slot views of viewerPerSEG.
+#
+# With Slicer's own view linking every slice node event is broadcast to all
+# the other views at once, so with 9-16 views each scroll or window/level
+# drag step renders every view, and interaction becomes jerky. The
+# synchronizer replaces it for the slot views (and turns it back to what it
+# was when they are no longer linked): it observes their slice nodes
+# and the display nodes of their volumes, keeps only the latest slice offset,
+# zoom (vertical field of view) and window/level changed by the user, and
+# applies them to the other views at most once per frame. Views whose state
+# already matches are not touched, and only the views that changed and are
+# visible are rendered.
+#
+# Each frame (applying the changes and rendering) is timed against
+# targetFrameMs; when frames take longer, the next ones are spaced out to
+# the measured frame time instead of piling up. The frame times are kept
+# for frameTimeStats() and recorded as the sync.frame span (see
+# Instrumentation).
+################################################################################
+
+import collections
+import time
+
+from .Instrumentation import instrumentation
+
+OFFSET = 'offset'
+ZOOM = 'zoom'
+WINDOW_LEVEL = 'windowLevel'
+
+# differences below these are not changes
+_TOLERANCE = {OFFSET: 1e-3, ZOOM: 1e-3, WINDOW_LEVEL: 1e-3}
+
+
+class ViewSynchronizer(object):
+    """Links the slice offset, zoom and window/level of a set of slice views."""
+
+    targetFrameMs = 16.0
+
+    def __init__(self):
+        self.linked = {OFFSET: True, ZOOM: True, WINDOW_LEVEL: True}
+        self.views = {}  # viewName -> slice widget
+        self.known = {}  # viewName -> {property: value} last seen in the view
+        self.sliceObservations = []  # (slice node, tag)
+        self.displayObservations = {}  # viewName -> (display node, tag)
+        self.linkedControls = {}  # composite node ID -> (composite node, its linked control before setViews)
+        self.pending = {}  # property -> (source viewName, value), waiting for the next frame
+        self.current = {}  # property -> value, last applied to all the views
+        self.applying = False
+        self.timer = None
+        self.intervalMs = self.targetFrameMs
+        self.lastFrameEnd = 0.0
+        self.frameTimes = collections.deque(maxlen=240)  # ms
+        self.framesOverTarget = 0
+
+    #
+    # Views
+    #
+
+    def setViews(self, sliceWidgets):
+        """Link these views ({viewName: slice widget}) instead of the previous ones.
+
+        Slicer's own linking is turned off in the linked views, and restored
+        to what it was when a view is no longer linked (e.g. setViews({})).
+        """
+        self._removeObservers()
+        self.views = dict(sliceWidgets)
+        self.known = {}
+        self.pending = {}
+        self.current = {}
+        compositeNodes = dict((sliceWidget.mrmlSliceCompositeNode().GetID(), sliceWidget.mrmlSliceCompositeNode())
+                              for sliceWidget in self.views.values())
+        # views that are no longer linked get Slicer's linking back as it was
+        for compositeNodeID in list(self.linkedControls):
+            if compositeNodeID not in compositeNodes:
+                compositeNode, linkedControl = self.linkedControls.pop(compositeNodeID)
+                compositeNode.SetLinkedControl(linkedControl)
+        for compositeNodeID, compositeNode in compositeNodes.items():
+            if compositeNodeID not in self.linkedControls:
+                self.linkedControls[compositeNodeID] = (compositeNode, compositeNode.GetLinkedControl())
+            # Slicer's own linking would broadcast every event again
+            compositeNode.SetLinkedControl(False)
+        for viewName, sliceWidget in self.views.items():
+            sliceNode = sliceWidget.mrmlSliceNode()
+            tag = sliceNode.AddObserver('ModifiedEvent', lambda caller, event, viewName=viewName: self._onViewModified(viewName))
+            self.sliceObservations.append((sliceNode, tag))
+            self._observeDisplayNode(viewName)
+            self.known[viewName] = self._state(viewName)
+
+    def viewContentChanged(self, viewName):
+        """A volume was put in the view: follow its display node, and give it
+        the linked state the user has set so far.
+        """
+        if viewName not in self.views:
+            return
+        self._observeDisplayNode(viewName)
+        self.known[viewName] = self._state(viewName)
+        if self.current:
+            self.applying = True
+            try:
+                self._applyTo(viewName, dict((name, value) for name, value in self.current.items() if self.linked[name]))
+            finally:
+                self.applying = False
+
+    def paused(self):
+        """Context manager for changes made by the module (e.g. fitting a
+        view to its volume) that should not be propagated.
+        """
+        return _Paused(self)
+
+    def clear(self):
+        self.setViews({})
+        if self.timer is not None:
+            self.timer.stop()
+
+    def _removeObservers(self):
+        for node, tag in self.sliceObservations:
+            node.RemoveObserver(tag)
+        self.sliceObservations = []
+        for node, tag in self.displayObservations.values():
+            node.RemoveObserver(tag)
+        self.displayObservations = {}
+
+    def _displayNode(self, viewName):
+        import slicer
+        compositeNode = self.views[viewName].mrmlSliceCompositeNode()
+        volumeID = compositeNode.GetForegroundVolumeID() or compositeNode.GetBackgroundVolumeID()
+        volumeNode = slicer.mrmlScene.GetNodeByID(volumeID) if volumeID else None
+        return volumeNode.GetDisplayNode() if volumeNode is not None else None
+
+    def _observeDisplayNode(self, viewName):
+        displayNode = self._displayNode(viewName)
+        observed = self.displayObservations.get(viewName)
+        if observed is not None and observed[0] is displayNode:
+            return
+        if observed is not None:
+            observed[0].RemoveObserver(observed[1])
+            del self.displayObservations[viewName]
+        if displayNode is not None:
+            tag = displayNode.AddObserver('ModifiedEvent', lambda caller, event, viewName=viewName: self._onViewModified(viewName))
+            self.displayObservations[viewName] = (displayNode, tag)
+
+    def _state(self, viewName):
+        sliceWidget = self.views[viewName]
+        state = {OFFSET: sliceWidget.sliceLogic().GetSliceOffset(),
+                 ZOOM: sliceWidget.mrmlSliceNode().GetFieldOfView()[1]}
+        displayNode = self._displayNode(viewName)
+        # automatic window/level is not a user change (e.g. a preview being refined)
+        if displayNode is not None and not displayNode.GetAutoWindowLevel():
+            state[WINDOW_LEVEL] = (displayNode.GetWindow(), displayNode.GetLevel())
+        return state
+
+    #
+    # Events and frames
+    #
+
+    def _onViewModified(self, viewName):
+        if self.applying or viewName not in self.views:
+            return
+        state = self._state(viewName)
+        known = self.known.get(viewName, {})
+        for name, value in state.items():
+            if self.linked[name] and not _same(name, known.get(name), value):
+                # the latest value wins, one update per frame
+                self.pending[name] = (viewName, value)
+        self.known[viewName] = state
+        if self.pending:
+            self._schedule()
+
+    def _schedule(self):
+        import qt
+        if self.timer is None:
+            self.timer = qt.QTimer()
+            self.timer.setSingleShot(True)
+            self.timer.connect('timeout()', self._applyPending)
+        if self.timer.isActive():
+            return
+        sinceLastFrameMs = (time.perf_counter() - self.lastFrameEnd) * 1000.0
+        self.timer.start(int(max(0.0, self.intervalMs - sinceLastFrameMs)))
+
+    def _applyPending(self):
+        start = time.perf_counter()
+        pending, self.pending = self.pending, {}
+        changedViews = []
+        self.applying = True
+        try:
+            for name, (sourceViewName, value) in pending.items():
+                self.current[name] = value
+            for viewName in self.views:
+                values = dict((name, value) for name, (sourceViewName, value) in pending.items() if sourceViewName != viewName)
+                if values and self._applyTo(viewName, values):
+                    changedViews.append(viewName)
+            # only the views that changed and can be seen are rendered
+            for viewName in changedViews:
+                sliceWidget = self.views[viewName]
+                if sliceWidget.visible:
+                    sliceWidget.sliceView().forceRender()
+        finally:
+            self.applying = False
+        self.lastFrameEnd = time.perf_counter()
+        frameMs = (self.lastFrameEnd - start) * 1000.0
+        self.frameTimes.append(frameMs)
+        instrumentation().record('sync.frame', frameMs / 1000.0)
+        instrumentation().count('sync.views', len(changedViews))
+        if frameMs > self.targetFrameMs:
+            self.framesOverTarget += 1
+            instrumentation().count('sync.overTarget')
+        # slow frames space out the next ones rather than queue up
+        self.intervalMs = max(self.targetFrameMs, frameMs)
+
+    def _applyTo(self, viewName, values):
+        """Set the values that differ in one view; True if anything changed."""
+        sliceWidget = self.views[viewName]
+        sliceNode = sliceWidget.mrmlSliceNode()
+        known = self.known.get(viewName) or self._state(viewName)
+        changed = False
+        wasModifying = sliceNode.StartModify()
+        try:
+            if OFFSET in values and not _same(OFFSET, known.get(OFFSET), values[OFFSET]):
+                sliceWidget.sliceLogic().SetSliceOffset(values[OFFSET])
+                changed = True
+            if ZOOM in values and not _same(ZOOM, known.get(ZOOM), values[ZOOM]):
+                fieldOfView = sliceNode.GetFieldOfView()
+                # keep the aspect ratio of this view
+                scale = values[ZOOM] / fieldOfView[1] if fieldOfView[1] else 1.0
+                sliceNode.SetFieldOfView(fieldOfView[0] * scale, values[ZOOM], fieldOfView[2])
+                changed = True
+        finally:
+            sliceNode.EndModify(wasModifying)
+        displayNode = self._displayNode(viewName)
+        if WINDOW_LEVEL in values and displayNode is not None and not _same(WINDOW_LEVEL, known.get(WINDOW_LEVEL), values[WINDOW_LEVEL]):
+            wasModifying = displayNode.StartModify()
+            displayNode.AutoWindowLevelOff()
+            displayNode.SetWindowLevel(*values[WINDOW_LEVEL])
+            displayNode.EndModify(wasModifying)
+            changed = True
+        if changed:
+            self.known[viewName] = self._state(viewName)
+        return changed
+
+    def frameTimeStats(self):
+        """{'frames', 'median', 'p95', 'max', 'overTarget'} of the recent frames, in ms."""
+        frameTimes = sorted(self.frameTimes)
+        if not frameTimes:
+            return {'frames': 0, 'median': 0.0, 'p95': 0.0, 'max': 0.0, 'overTarget': self.framesOverTarget}
+        return {'frames': len(frameTimes),
+                'median': frameTimes[len(frameTimes) // 2],
+                'p95': frameTimes[min(len(frameTimes) - 1, int(len(frameTimes) * 0.95))],
+                'max': frameTimes[-1],
+                'overTarget': self.framesOverTarget}
+
+
+def _same(name, a, b):
+    if a is None or b is None:
+        return a is b
+    if name == WINDOW_LEVEL:
+        return all(abs(x - y) <= _TOLERANCE[name] for x, y in zip(a, b))
+    return abs(a - b) <= _TOLERANCE[name]
+
+
+class _Paused(object):
+
+    def __init__(self, synchronizer):
+        self.synchronizer = synchronizer
+
+    def __enter__(self):
+        self.wasApplying = self.synchronizer.applying
+        self.synchronizer.applying = True
+        return self
+
+    def __exit__(self, *exc):
+        self.synchronizer.applying = self.wasApplying
+        return False
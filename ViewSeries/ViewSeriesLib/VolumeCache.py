@@ -0,0 +1,289 @@
+# VolumeCache.py
+#
+# Persistent on-disk cache of decoded series volumes, keyed by
+# SeriesInstanceUID.
+#
+# Each entry is the voxel array saved as an uncompressed .npy file, which is
+# opened memory mapped on a hit, plus a small .json file with the geometry
+# (origin, spacing and direction, in LPS as read by SimpleITK) and a
+# fingerprint of the source files (names, sizes and modification times, in
+# the order they are decoded, so slices decoded in another order miss).
+# An entry whose fingerprint does not match the current files is ignored and
+# overwritten. The least recently used entries are removed when the cache
+# grows over its size limit.
+#
+# Reading and writing entries does not touch MRML, so it can be done in the
+# worker threads; volumeNodeFromArray() creates the node on the main thread.
+################################################################################
+
+import hashlib
+import json
+import logging
+import os
+
+from .Instrumentation import instrumentation
+
+DEFAULT_VOLUME_CACHE_MB = 20480
+
+
+def ijkToRASMatrix(origin, spacing, direction):
+    """4x4 IJK to RAS matrix, as nested lists, from LPS origin, spacing and
+    row-major direction matrix (whose columns are the i, j, k axes).
+    """
+    matrix = [[0.0] * 4 for row in range(4)]
+    flip = [-1.0, -1.0, 1.0]  # LPS to RAS
+    for row in range(3):
+        for column in range(3):
+            matrix[row][column] = flip[row] * direction[3 * row + column] * spacing[column]
+        matrix[row][3] = flip[row] * origin[row]
+    matrix[3][3] = 1.0
+    return matrix
+
+
+class VolumeArray(object):
+    """Voxels (k, j, i order) and LPS geometry of a decoded volume."""
+
+    def __init__(self, voxels, origin, spacing, direction, image=None):
+        self.voxels = voxels
+        self.origin = [float(v) for v in origin]
+        self.spacing = [float(v) for v in spacing]
+        self.direction = [float(v) for v in direction]
+        # keeps the SimpleITK image alive when voxels is a view into it
+        self._image = image
+
+    @classmethod
+    def fromImage(cls, image):
+        import SimpleITK as sitk
+        return cls(sitk.GetArrayViewFromImage(image), image.GetOrigin(), image.GetSpacing(), image.GetDirection(), image=image)
+
+    @property
+    def nbytes(self):
+        return self.voxels.nbytes
+
+    @property
+    def isMapped(self):
+        """True if the voxels are memory mapped from the disk cache."""
+        import numpy as np
+        return isinstance(self.voxels, np.memmap)
+
+    def ijkToRAS(self):
+        return ijkToRASMatrix(self.origin, self.spacing, self.direction)
+
+    def geometry(self):
+        return {'origin': self.origin, 'spacing': self.spacing, 'direction': self.direction}
+
+    def subsampled(self, sliceStep=1, shrink=1):
+        """Every sliceStep-th slice and every shrink-th row and column, with
+        the geometry of the subsampled grid (the first voxel stays in place).
+        """
+        spacing = [self.spacing[0] * shrink, self.spacing[1] * shrink, self.spacing[2] * sliceStep]
+        return VolumeArray(self.voxels[::sliceStep, ::shrink, ::shrink], self.origin, spacing, self.direction, image=self._image)
+
+
+def volumeNodeFromArray(volumeArray, name):
+    """Create a scalar volume node from a VolumeArray (main thread only)."""
+    import numpy as np
+    import slicer
+    ijkToRAS = slicer.util.vtkMatrixFromArray(np.array(volumeArray.ijkToRAS()))
+    volumeNode = slicer.util.addVolumeFromArray(np.ascontiguousarray(volumeArray.voxels), ijkToRAS=ijkToRAS, name=name)
+    volumeNode.CreateDefaultDisplayNodes()
+    volumeNode.GetDisplayNode().AutoWindowLevelOn()
+    return volumeNode
+
+
+def updateVolumeNodeFromArray(volumeNode, volumeArray):
+    """Replace the voxels and geometry of a volume node (main thread only).
+
+    The node and its display node are kept, so the views showing it keep
+    their slice position.
+    """
+    import numpy as np
+    import slicer
+    volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(np.array(volumeArray.ijkToRAS())))
+    slicer.util.updateVolumeFromArray(volumeNode, np.ascontiguousarray(volumeArray.voxels))
+
+
+def sortSliceFiles(files):
+    """The single frame image files of a series sorted along the normal of
+    the image plane by ImagePositionPatient, in the order the DICOM scalar
+    volume plugin gives its loadables (the order decodeScalarVolume needs).
+
+    Files are read up to their pixels. The files are returned as they are if
+    one of them has no position or orientation.
+    """
+    import numpy as np
+    import pydicom
+    files = list(files)
+    positions = []
+    normal = None
+    for fileName in files:
+        dataset = pydicom.dcmread(fileName, stop_before_pixels=True, specific_tags=['ImagePositionPatient', 'ImageOrientationPatient'])
+        if 'ImagePositionPatient' not in dataset or 'ImageOrientationPatient' not in dataset:
+            return files
+        if normal is None:
+            orientation = [float(v) for v in dataset.ImageOrientationPatient]
+            normal = np.cross(orientation[:3], orientation[3:])
+        positions.append([float(v) for v in dataset.ImagePositionPatient])
+    if not positions:
+        return files
+    distances = np.array(positions).dot(normal)
+    return [files[index] for index in np.argsort(distances, kind='stable')]
+
+
+def sourceFingerprint(files):
+    """Fingerprint of the names, sizes and modification times of the source
+    files, in the order given: the same files in another order (e.g. slices
+    decoded in another order) have another fingerprint.
+
+    Returns None if a file cannot be read.
+    """
+    digest = hashlib.sha1()
+    for fileName in files:
+        try:
+            stat = os.stat(fileName)
+        except OSError:
+            return None
+        digest.update(('%s\0%d\0%d\0' % (fileName, stat.st_size, stat.st_mtime_ns)).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+class VolumeCache(object):
+    """Size bounded directory of memory mappable decoded volumes."""
+
+    dataSuffix = '.npy'
+    counterName = 'volumeCache'  # of the hit and miss counters
+
+    def __init__(self, directory, maxBytes=DEFAULT_VOLUME_CACHE_MB * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, seriesUID):
+        key = hashlib.sha1(seriesUID.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + self.dataSuffix, base + '.json'
+
+    def contains(self, seriesUID):
+        """True if there is an entry for the series, up to date or not."""
+        return os.path.exists(self._paths(seriesUID)[1])
+
+    def get(self, seriesUID, files):
+        """The cached VolumeArray of the series (memory mapped), or None."""
+        import numpy as np
+        voxelsPath, metadataPath = self._paths(seriesUID)
+        try:
+            with open(metadataPath) as metadataFile:
+                metadata = json.load(metadataFile)
+            if metadata['seriesUID'] != seriesUID or metadata['fingerprint'] != sourceFingerprint(files):
+                self.misses += 1
+                instrumentation().count(self.counterName + '.miss')
+                return None
+            voxels = np.load(voxelsPath, mmap_mode='r')
+            # the modification time of the metadata file is the last use (an
+            # entry evicted meanwhile, e.g. by another process, is a miss)
+            os.utime(metadataPath)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            instrumentation().count(self.counterName + '.miss')
+            return None
+        self.hits += 1
+        instrumentation().count(self.counterName + '.hit')
+        return VolumeArray(voxels, **metadata['geometry'])
+
+    def put(self, seriesUID, files, volumeArray):
+        """Store a decoded volume. Failures are logged, not raised."""
+        import numpy as np
+        if self.maxBytes <= 0 or volumeArray.nbytes > self.maxBytes:
+            return
+        fingerprint = sourceFingerprint(files)
+        if fingerprint is None:
+            return
+        voxelsPath, metadataPath = self._paths(seriesUID)
+        metadata = {'seriesUID': seriesUID, 'fingerprint': fingerprint, 'geometry': volumeArray.geometry(),
+                    'shape': list(volumeArray.voxels.shape), 'dtype': str(volumeArray.voxels.dtype)}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write to temporary files first so a reader never sees half an entry
+            with open(voxelsPath + '.tmp', 'wb') as voxelsFile:
+                np.save(voxelsFile, np.ascontiguousarray(volumeArray.voxels))
+            with open(metadataPath + '.tmp', 'w') as metadataFile:
+                json.dump(metadata, metadataFile)
+            os.replace(voxelsPath + '.tmp', voxelsPath)
+            os.replace(metadataPath + '.tmp', metadataPath)
+        except OSError as e:
+            logging.warning('Could not write volume cache entry for %s: %s' % (seriesUID, e))
+            return
+        self.evict()
+
+    def entries(self):
+        """[(lastUsed, bytes, voxelsPath, metadataPath)] of all the entries."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for fileName in os.listdir(self.directory):
+            if not fileName.endswith('.json'):
+                continue
+            metadataPath = os.path.join(self.directory, fileName)
+            voxelsPath = metadataPath[:-len('.json')] + self.dataSuffix
+            try:
+                entries.append((os.path.getmtime(metadataPath), os.path.getsize(voxelsPath), voxelsPath, metadataPath))
+            except OSError:
+                continue
+        return entries
+
+    @property
+    def totalBytes(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in maxBytes."""
+        entries = sorted(self.entries())
+        total = sum(entry[1] for entry in entries)
+        for lastUsed, size, voxelsPath, metadataPath in entries:
+            if total <= self.maxBytes:
+                break
+            for path in (metadataPath, voxelsPath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        maxBytes, self.maxBytes = self.maxBytes, 0
+        self.evict()
+        self.maxBytes = maxBytes
+
+
+def readScalarVolume(seriesUID, files, cache=None):
+    """VolumeArray of a series, from the cache or decoded (and then cached).
+
+    Runs in the worker threads: no MRML access.
+    """
+    if cache is not None and seriesUID:
+        with instrumentation().span('volumeCache.read'):
+            volumeArray = cache.get(seriesUID, files)
+        if volumeArray is not None:
+            return volumeArray
+    from .LoadEngine import decodeScalarVolume
+    with instrumentation().span('decode'):
+        volumeArray = VolumeArray.fromImage(decodeScalarVolume(files))
+    instrumentation().count('files.decoded', len(files))
+    instrumentation().count('bytes.decoded', volumeArray.nbytes)
+    if cache is not None and seriesUID:
+        with instrumentation().span('volumeCache.write'):
+            cache.put(seriesUID, files, volumeArray)
+    return volumeArray
+
+
+_volumeCache = None
+
+
+def volumeCache():
+    """The VolumeCache in the Slicer cache directory."""
+    global _volumeCache
+    if _volumeCache is None:
+        import slicer
+        _volumeCache = VolumeCache(os.path.join(slicer.app.cachePath, 'ViewSeries', 'volumes'))
+    return _volumeCache
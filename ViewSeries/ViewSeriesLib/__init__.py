@@ -0,0 +1,21 @@
+from .SeriesIndex import DICOMHierarchyIndex, PatientRecord, StudyRecord, SeriesRecord
+from .TagFetch import SeriesTagTable, fetchTags, fetchSeriesTags
+from .LoadableCache import LoadableCache, loadableCache, fileListFingerprint
+from .LoadEngine import LoadRequest, PairLoader, decodeScalarVolume, workerPool
+from .StudyPipeline import CancellationToken, Cancelled, StudyLoadPipeline, timeSliced
+from .NodeCache import NodeResidencyManager, nodeResidency, nodeMemorySize
+from .Prefetch import DecodedImageCache, StudyPrefetcher, decodedImages
+from .VolumeCache import VolumeArray, VolumeCache, volumeCache, readScalarVolume, sortSliceFiles, volumeNodeFromArray
+from .SegmentationCache import SegmentationArray, SegmentationCache, segmentationCache, readSegmentation, segmentationNodeFromArray
+from .NodeRegistry import ViewNodeRegistry
+from .SliceLayout import SliceLayoutEngine
+from .RecordLists import LazyRecordList, patientList, studyList
+from .SearchIndex import PatientSearchIndex, SearchResult, SortedIndex
+from .ReferenceGraph import ReferenceGraph, SourceMatch, referenceGraph, readReferencedSeries
+from .StudyBrowser import StudyBrowser
+from .Instrumentation import Instrumentation, instrumentation
+from .ViewSync import ViewSynchronizer
+from .SegmentStatistics import SegmentStatisticsCache, segmentStatistics, segmentStatisticsCache, readSegmentStatistics
+from .RTStructure import decodeRTStructure, imageSeriesGeometry, rasterizeContours, readRTStructure
+from .SQLiteDatabase import SQLiteDICOMDatabase
+from .CacheWarming import studyJob, warmCohort, warmStudy